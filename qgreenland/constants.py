@@ -37,10 +37,55 @@ TMP_DIR = WIP_DIR
 # Presence indicates the project is ready to be zipped for release.
 ZIP_TRIGGERFILE = os.path.join(WIP_DIR, 'READY_TO_ZIP')
 
+# Resource usage of every task run, appended to by all builds. See
+# `qgreenland.util.profiling`.
+BUILD_METRICS_FILE = os.path.join(WIP_DIR, 'build_metrics.jsonl')
+
 REQUEST_TIMEOUT = 20
 
+# Partial downloads, kept so failed fetches can resume. On the same filesystem
+# as INPUT_DIR so completed downloads can be moved into place cheaply.
+DOWNLOAD_STAGING_DIR = os.path.join(INPUT_DIR, '.partial-downloads')
+# Maximum parallel connections per HTTP download.
+FETCH_CONNECTIONS = int(os.environ.get('QGR_FETCH_CONNECTIONS', 4))
+# Bytes read per block of FTP downloads; see `qgreenland.util.ftp`.
+FTP_BUFFER_SIZE = int(os.environ.get('QGR_FTP_BUFFER_SIZE', 1024 * 1024))
+# Maximum files downloaded at once from each host by one fetch task, and how
+# often to retry a failed download, waiting FETCH_BACKOFF_S, then twice as
+# long, etc. See `qgreenland.util.concurrent_fetch`.
+FETCH_FILES_PER_HOST = int(os.environ.get('QGR_FETCH_FILES_PER_HOST', 4))
+FETCH_RETRIES = 3
+FETCH_BACKOFF_S = 2
+# Connection slots per remote host, shared by all workers, and the number of
+# slots for hosts not configured in `luigi.toml`. See
+# `qgreenland.util.governor`.
+HOST_GOVERNOR_DIR = os.path.join(DATA_DIR, 'host-governor')
+HOST_CONNECTIONS_DEFAULT = 8
+# Throughput of every mirror downloaded from; see `qgreenland.util.mirrors`.
+MIRROR_THROUGHPUT_FILE = os.path.join(DATA_DIR, 'mirror_throughput.json')
+# What each fetch downloaded, to detect upstream changes; see
+# `qgreenland.util.manifest`.
+FETCH_MANIFEST_DIR = os.path.join(INPUT_DIR, '.manifests')
+
+# Pages of features downloaded from ArcGIS feature servers, kept so re-fetches
+# only download pages which changed; see `qgreenland.util.feature_server`.
+FEATURE_SERVER_PAGES_DIR = os.path.join(INPUT_DIR, '.feature-server-pages')
+# Most features requested per page; servers may allow fewer.
+FEATURE_SERVER_PAGE_SIZE = 1000
+
+# Granule metadata looked up in CMR; see `qgreenland.util.cmr`.
+CMR_CACHE_DIR = os.path.join(DATA_DIR, 'cmr-cache')
+CMR_CACHE_MAX_AGE_S = int(
+    os.environ.get('QGR_CMR_CACHE_MAX_AGE_S', 7 * 24 * 60 * 60)
+)
+
 # URS stuff
 URS_COOKIE = 'urs_user_already_logged'
+# Earthdata Login cookies shared by all workers; see `qgreenland.util.edl`.
+EDL_COOKIE_JAR = os.path.join(DATA_DIR, 'edl_cookies.txt')
+# How long to reuse an authenticated session, and its cookies which don't
+# expire on their own.
+EDL_SESSION_MAX_AGE_S = 4 * 60 * 60
 
 
 class TaskType(Enum):
@@ -1,22 +1,34 @@
 import os
-import shutil
 
 import luigi
 
 from qgreenland.constants import LOCALDATA_DIR, PRIVATE_ARCHIVE_DIR, TaskType
 from qgreenland.util.cmr import get_cmr_granule
-from qgreenland.util.edl import create_earthdata_authenticated_session as make_session
+from qgreenland.util.concurrent_fetch import fetch_all
+from qgreenland.util.feature_server import (
+    fetch_pages,
+    last_edit_date,
+    layer_info,
+    pages_digest,
+)
+from qgreenland.util.luigi import NETWORK_BOUND_RESOURCES
+from qgreenland.util.manifest import file_entry, read_manifest, write_manifest
 from qgreenland.util.misc import (
     datasource_dirname,
-    fetch_and_write_file,
+    link_or_copy,
+    remote_file_changed,
     temporary_path_dir,
 )
-from qgreenland.util.vector import ogr2ogr
+from qgreenland.util.vector import merge_to_gpkg
 
 
 class FetchTask(luigi.Task):
     dataset_cfg = luigi.DictParameter()
     source_cfg = luigi.DictParameter()
+    # Replace an existing output instead of keeping it. Set by
+    # `qgreenland.util.refresh` to re-fetch sources which changed upstream.
+    refresh = luigi.BoolParameter(default=False, significant=False)
+    resources = NETWORK_BOUND_RESOURCES
 
     @property
     def output_name(self):
@@ -25,10 +37,30 @@ class FetchTask(luigi.Task):
             source_id=self.source_cfg['id'],
         )
 
+    @property
+    def manifest(self):
+        return read_manifest(self.output_name)
 
-class FetchCmrGranule(FetchTask):
-    session = None
+    @property
+    def content_version(self):
+        """Incremented each time a refresh fetches different content.
+
+        Part of the hash of downstream WIP outputs; see `LayerTask.config_hash`.
+        """
+        return self.manifest.get('generation', 0)
 
+    def changed_upstream(self):
+        """Whether the source may have changed since it was fetched.
+
+        Sources which can't be checked are assumed unchanged.
+        """
+        return False
+
+    def temporary_output_dir(self):
+        return temporary_path_dir(self.output(), replace=self.refresh)
+
+
+class FetchCmrGranule(FetchTask):
     def output(self):
         path = [TaskType.FETCH.value, self.output_name]
         if 'subdir_path' in self.source_cfg:
@@ -47,12 +79,27 @@ class FetchCmrGranule(FetchTask):
                 'Ignoring TLS certificate verification is not supported for CMR granules.'
             )
 
-        with temporary_path_dir(self.output()) as temp_path:
-            for url in granule.urls:
-                if not self.session:
-                    self.session = make_session(hosts=[url])
+        files = {}
+        with self.temporary_output_dir() as temp_path:
+            fetch_all(
+                granule.urls,
+                output_dir=temp_path,
+                mirrors=self.source_cfg.get('mirrors', ()),
+                manifest=files,
+            )
 
-                fetch_and_write_file(url, output_dir=temp_path, session=self.session)
+        write_manifest(
+            self.output_name, files, cmr_revision_id=granule.revision_id,
+        )
+
+    def changed_upstream(self):
+        granule = get_cmr_granule(
+            granule_ur=self.source_cfg['granule_ur'],
+            collection_concept_id=self.source_cfg['collection_concept_id'],
+            max_age_s=0,
+        )
+
+        return granule.revision_id != self.manifest.get('cmr_revision_id')
 
 
 class FetchDataFiles(FetchTask):
@@ -68,12 +115,35 @@ class FetchDataFiles(FetchTask):
             raise RuntimeError('Use a FetchCmrGranule task!')
 
         verify = self.source_cfg.get('verify', True)
-        with temporary_path_dir(self.output()) as temp_path:
-            for url in self.source_cfg['urls']:
-                fetch_and_write_file(url, output_dir=temp_path, verify=verify)
+        files = {}
+        with self.temporary_output_dir() as temp_path:
+            fetch_all(
+                self.source_cfg['urls'],
+                output_dir=temp_path,
+                verify=verify,
+                mirrors=self.source_cfg.get('mirrors', ()),
+                manifest=files,
+                decompress=self.source_cfg.get('decompress_on_fetch', False),
+            )
+
+        write_manifest(self.output_name, files)
+
+    def changed_upstream(self):
+        entries = {e['url']: e for e in self.manifest.get('files', {}).values()}
+        verify = self.source_cfg.get('verify', True)
+
+        return any(
+            # Sources fetched before manifests were recorded are re-fetched.
+            url not in entries
+            or remote_file_changed(url, entries[url], verify=verify)
+            for url in self.source_cfg['urls']
+        )
 
 
 class FetchLocalDataFiles(FetchTask):
+    # Copies from local disk; no need to hold a network slot.
+    resources: dict = {}
+
     def output(self):
         return luigi.LocalTarget(
             os.path.join(TaskType.FETCH.value,
@@ -81,20 +151,22 @@ class FetchLocalDataFiles(FetchTask):
             format=luigi.format.Nop
         )
 
-    def run(self):
+    def _source_files(self):
+        """Return a mapping of output relative paths to local source paths."""
         if self.dataset_cfg['access_method'] == 'local':
-            local_dir = LOCALDATA_DIR
-            with temporary_path_dir(self.output()) as temp_path:
-                for filename in self.source_cfg['urls']:
-                    source_path = os.path.join(local_dir, filename)
-                    out_path = os.path.join(temp_path, os.path.basename(filename))
-
-                    shutil.copy2(source_path, out_path)
+            return {
+                os.path.basename(filename): os.path.join(LOCALDATA_DIR, filename)
+                for filename in self.source_cfg['urls']
+            }
 
         elif self.dataset_cfg['access_method'] == 'manual':
             local_dir = os.path.join(PRIVATE_ARCHIVE_DIR, self.dataset_cfg['id'])
-            with temporary_path_dir(self.output()) as temp_path:
-                shutil.copytree(local_dir, temp_path, dirs_exist_ok=True)
+            return {
+                os.path.relpath(os.path.join(dirpath, fn), local_dir):
+                    os.path.join(dirpath, fn)
+                for dirpath, _, filenames in os.walk(local_dir)
+                for fn in filenames
+            }
 
         else:
             raise RuntimeError(
@@ -102,8 +174,37 @@ class FetchLocalDataFiles(FetchTask):
                 f' {self.dataset_cfg["access_method"]}'
             )
 
+    def run(self):
+        source_files = self._source_files()
+        with self.temporary_output_dir() as temp_path:
+            for relpath, source_path in source_files.items():
+                link_or_copy(source_path, os.path.join(temp_path, relpath))
+
+        write_manifest(self.output_name, {
+            relpath: file_entry(source_path, url=source_path)
+            for relpath, source_path in source_files.items()
+        })
+
+    def changed_upstream(self):
+        recorded = self.manifest.get('files', {})
+        source_files = self._source_files()
+        if set(source_files) != set(recorded):
+            return True
+
+        return any(
+            file_entry(source_path, url=source_path)['sha256']
+            != recorded[relpath]['sha256']
+            for relpath, source_path in source_files.items()
+        )
+
 
 class FetchOgrRemoteData(FetchTask):
+    """Download an ArcGIS feature server layer to a GeoPackage.
+
+    Pages of features are downloaded concurrently, and only if they changed
+    since the last fetch; see `qgreenland.util.feature_server`.
+    """
+
     def output(self):
         return luigi.LocalTarget(
             os.path.join(TaskType.FETCH.value,
@@ -111,13 +212,38 @@ class FetchOgrRemoteData(FetchTask):
             format=luigi.format.Nop
         )
 
-    def run(self):
-        with temporary_path_dir(self.output()) as temp_path:
-            url = self.source_cfg['query_url']
+    def complete(self):
+        # Outputs fetched by earlier versions hold `fetched.geojson` instead.
+        return os.path.isfile(os.path.join(self.output().path, 'fetched.gpkg'))
 
-            ofile = os.path.join(temp_path, 'fetched.geojson')
-            ogr2ogr_kwargs = {
-                'oo': 'FEATURE_SERVER_PAGING=YES',
-            }
+    def temporary_output_dir(self):
+        # Runs only to refresh the output, or to replace an earlier version's.
+        return temporary_path_dir(self.output(), replace=True)
+
+    def run(self):
+        url = self.source_cfg['query_url']
+        # Recorded before fetching, so edits made meanwhile are detected later.
+        edited = last_edit_date(layer_info(url))
+        page_fps = fetch_pages(url)
+
+        with self.temporary_output_dir() as temp_path:
+            # Named like the layer of the Esri JSON pages, which layer configs'
+            # SQL selects from.
+            merge_to_gpkg(
+                page_fps, os.path.join(temp_path, 'fetched.gpkg'), layer_name='ESRIJSON',
+            )
 
-            ogr2ogr(f'"{url}"', ofile, **ogr2ogr_kwargs)
+        ofile = os.path.join(self.output().path, 'fetched.gpkg')
+        write_manifest(self.output_name, {
+            # The GeoPackage differs every time it's written, even if the
+            # features don't.
+            'fetched.gpkg': {
+                **file_entry(ofile, url=url),
+                'sha256': pages_digest(page_fps),
+            },
+        }, last_edit_date=edited)
+
+    def changed_upstream(self):
+        edited = last_edit_date(layer_info(self.source_cfg['query_url']))
+        # Layers without edit tracking are assumed unchanged.
+        return edited is not None and edited != self.manifest.get('last_edit_date')
@@ -1,112 +1,460 @@
 """common.py: Tasks that could apply to any type of dataproduct."""
 import copy
-import gzip
+import functools
 import logging
 import os
+import tempfile
 import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Type
 
 import luigi
 import rarfile
 from osgeo import gdal
 
 from qgreenland.constants import TaskType
-from qgreenland.util.luigi import LayerTask
-from qgreenland.util.misc import (find_in_dir_by_pattern,
+from qgreenland.util.luigi import (CPU_BOUND_RESOURCES,
+                                   LayerTask,
+                                   SourceTask,
+                                   task_threads)
+from qgreenland.util.misc import (DECOMPRESS_BUFFER_SIZE,
+                                  find_in_dir_by_pattern,
                                   find_single_file_by_ext,
                                   find_single_file_by_name,
-                                  temporary_path_dir)
-
+                                  gunzip_files,
+                                  json_hash,
+                                  link_or_copy,
+                                  link_tree,
+                                  relpaths_in,
+                                  temporary_path_dir,
+                                  with_sidecars)
 
 logger = logging.getLogger('luigi-interface')
 
 
+def _data_source_steps(layer_task):
+    """Return steps of the same class as `layer_task` for its data source."""
+    # Imported here to avoid a circular import; layer pipelines import this
+    # module.
+    from qgreenland.util.task import data_source_steps
+
+    return data_source_steps(layer_task.layer_cfg['data_source'], type(layer_task))
+
+
+class DecompressSource(SourceTask):
+    """Decompress an archive once for every layer that uses it."""
+
+    # Empty to extract all files.
+    extract_files = luigi.ListParameter(default=())
+
+
+class UngzipSource(SourceTask):
+    """Decompress a data source's .gz files, `cpu` at a time.
+
+    Sources fetched with `decompress_on_fetch` have no .gz files left; their
+    files are linked as-is.
+    """
+
+    def run(self):
+        gzip_paths = find_in_dir_by_pattern(self.input().path, pattern='*.gz')
+        with temporary_path_dir(self.output()) as temp_path:
+            if not gzip_paths:
+                link_tree(self.input().path, temp_path)
+                return
+
+            gunzip_files(gzip_paths, temp_path, workers=task_threads(self))
+
+
+def _extract_batch(open_archive, members, output_dir):
+    with open_archive() as archive:
+        for member in members:
+            archive.extract(member, path=output_dir)
+
+
+def _extract_members(open_archive, members, output_dir, *, workers):
+    """Extract `members` into `output_dir` on `workers` threads.
+
+    Each thread opens the archive with `open_archive` and extracts its share of
+    the members.
+    """
+    # Threads would otherwise race to create the same directories.
+    for member in members:
+        os.makedirs(
+            os.path.normpath(os.path.join(output_dir, os.path.dirname(member))),
+            exist_ok=True,
+        )
+
+    n_workers = max(1, min(len(members), workers))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(
+                _extract_batch, open_archive, members[i::n_workers], output_dir,
+            )
+            for i in range(n_workers)
+        ]
+        for future in futures:
+            future.result()
+
+
+class UnrarSource(DecompressSource):
+    def run(self):
+        rar_path = find_single_file_by_ext(self.input().path, ext='.rar')
+        with rarfile.RarFile(rar_path) as rf:
+            members = [info.filename for info in rf.infolist() if not info.isdir()]
+
+        if self.extract_files:
+            members = with_sidecars(self.extract_files, members)
+
+        with temporary_path_dir(self.output()) as temp_path:
+            _extract_members(
+                functools.partial(rarfile.RarFile, rar_path), members, temp_path,
+                workers=task_threads(self),
+            )
+
+
+def _find_zip(path, input_filename=None):
+    if input_filename:
+        return find_single_file_by_name(path, filename=input_filename)
+
+    return find_single_file_by_ext(path, ext='.zip')
+
+
+class UnzipSource(DecompressSource):
+    input_filename = luigi.OptionalParameter(default=None)
+
+    def run(self):
+        zf_path = _find_zip(self.input().path, self.input_filename)
+        with zipfile.ZipFile(zf_path) as zf:
+            members = zf.namelist()
+
+        if self.extract_files:
+            members = with_sidecars(self.extract_files, members)
+
+        with temporary_path_dir(self.output()) as temp_path:
+            _extract_members(
+                functools.partial(zipfile.ZipFile, zf_path), members, temp_path,
+                workers=task_threads(self),
+            )
+
+
 class Decompress(LayerTask):
+    """Link this layer's files from the data source's decompressed archive.
+
+    The archive is decompressed once, by `source_task`, with the files needed
+    by every layer using it, and their sidecars (see `with_sidecars`).
+
+    With `decompress_kwargs.in_place`, the archives themselves are linked
+    instead, and later steps read their members with GDAL's `/vsizip/`,
+    `/vsitar/` or `/vsigzip/` (see `LayerTask.reads_archives`), so nothing is
+    extracted.
+    """
+
     task_type = TaskType.WIP
+    config_keys = ('decompress_kwargs', 'unzip_kwargs')
+    source_task_cls: Type[SourceTask] = DecompressSource
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.decompress_kwargs = self.layer_cfg.get('decompress_kwargs', {})
 
+    @property
+    def extract_files(self):
+        """Files this layer needs from the archive; `None` for all files."""
+        return self.decompress_kwargs.get('extract_files')
+
+    @property
+    def in_place(self):
+        return self.decompress_kwargs.get('in_place', False)
+
+    @property
+    def source_task_kwargs(self):
+        """Parameters, besides `extract_files`, identifying the archive."""
+        return {}
+
+    @property
+    def source_task_cpu(self):
+        """Cores this layer requests for `source_task_cls` in `task_resources`."""
+        return self.layer_cfg.get('task_resources', {}).get(
+            self.source_task_cls.__name__, {},
+        ).get('cpu', CPU_BOUND_RESOURCES['cpu'])
+
+    @functools.cached_property
+    def source_task(self):
+        sharing_steps = [
+            step for step in _data_source_steps(self)
+            if step.requires_task == self.requires_task
+            and step.source_task_kwargs == self.source_task_kwargs
+            and not step.in_place
+        ]
+
+        extract_files = set()
+        for step in [self, *sharing_steps]:
+            if step.extract_files is None:
+                # An empty set extracts everything.
+                extract_files = set()
+                break
+            extract_files.update(step.extract_files)
+
+        return self.source_task_cls(
+            requires_task=self.requires_task,
+            extract_files=sorted(extract_files),
+            cpu=max(step.source_task_cpu for step in [self, *sharing_steps]),
+            **self.source_task_kwargs,
+        )
+
+    def requires(self):
+        if self.in_place:
+            return self.requires_task
+
+        return self.source_task
+
+    @property
+    def hash_upstream(self):
+        # This layer's `extract_files` are in `config_keys`.
+        return self.requires_task
+
     def output(self):
         return luigi.LocalTarget(f'{self.outdir}/decompress/')
 
+    def link_archives(self, temp_path):
+        """Link the archives to read in place into `temp_path`."""
+        link_tree(self.input().path, temp_path)
 
-class UngzipMany(Decompress):
     def run(self):
-        gzip_paths = find_in_dir_by_pattern(self.input().path, pattern='*.gz')
         with temporary_path_dir(self.output()) as temp_path:
-            for gzip_path in gzip_paths:
-                with gzip.open(gzip_path, 'rb') as gf:
-                    decompress_filename = os.path.basename(gzip_path).replace('.gz', '')
-                    decompress_filepath = os.path.join(temp_path, decompress_filename)
-                    with open(decompress_filepath, 'wb') as f:
-                        f.write(gf.read())
+            if self.in_place:
+                self.link_archives(temp_path)
+                return
+
+            relpaths = None
+            if self.extract_files is not None:
+                relpaths = with_sidecars(
+                    self.extract_files, relpaths_in(self.input().path),
+                )
+            link_tree(self.input().path, temp_path, relpaths=relpaths)
+
+
+class UngzipMany(Decompress):
+    source_task_cls = UngzipSource
+
+    @functools.cached_property
+    def source_task(self):
+        return UngzipSource(requires_task=self.requires_task, cpu=self.source_task_cpu)
 
 
 class Unrar(Decompress):
-    def run(self):
-        rar_path = find_single_file_by_ext(self.input().path, ext='.rar')
-        rf = rarfile.RarFile(rar_path)
+    source_task_cls = UnrarSource
 
-        with temporary_path_dir(self.output()) as temp_path:
-            if 'extract_file' in self.decompress_kwargs:
-                rf.extract(self.decompress_kwargs['extract_file'],
-                           path=temp_path)
-            else:
-                rf.extractall(path=temp_path)
+    @property
+    def in_place(self):
+        if super().in_place:
+            raise RuntimeError(
+                f"{self.layer_cfg['id']}: GDAL can't read .rar archives in place."
+            )
 
-            rf.close()
+        return False
 
 
 class Unzip(Decompress):
+    """Link this layer's files from the data source's extracted .zip file."""
+
+    source_task_cls = UnzipSource
+
+    @property
+    def unzip_kwargs(self):
+        return self.layer_cfg.get('unzip_kwargs', {})
+
+    @property
+    def source_task_kwargs(self):
+        return {'input_filename': self.unzip_kwargs.get('input_filename')}
+
+    def link_archives(self, temp_path):
+        zf_path = _find_zip(self.input().path, self.unzip_kwargs.get('input_filename'))
+        link_or_copy(zf_path, os.path.join(temp_path, os.path.basename(zf_path)))
+
+
+def _copy_from_vsi(vsi_path, output_dir):
+    """Copy a file read through a GDAL virtual file system into `output_dir`."""
+    fp = os.path.join(output_dir, os.path.basename(vsi_path))
+    vsi_file = gdal.VSIFOpenL(vsi_path, 'rb')
+    if vsi_file is None:
+        raise RuntimeError(f'Could not open {vsi_path}')
+
+    try:
+        with open(fp, 'wb') as f:
+            for chunk in iter(
+                lambda: gdal.VSIFReadL(1, DECOMPRESS_BUFFER_SIZE, vsi_file), b'',
+            ):
+                f.write(chunk)
+    finally:
+        gdal.VSIFCloseL(vsi_file)
+
+    return fp
+
+
+def _translate_nc_datasets(input_fp, requests, *, output_dir):
+    """Extract the datasets of `requests` from `input_fp`, opening each once."""
+    requests_by_dataset = defaultdict(list)
+    for request in requests:
+        requests_by_dataset[request['extract_dataset']].append(request)
+
+    for dataset_name, dataset_requests in requests_by_dataset.items():
+        from_dataset_path = f'NETCDF:{input_fp}:{dataset_name}'
+        dataset = gdal.Open(from_dataset_path)
+
+        for request in dataset_requests:
+            output_fp = os.path.join(output_dir, request['output_filename'])
+            logger.debug(
+                f'Using gdal.Translate to convert from {from_dataset_path}'
+                f' to {output_fp}'
+            )
+
+            gdal.Translate(
+                output_fp,
+                dataset,
+                **request['translate_kwargs'],
+            )
+
+        # Close the dataset.
+        dataset = None
+
+
+class ExtractNcDatasets(SourceTask):
+    """Extract datasets from a data source's .nc files for every layer.
+
+    Each dataset is opened once, no matter how many layers extract from it.
+    """
+
+    # See `ExtractNcDataset.request`.
+    requests = luigi.ListParameter()
+
+    def _input_fp(self, input_relpath):
+        # The input is archives read in place for layers with
+        # `decompress_kwargs.in_place`; see `ExtractNcDataset.source_upstream`.
+        if not input_relpath:
+            return find_single_file_by_ext(
+                self.input().path, ext='.nc', search_archives=True,
+            )
+
+        input_fp = os.path.join(self.input().path, input_relpath)
+        if os.path.exists(input_fp):
+            return input_fp
+
+        return find_single_file_by_name(
+            self.input().path,
+            filename=os.path.basename(input_relpath),
+            search_archives=True,
+        )
+
     def run(self):
-        if unzip_filename := self.layer_cfg.get('unzip_kwargs', {}).get('input_filename'):
-            zf_path = find_single_file_by_name(self.input().path, filename=unzip_filename)
-        else:
-            zf_path = find_single_file_by_ext(self.input().path, ext='.zip')
-        zf = zipfile.ZipFile(zf_path)
+        requests_by_fp = defaultdict(list)
+        for request in self.requests:
+            requests_by_fp[self._input_fp(request['input_relpath'])].append(request)
 
-        with temporary_path_dir(self.output()) as temp_path:
-            if 'extract_files' in self.decompress_kwargs:
-                for extract_file in self.decompress_kwargs['extract_files']:
-                    zf.extract(extract_file, path=temp_path)
-            else:
-                # zf.extractall instead???
-                for fn in zf.namelist():
-                    zf.extract(fn, temp_path)
+        # Our GDAL's netCDF driver can't read through virtual file systems, so
+        # only the archive members used are copied out.
+        scratch_dir = os.path.dirname(self.outdir.rstrip('/'))
+        os.makedirs(scratch_dir, exist_ok=True)
+        with temporary_path_dir(self.output()) as temp_dir, \
+                tempfile.TemporaryDirectory(dir=scratch_dir) as members_dir:
+            for input_fp, requests in requests_by_fp.items():
+                if input_fp.startswith('/vsi'):
+                    input_fp = _copy_from_vsi(input_fp, members_dir)
 
-            zf.close()
+                _translate_nc_datasets(input_fp, requests, output_dir=temp_dir)
 
 
 # TODO: Delete and use generic GdalTranslate task?
 class ExtractNcDataset(LayerTask):
-    """Extracts dataset `dataset_name` from input .nc file."""
+    """Extracts dataset `dataset_name` from input .nc file.
+
+    Extraction is batched with other layers reading from the same data source
+    in `ExtractNcDatasets`.
+    """
 
     task_type = TaskType.WIP
+    config_keys = ('file_type', 'extract_nc_dataset_kwargs')
 
-    def output(self):
+    @property
+    def dataset_name(self):
+        return self.layer_cfg['extract_nc_dataset_kwargs']['extract_dataset']
+
+    @property
+    def output_filename(self):
         # GDAL translate will automatically determine file type from the extension.
-        return luigi.LocalTarget(
-            os.path.join(self.outdir, 'extract')
+        return f"{self.dataset_name}{self.layer_cfg['file_type']}"
+
+    @property
+    def source_upstream(self):
+        """The shared task providing the .nc file, or an archive containing it."""
+        if isinstance(self.requires_task, Decompress):
+            if self.requires_task.in_place:
+                return self.requires_task.requires_task
+            return self.requires_task.source_task
+
+        return self.requires_task
+
+    @property
+    def request(self):
+        """Describe this layer's extraction for `ExtractNcDatasets`."""
+        kwargs = copy.deepcopy(self.layer_cfg['extract_nc_dataset_kwargs'])
+        kwargs.pop('extract_dataset')
+
+        # `None` if the only .nc file in the input should be used.
+        input_relpath = None
+        if isinstance(self.requires_task, Decompress):
+            nc_files = [
+                fn for fn in (self.requires_task.extract_files or [])
+                if fn.endswith('.nc')
+            ]
+            if len(nc_files) == 1:
+                input_relpath = nc_files[0]
+
+        request = {
+            'input_relpath': input_relpath,
+            'extract_dataset': self.dataset_name,
+            'file_type': self.layer_cfg['file_type'],
+            'translate_kwargs': kwargs,
+        }
+        request['output_filename'] = (
+            f'{self.dataset_name}-{json_hash(request, length=8)}'
+            f"{self.layer_cfg['file_type']}"
         )
 
-    def run(self):
-        with temporary_path_dir(self.output()) as temp_dir:
-            kwargs = copy.deepcopy(self.layer_cfg['extract_nc_dataset_kwargs'])
-            input_fp = find_single_file_by_ext(self.input().path, ext='.nc')
+        return request
 
-            dataset_name = kwargs.pop('extract_dataset')
+    @functools.cached_property
+    def source_task(self):
+        source_upstream = self.source_upstream
+        requests = {
+            step.request['output_filename']: step.request
+            for step in [self, *_data_source_steps(self)]
+            if step.source_upstream == source_upstream
+        }
 
-            output_filename = f"{dataset_name}{self.layer_cfg['file_type']}"
-            output_fp = os.path.join(temp_dir, output_filename)
+        return ExtractNcDatasets(
+            requires_task=source_upstream,
+            requests=[requests[k] for k in sorted(requests)],
+        )
 
-            from_dataset_path = f'NETCDF:{input_fp}:{dataset_name}'
-            logger.debug(
-                f'Using gdal.Translate to convert from {from_dataset_path} to {output_fp}'
-            )
+    def requires(self):
+        return self.source_task
 
-            gdal.Translate(
-                output_fp,
-                from_dataset_path,
-                **kwargs,
+    @property
+    def hash_upstream(self):
+        # This layer's `request` is derived from `config_keys` and the upstream
+        # step.
+        return self.requires_task
+
+    def output(self):
+        return luigi.LocalTarget(
+            os.path.join(self.outdir, 'extract')
+        )
+
+    def run(self):
+        with temporary_path_dir(self.output()) as temp_dir:
+            link_or_copy(
+                os.path.join(self.input().path, self.request['output_filename']),
+                os.path.join(temp_dir, self.output_filename),
             )
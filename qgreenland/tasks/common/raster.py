@@ -1,24 +1,69 @@
 import logging
 import os
-import shutil
 
 import luigi
-import rasterio as rio
 from osgeo import gdal
 
 from qgreenland.constants import TaskType
-from qgreenland.util.luigi import LayerTask
-from qgreenland.util.misc import find_single_file_by_ext, temporary_path_dir
-from qgreenland.util.raster import (gdal_calc_raster,
+from qgreenland.util.luigi import (LayerTask,
+                                   MEMORY_BOUND_RESOURCES,
+                                   task_threads)
+from qgreenland.util.misc import (find_single_file_by_ext,
+                                  link_or_copy,
+                                  temporary_path_dir)
+from qgreenland.util.raster import (OVERVIEW_RESAMPLING_METHODS,
+                                    gdal_calc_raster,
+                                    gdal_calc_vrt,
                                     gdal_edit_raster,
                                     gdal_mdim_translate_raster,
-                                    warp_raster)
+                                    to_vrt,
+                                    warp_performance_kwargs,
+                                    warp_raster,
+                                    write_cog)
 
 logger = logging.getLogger('luigi-interface')
 
 
+def _lazy(task):
+    """Whether `task` writes a VRT instead of a raster.
+
+    With `lazy_raster`, `WarpRaster`, `GdalCalcRaster` and `GdalEdit` only
+    describe their output as a VRT, which can be inspected like any raster.
+    `BuildRasterOverviews`, which must be the last step, computes the result.
+    """
+    return task.layer_cfg.get('lazy_raster', False)
+
+
+def _output_path(task, output_dir):
+    if _lazy(task):
+        stem = os.path.splitext(task.filename)[0]
+        return os.path.abspath(os.path.join(output_dir, f'{stem}.vrt'))
+
+    return os.path.join(output_dir, task.filename)
+
+
+def _input_path(task, *, ext):
+    """Return the upstream step's VRT, if lazy, or its one file with `ext`."""
+    if _lazy(task):
+        vrt_path = _output_path(task, task.input().path)
+        if os.path.isfile(vrt_path):
+            return vrt_path
+
+    return find_single_file_by_ext(
+        task.input().path, ext=ext, search_archives=task.reads_archives,
+    )
+
+
 class BuildRasterOverviews(LayerTask):
+    """Write the final raster as a Cloud-Optimized GeoTIFF, with overviews.
+
+    See `write_cog`. The overview levels are chosen by the raster's size unless
+    configured with `overviews_kwargs`.
+    """
+
     task_type = TaskType.WIP
+    config_keys = ('file_type', 'overviews_kwargs', 'lazy_raster')
+    resources = MEMORY_BOUND_RESOURCES
 
     def output(self):
         return luigi.LocalTarget(os.path.join(self.outdir, 'overviews'))
@@ -27,11 +72,10 @@ class BuildRasterOverviews(LayerTask):
         # TODO: Extract this to LayerTask as a property?
         # TODO: Find in dir by self.filename instead? Wouldn't work if the
         #       upstream task was e.g. unzip
-        ifile = find_single_file_by_ext(self.input().path,
-                                        ext=self.layer_cfg['file_type'])
+        ifile = _input_path(self, ext=self.layer_cfg['file_type'])
 
         overviews_kwargs = {
-            'overview_levels': tuple(),  # noqa: C408
+            'overview_levels': None,
             'resampling_method': 'average'
         }
 
@@ -39,33 +83,28 @@ class BuildRasterOverviews(LayerTask):
             self.layer_cfg.get('overviews_kwargs', {})
         )
 
-        overview_levels = overviews_kwargs['overview_levels']
-        resampling_str = overviews_kwargs['resampling_method']
-
-        try:
-            resampling_method = rio.enums.Resampling[resampling_str]
-        except KeyError:
+        # Accept rasterio's names, e.g. `cubic_spline`, too.
+        resampling_str = overviews_kwargs['resampling_method'].replace('_', '')
+        if resampling_str not in OVERVIEW_RESAMPLING_METHODS:
             raise RuntimeError(
                 f"'{resampling_str}' is not a valid resampling method."
             )
 
         with temporary_path_dir(self.output()) as tmp_dir:
-            tmp_path = os.path.join(tmp_dir, self.filename)
-            # Copy the existing file into place. Currently, this task creates
-            # 'internal overviews', which changes the file itself.
-            shutil.copy2(ifile, tmp_path)
-
-            # HACK:
-            # Only build overviews if overview_levels is populated with values.
-            # This allows pipelines to have an overview step that can be
-            # disabled in config.
-            if overview_levels:
-                with rio.open(tmp_path, 'r+') as ds:
-                    ds.build_overviews(overview_levels, resampling_method)
+            write_cog(
+                ifile, os.path.join(tmp_dir, self.filename),
+                overview_levels=overviews_kwargs['overview_levels'],
+                resampling=resampling_str,
+            )
 
 
 class WarpRaster(LayerTask):
     task_type = TaskType.WIP
+    config_keys = (
+        'file_type', 'override_source_projection', 'warp_kwargs', 'boundary',
+        'lazy_raster',
+    )
+    resources = MEMORY_BOUND_RESOURCES
     input_ext_override = luigi.Parameter(default=None)
 
     def output(self):
@@ -84,14 +123,25 @@ class WarpRaster(LayerTask):
             'cropToCutline': True,
             'creationOptions': ['COMPRESS=DEFLATE']
         }
-        if 'warp_kwargs' in self.layer_cfg:
-            warp_kwargs.update(self.layer_cfg['warp_kwargs'])
+        layer_warp_kwargs = dict(self.layer_cfg.get('warp_kwargs', {}))
 
         file_ext = self.input_ext_override or self.layer_cfg['file_type']
-        inp_path = find_single_file_by_ext(self.input().path, ext=file_ext)
+        inp_path = _input_path(self, ext=file_ext)
+
+        # Threads and memory by the input's size; the layer's `warp_kwargs`
+        # override them.
+        performance_kwargs = warp_performance_kwargs(
+            inp_path,
+            memory_gb=self.process_resources()['memory'],
+            cpus=task_threads(self),
+            profile=layer_warp_kwargs.pop('performance_profile', None),
+        )
+        warp_kwargs['creationOptions'] += performance_kwargs.pop('creationOptions', [])
+        warp_kwargs.update(performance_kwargs)
+        warp_kwargs.update(layer_warp_kwargs)
 
         with temporary_path_dir(self.output()) as tmp_dir:
-            out_path = os.path.join(tmp_dir, self.filename)
+            out_path = _output_path(self, tmp_dir)
             warp_raster(inp_path, out_path,
                         layer_cfg=self.layer_cfg,
                         warp_kwargs=warp_kwargs)
@@ -100,20 +150,26 @@ class WarpRaster(LayerTask):
 class GdalCalcRaster(LayerTask):
 
     task_type = TaskType.WIP
+    config_keys = ('file_type', 'gdal_calc_kwargs', 'lazy_raster')
+    resources = MEMORY_BOUND_RESOURCES
 
     def output(self):
         return luigi.LocalTarget(os.path.join(self.outdir, 'calc'))
 
     def run(self):
         with temporary_path_dir(self.output()) as tmp_dir:
-            out_path = os.path.join(tmp_dir, self.filename)
-            inp_path = find_single_file_by_ext(self.input().path,
-                                               ext=self.layer_cfg['file_type'])
+            out_path = _output_path(self, tmp_dir)
+            inp_path = _input_path(self, ext=self.layer_cfg['file_type'])
             gdal_calc_kwargs = self.layer_cfg['gdal_calc_kwargs']
+            if _lazy(self):
+                gdal_calc_vrt(inp_path, out_path, gdal_calc_kwargs=gdal_calc_kwargs)
+                return
+
             gdal_calc_raster(
                 inp_path, out_path,
                 layer_cfg=self.layer_cfg,
-                gdal_calc_kwargs=gdal_calc_kwargs
+                gdal_calc_kwargs=gdal_calc_kwargs,
+                workers=task_threads(self),
             )
 
 
@@ -121,6 +177,7 @@ class GdalTranslateRaster(LayerTask):
     """Perform an arbitrary GDAL translate."""
 
     task_type = TaskType.WIP
+    config_keys = ('file_type', 'translate_kwargs')
 
     def output(self):
         # GDAL translate will automatically determine file type from the extension.
@@ -132,7 +189,9 @@ class GdalTranslateRaster(LayerTask):
         with temporary_path_dir(self.output()) as temp_dir:
             # TODO: inp_ext_override like WarpRaster?
             file_ext = self.layer_cfg['file_type']
-            inp_path = find_single_file_by_ext(self.input().path, ext=file_ext)
+            inp_path = find_single_file_by_ext(
+                self.input().path, ext=file_ext, search_archives=self.reads_archives,
+            )
             out_path = os.path.join(temp_dir, self.filename)
 
             logger.debug(
@@ -149,6 +208,7 @@ class GdalTranslateRaster(LayerTask):
 class GdalMDimTranslate(LayerTask):
 
     task_type = TaskType.WIP
+    config_keys = ('file_type', 'gdal_mdim_translate_kwargs')
     input_ext_override = luigi.Parameter(default=None)
 
     def output(self):
@@ -159,7 +219,9 @@ class GdalMDimTranslate(LayerTask):
             out_path = os.path.join(tmp_dir, self.filename)
 
             file_ext = self.input_ext_override or self.layer_cfg['file_type']
-            inp_path = find_single_file_by_ext(self.input().path, ext=file_ext)
+            inp_path = find_single_file_by_ext(
+                self.input().path, ext=file_ext, search_archives=self.reads_archives,
+            )
 
             gdal_mdim_translate_kwargs = self.layer_cfg['gdal_mdim_translate_kwargs']
             gdal_mdim_translate_raster(
@@ -172,16 +234,22 @@ class GdalMDimTranslate(LayerTask):
 class GdalEdit(LayerTask):
 
     task_type = TaskType.WIP
+    config_keys = ('file_type', 'gdal_edit_kwargs', 'lazy_raster')
 
     def output(self):
         return luigi.LocalTarget(os.path.join(self.outdir, 'gdal_edit'))
 
     def run(self):
         with temporary_path_dir(self.output()) as tmp_dir:
-            out_path = os.path.join(tmp_dir, self.filename)
-            inp_path = find_single_file_by_ext(self.input().path,
-                                               ext=self.layer_cfg['file_type'])
-            shutil.copy(inp_path, out_path)
+            out_path = _output_path(self, tmp_dir)
+            inp_path = _input_path(self, ext=self.layer_cfg['file_type'])
+            # `gdal_edit_raster` edits the file in place.
+            if _lazy(self):
+                # A VRT's sources may be relative to it, so wrap it instead of
+                # copying it.
+                to_vrt(inp_path, out_path)
+            else:
+                link_or_copy(inp_path, out_path, mutable=True)
 
             gdal_edit_kwargs = self.layer_cfg['gdal_edit_kwargs']
             gdal_edit_raster(
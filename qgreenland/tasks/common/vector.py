@@ -24,6 +24,7 @@ class DelimitedTextPointsVector(LayerTask):
     """
 
     task_type = TaskType.WIP
+    config_keys = ('file_type', 'delimited_text_vector_kwargs')
 
     def output(self):
         return luigi.LocalTarget(f'{self.outdir}/transform_delimited/')
@@ -61,6 +62,7 @@ class Ogr2OgrVector(LayerTask):
     """Acts on vector data that can be read by `ogr2ogr`."""
 
     task_type = TaskType.WIP
+    config_keys = ('file_type', 'ogr2ogr_kwargs', 'boundary')
 
     def output(self):
         return luigi.LocalTarget(f'{self.outdir}/transform/')
@@ -82,7 +84,8 @@ class Ogr2OgrVector(LayerTask):
         if 'input_filename' in ogr2ogr_kwargs:
             input_filename = find_single_file_by_name(
                 self.input().path,
-                filename=ogr2ogr_kwargs.pop('input_filename')
+                filename=ogr2ogr_kwargs.pop('input_filename'),
+                search_archives=self.reads_archives,
             )
         else:
             # TODO: we assume input data comes in .shp format unless we override
@@ -90,7 +93,8 @@ class Ogr2OgrVector(LayerTask):
             # extensions we look for, starting with self.layer_cfg['file_type']?
             datafile = find_single_file_by_ext(
                 self.input().path,
-                ext='shp'
+                ext='shp',
+                search_archives=self.reads_archives,
             )
             input_filename = datafile
 
@@ -12,7 +12,7 @@ from qgreenland.tasks.common.raster import (
     GdalEdit,
     WarpRaster,
 )
-from qgreenland.util.luigi import LayerPipeline, LayerTask
+from qgreenland.util.luigi import LayerPipeline, LayerTask, MEMORY_BOUND_RESOURCES
 from qgreenland.util.misc import (datasource_dirname,
                                   find_single_file_by_ext,
                                   temporary_path_dir)
@@ -53,6 +53,8 @@ class RacmoRaster(LayerPipeline):
 class ApplyPromiceMask(LayerTask):
 
     task_type = TaskType.WIP
+    # Reads the full source and mask grids in to memory.
+    resources = MEMORY_BOUND_RESOURCES
     mask_fp = luigi.Parameter(default=None)
 
     def output(self):
@@ -1,5 +1,4 @@
 import os
-import subprocess
 
 import luigi
 
@@ -7,8 +6,11 @@ from qgreenland.constants import TaskType
 from qgreenland.tasks.common.fetch import FetchDataFiles
 from qgreenland.tasks.common.raster import (BuildRasterOverviews,
                                             WarpRaster)
+from qgreenland.util.calc import gdal_calc
 from qgreenland.util.luigi import LayerPipeline
-from qgreenland.util.luigi import LayerTask
+from qgreenland.util.luigi import (LayerTask,
+                                   MEMORY_BOUND_RESOURCES,
+                                   task_threads)
 from qgreenland.util.misc import find_single_file_by_ext, temporary_path_dir
 
 
@@ -25,6 +27,8 @@ class GdalCalcMaskedVelocity(LayerTask):
     """
 
     task_type = TaskType.WIP
+    config_keys = ('file_type', 'extract_nc_dataset_kwargs')
+    resources = MEMORY_BOUND_RESOURCES
 
     def output(self):
         return luigi.LocalTarget(os.path.join(self.outdir, 'calc'))
@@ -44,17 +48,15 @@ class GdalCalcMaskedVelocity(LayerTask):
                     ' Needs `extract_nc_dataset_kwargs:extract_dataset`'
                 )
 
-            cmd = (
-                f'gdal_calc.py -A NETCDF:{inp_path}:{variable} -B NETCDF:{inp_path}:ice'
-                f'  --calc="A*B" --outfile={out_path}'
+            gdal_calc(
+                {
+                    'A': f'NETCDF:{inp_path}:{variable}',
+                    'B': f'NETCDF:{inp_path}:ice',
+                },
+                out_path,
+                calc='A*B',
+                workers=task_threads(self),
             )
-            result = subprocess.run(cmd,
-                                    shell=True,
-                                    executable='/bin/bash',
-                                    capture_output=True)
-
-            if result.returncode != 0:
-                raise RuntimeError(result.stderr)
 
 
 class VelocityMosaic(LayerPipeline):
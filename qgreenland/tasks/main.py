@@ -15,20 +15,28 @@ from qgreenland.constants import (ASSETS_DIR,
                                   TaskType,
                                   WIP_DIR,
                                   ZIP_TRIGGERFILE)
+from qgreenland.exceptions import QgrRuntimeError
 from qgreenland.util.cleanup import cleanup_intermediate_dirs
+from qgreenland.util.cmr import prefetch_cmr_granules
 from qgreenland.util.config import export_config
+from qgreenland.util.misc import get_layer_dir
+from qgreenland.util.profiling import register_event_handlers, write_build_report
 from qgreenland.util.qgis import make_qgis_project_file
 from qgreenland.util.task import generate_layer_tasks
 from qgreenland.util.version import get_build_version
 
 logger = logging.getLogger('luigi-interface')
 
+register_event_handlers()
+
 
 class IngestAllLayers(luigi.WrapperTask):
     def requires(self):
         """All layers (not sources) that will be added to the project."""
         # To disable layer(s), edit layers.yml
         tasks = generate_layer_tasks()
+        # Look up CMR granules in bulk, before any fetch tasks need them.
+        prefetch_cmr_granules(CONFIG['datasets'])
 
         for task in tasks:
             yield task
@@ -97,11 +105,26 @@ class CreateQgisProjectFile(luigi.Task):
             dest_relative_filepath='CHANGELOG.txt'
         )
         yield LayerList()
+        # Explicitly depend on all layers, even though `LayerList` already
+        # does, so that the project file is never built from a partial package.
+        yield IngestAllLayers()
 
     def output(self):
         return luigi.LocalTarget(ZIP_TRIGGERFILE)
 
     def run(self):
+        # Layer outputs are committed atomically, so a missing layer here
+        # means an upstream task did not run, not that it is still running.
+        missing_layers = [
+            cfg['id'] for cfg in CONFIG['layers'].values()
+            if cfg['dataset']['access_method'] != 'gdal_remote'
+            and not os.path.isdir(get_layer_dir(cfg))
+        ]
+        if missing_layers:
+            raise QgrRuntimeError(
+                f'Refusing to create project file; missing layers: {missing_layers}'
+            )
+
         # make_qgs outputs multiple files, not just one .qgs file. Similar to
         # writing shapefiles, except this time we want to put them inside a
         # pre-existing directory.
@@ -146,6 +169,11 @@ class ZipQGreenland(luigi.Task):
         if ENVIRONMENT != 'dev':
             cleanup_intermediate_dirs()
 
+        write_build_report(
+            self,
+            output_basepath=f'{RELEASE_DIR}/{PROJECT}_{get_build_version()}_build_report',
+        )
+
         # Mathias Nordvig advised the following Greenlandic words:
         """
         For "hooray," the direct Greenlandic translation is simply "horaa!" If
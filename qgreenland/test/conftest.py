@@ -0,0 +1,50 @@
+import http.server
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from qgreenland.util import governor
+
+
+@pytest.fixture(autouse=True)
+def governor_dir(tmp_path_factory):
+    """Keep each test's connection slots and bandwidth budgets to itself.
+
+    Outside `tmp_path`, which tests may expect to contain only their outputs.
+    """
+    governor_dir = str(tmp_path_factory.mktemp('governor'))
+    with patch.object(governor, 'HOST_GOVERNOR_DIR', governor_dir):
+        yield
+
+
+@pytest.fixture
+def serve():
+    """Return a function serving a request handler class on localhost.
+
+    It calls the handler's `reset` class method, if any, to reset state kept
+    on the class by earlier tests, and returns the server's base URL. Requests
+    aren't logged, and connections are kept alive. Servers are shut down and
+    closed after the test.
+    """
+    servers = []
+
+    def _serve(handler_cls):
+        if hasattr(handler_cls, 'reset'):
+            handler_cls.reset()
+
+        quiet_handler_cls = type(handler_cls.__name__, (handler_cls,), {
+            'protocol_version': 'HTTP/1.1',
+            'log_message': lambda self, *args: None,
+        })
+        httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), quiet_handler_cls)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+
+        return f'http://127.0.0.1:{httpd.server_port}'
+
+    yield _serve
+
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
@@ -0,0 +1,60 @@
+from unittest.mock import patch
+
+import numpy as np
+from osgeo import gdal
+
+from qgreenland.util import calc
+
+
+def _raster(fp, data, *, gdal_type, nodata=None):
+    rows, cols = data.shape
+    ds = gdal.GetDriverByName('GTiff').Create(
+        fp, cols, rows, 1, gdal_type, options=['BLOCKYSIZE=4'],
+    )
+    ds.SetGeoTransform((0, 1, 0, 0, 0, -1))
+    band = ds.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    band.WriteArray(data)
+    ds = None
+
+    return fp
+
+
+def test_gdal_calc_multiple_inputs(tmp_path):
+    data = np.arange(64 * 40, dtype=np.int16).reshape(40, 64) % 7
+    mask = (np.arange(64 * 40).reshape(40, 64) % 3 != 0).astype(np.uint8)
+    a_fp = _raster(str(tmp_path / 'a.tif'), data, gdal_type=gdal.GDT_Int16, nodata=6)
+    b_fp = _raster(str(tmp_path / 'b.tif'), mask, gdal_type=gdal.GDT_Byte)
+    out_fp = str(tmp_path / 'out.tif')
+
+    # Several windows, computed on several threads.
+    with patch.object(calc, 'CALC_WINDOW_PIXELS', 64 * 3):
+        calc.gdal_calc({'A': a_fp, 'B': b_fp}, out_fp, calc='A * B', workers=4)
+
+    band = gdal.Open(out_fp).GetRasterBand(1)
+    # The largest input type, and its default nodata.
+    assert gdal.GetDataTypeName(band.DataType) == 'Int16'
+    assert band.GetNoDataValue() == -32767
+    expected = np.where(data == 6, -32767, data * mask)
+    assert (band.ReadAsArray() == expected).all()
+
+
+def test_gdal_calc_numpy_functions(tmp_path):
+    data = np.array([[-1.5, 2.5], [0.5, -9999]], dtype=np.float32)
+    a_fp = _raster(
+        str(tmp_path / 'a.tif'), data, gdal_type=gdal.GDT_Float32, nodata=-9999,
+    )
+    out_fp = str(tmp_path / 'out.tif')
+
+    calc.gdal_calc(
+        {'A': a_fp}, out_fp,
+        calc='where(A > 0, A * 2, 0)',
+        out_type='Int32',
+        nodata_value=-1,
+        creation_options=['COMPRESS=DEFLATE'],
+    )
+
+    band = gdal.Open(out_fp).GetRasterBand(1)
+    assert gdal.GetDataTypeName(band.DataType) == 'Int32'
+    assert band.ReadAsArray().tolist() == [[0, 5], [1, -1]]
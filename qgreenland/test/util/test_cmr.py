@@ -0,0 +1,99 @@
+import datetime
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from qgreenland.util import cmr
+
+COLLECTION = 'C1-TEST'
+
+
+def _umm_item(granule_ur, revision_id=1):
+    return {
+        'meta': {'revision-id': revision_id},
+        'umm': {
+            'GranuleUR': granule_ur,
+            'RelatedUrls': [
+                {'URL': f'https://example.com/{granule_ur}.nc', 'Type': 'GET DATA'},
+                {
+                    'URL': f'https://example.com/{granule_ur}.png',
+                    'Type': 'GET RELATED VISUALIZATION',
+                },
+            ],
+            'TemporalExtent': {
+                'RangeDateTime': {'BeginningDateTime': '2020-01-01T00:00:00.000Z'},
+            },
+        },
+    }
+
+
+def _response(granule_urs):
+    response = MagicMock(ok=True)
+    response.json.return_value = {'items': [_umm_item(ur) for ur in granule_urs]}
+    return response
+
+
+@pytest.fixture
+def mock_get(tmp_path):
+    def _get(_url, *, params, **_kwargs):
+        return _response([v for k, v in params if k == 'granule_ur[]'])
+
+    with patch.object(cmr, 'CMR_CACHE_DIR', str(tmp_path)), \
+            patch.object(cmr.requests, 'get', side_effect=_get) as mock:
+        yield mock
+
+
+def test_get_cmr_granules_batched_and_cached(mock_get):
+    granules = cmr.get_cmr_granules(
+        collection_concept_id=COLLECTION, granule_urs=['a', 'b', 'c'],
+    )
+
+    assert mock_get.call_count == 1
+    assert granules['a'] == cmr.Granule(
+        urls=('https://example.com/a.nc',),
+        start_time=datetime.datetime(2020, 1, 1),
+        revision_id=1,
+        granule_ur='a',
+    )
+
+    assert cmr.get_cmr_granule(
+        granule_ur='b', collection_concept_id=COLLECTION,
+    ) == granules['b']
+    assert mock_get.call_count == 1
+
+
+def test_get_cmr_granules_offline(mock_get):
+    cmr.get_cmr_granule(granule_ur='a', collection_concept_id=COLLECTION)
+
+    mock_get.side_effect = requests.exceptions.ConnectionError()
+    # Expired entries are used when CMR can't be reached...
+    granule = cmr.get_cmr_granule(
+        granule_ur='a', collection_concept_id=COLLECTION, max_age_s=0,
+    )
+    assert granule.urls == ('https://example.com/a.nc',)
+
+    # ...but granules never looked up can't be.
+    with pytest.raises(requests.exceptions.ConnectionError):
+        cmr.get_cmr_granule(granule_ur='b', collection_concept_id=COLLECTION)
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_search_cmr_granules_pages(prefetch):
+    granule_urs = ['a', 'b', 'c', 'd', 'e']
+    page_size = 2
+
+    def _get(_url, *, headers, **_kwargs):
+        start = int(headers.get('CMR-Search-After', 0))
+        response = _response(granule_urs[start:start + page_size])
+        response.headers = {'CMR-Search-After': str(start + page_size)}
+        return response
+
+    with patch.object(cmr.requests, 'get', side_effect=_get) as mock_get:
+        granules = cmr.search_cmr_granules(
+            short_name='TEST', version='1', page_size=page_size, prefetch=prefetch,
+        )
+
+        assert next(granules).granule_ur == 'a'
+        assert [g.granule_ur for g in granules] == granule_urs[1:]
+        assert mock_get.call_count == 3
@@ -0,0 +1,80 @@
+import http.server
+import os
+import threading
+import time
+from typing import Set
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from qgreenland.util import concurrent_fetch
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+    # Paths to respond to with a 503 once.
+    flaky: Set[str] = set()
+
+    @classmethod
+    def reset(cls):
+        cls.active = 0
+        cls.max_active = 0
+        cls.flaky = set()
+
+    def do_GET(self):  # noqa: N802
+        with self.lock:
+            fail = self.path in _Handler.flaky
+            _Handler.flaky.discard(self.path)
+            _Handler.active += 1
+            _Handler.max_active = max(_Handler.max_active, _Handler.active)
+
+        time.sleep(0.05)
+        body = b'' if fail else self.path.encode('utf-8')
+        self.send_response(503 if fail else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        with self.lock:
+            _Handler.active -= 1
+
+
+@pytest.fixture
+def server(serve):
+    with patch.object(concurrent_fetch, 'FETCH_BACKOFF_S', 0):
+        yield serve(_Handler)
+
+
+def test_fetch_all(server, tmp_path):
+    urls = [f'{server}/{i}.txt' for i in range(8)]
+    _Handler.flaky = {'/3.txt'}
+
+    fps = concurrent_fetch.fetch_all(
+        urls,
+        output_dir=str(tmp_path),
+        files_per_host=2,
+        session=requests.Session(),
+    )
+
+    assert [os.path.basename(fp) for fp in fps] == [f'{i}.txt' for i in range(8)]
+    with open(fps[3]) as f:
+        assert f.read() == '/3.txt'
+    assert _Handler.max_active == 2
+
+
+def test_fetch_all_fails(server, tmp_path):
+    with patch.object(concurrent_fetch, 'FETCH_RETRIES', 0):
+        _Handler.flaky = {'/1.txt'}
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            concurrent_fetch.fetch_all(
+                [f'{server}/0.txt', f'{server}/1.txt'],
+                output_dir=str(tmp_path),
+                session=requests.Session(),
+            )
+
+    # Other downloads still completed.
+    assert os.listdir(tmp_path) == ['0.txt']
@@ -0,0 +1,153 @@
+import http.server
+import os
+import re
+import threading
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from qgreenland.util import download
+from qgreenland.util.misc import fetch_and_write_file, remote_file_changed
+
+CONTENT = os.urandom(3 * 1024 * 1024 + 123)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    supports_ranges = True
+    # Number of responses to cut short, to simulate dropped connections.
+    failures = 0
+    range_bytes_sent = 0
+    lock = threading.Lock()
+
+    @classmethod
+    def reset(cls):
+        cls.supports_ranges = True
+        cls.failures = 0
+        cls.range_bytes_sent = 0
+
+    def do_GET(self):  # noqa: N802
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        range_header = self.headers.get('Range')
+        if range_header and self.supports_ranges:
+            start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', range_header).groups())
+            self.send_response(206)
+        else:
+            start, end = 0, len(CONTENT) - 1
+            self.send_response(200)
+
+        body = CONTENT[start:end + 1]
+        if self.supports_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        with self.lock:
+            fail = range_header is not None and _Handler.failures > 0
+            if fail:
+                _Handler.failures -= 1
+        if fail:
+            body = body[:len(body) // 2]
+            self.close_connection = True
+
+        self.wfile.write(body)
+        if range_header:
+            with self.lock:
+                _Handler.range_bytes_sent += len(body)
+
+
+@pytest.fixture
+def server(serve, tmp_path):
+    base_url = serve(_Handler)
+    staging_dir = str(tmp_path / 'staging')
+    with patch.object(download, 'DOWNLOAD_STAGING_DIR', staging_dir), \
+            patch.object(download, 'SEGMENT_MIN_BYTES', 512 * 1024), \
+            patch.object(download, 'PROGRESS_INTERVAL_BYTES', 64 * 1024):
+        yield f'{base_url}/data.bin'
+
+
+def _fetch(url, output_dir, **kwargs):
+    os.makedirs(output_dir, exist_ok=True)
+    return fetch_and_write_file(
+        url, output_dir=output_dir, session=requests.Session(), **kwargs,
+    )
+
+
+def test_fetch_ranges(server, tmp_path):
+    fp = _fetch(server, str(tmp_path / 'out'))
+
+    with open(fp, 'rb') as f:
+        assert f.read() == CONTENT
+    assert os.listdir(download.DOWNLOAD_STAGING_DIR) == []
+
+
+def test_fetch_ranges_resumes(server, tmp_path):
+    _Handler.failures = 2
+
+    with pytest.raises(requests.exceptions.RequestException):
+        _fetch(server, str(tmp_path / 'out'))
+    assert len(os.listdir(download.DOWNLOAD_STAGING_DIR)) == 1
+
+    fp = _fetch(server, str(tmp_path / 'out'))
+
+    with open(fp, 'rb') as f:
+        assert f.read() == CONTENT
+    # Only the failed segments' remaining bytes were downloaded again.
+    assert _Handler.range_bytes_sent < 1.5 * len(CONTENT)
+
+
+def test_fetch_without_ranges(server, tmp_path):
+    _Handler.supports_ranges = False
+
+    fp = _fetch(server, str(tmp_path / 'out'))
+
+    with open(fp, 'rb') as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(download.DOWNLOAD_STAGING_DIR)
+
+
+def test_fetch_empty(server, tmp_path):
+    with patch(f'{__name__}.CONTENT', b''):
+        fp = _fetch(server, str(tmp_path / 'out'))
+
+    assert os.path.getsize(fp) == 0
+
+
+def test_fetch_records_manifest(server, tmp_path):
+    files = {}
+    _fetch(server, str(tmp_path / 'out'), manifest=files)
+
+    entry = files['data.bin']
+    assert entry['etag'] == '"v1"'
+    assert entry['content_length'] == len(CONTENT)
+
+    session = requests.Session()
+    assert not remote_file_changed(server, entry, session=session)
+    assert remote_file_changed(server, {**entry, 'etag': '"v0"'}, session=session)
+    # Without validators, the size is compared.
+    no_validators = {**entry, 'etag': None}
+    assert not remote_file_changed(server, no_validators, session=session)
+    assert remote_file_changed(
+        server, {**no_validators, 'content_length': 1}, session=session,
+    )
+
+
+def test_segments():
+    size = 10 * download.SEGMENT_MIN_BYTES + 1
+
+    segments = download._segments(size, 3)
+
+    assert len(segments) == 3
+    assert segments[0][0] == 0
+    assert segments[-1][1] == size - 1
+    for (_, end), (start, _) in zip(segments, segments[1:]):
+        assert start == end + 1
+
+    # Small files aren't split.
+    assert download._segments(10, 3) == [(0, 9)]
+    assert download._segments(0, 3) == []
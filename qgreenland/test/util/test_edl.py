@@ -0,0 +1,53 @@
+import time
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from qgreenland.util import edl
+
+
+def _skip_auth(session, **_kwargs):
+    return session
+
+
+@pytest.fixture
+def mock_auth(tmp_path):
+    jar_fp = str(tmp_path / 'cookies.txt')
+    auth_patch = patch.object(
+        edl, 'create_earthdata_authenticated_session', side_effect=_skip_auth,
+    )
+    with patch.object(edl, 'EDL_COOKIE_JAR', jar_fp), \
+            patch.dict(edl._sessions, clear=True), \
+            auth_patch as mock:
+        yield mock
+
+
+def test_get_session_pooled_by_host(mock_auth):
+    session = edl.get_session('https://n5eil01u.ecs.nsidc.org/a.nc')
+
+    assert edl.get_session('https://n5eil01u.ecs.nsidc.org/b.nc') is session
+    assert edl.get_session('https://example.com/c.nc') is not session
+    assert mock_auth.call_count == 2
+
+
+def test_get_session_expires(mock_auth):
+    session = edl.get_session('https://example.com/a.nc')
+
+    with patch.object(edl, 'EDL_SESSION_MAX_AGE_S', 0):
+        assert edl.get_session('https://example.com/a.nc') is not session
+
+
+def test_cookies_persisted(mock_auth):
+    session = requests.Session()
+    session.cookies.set('fresh', 'yes', domain='example.com')
+    session.cookies.set(
+        'stale', 'yes', domain='example.com', expires=int(time.time()) - 1,
+    )
+    edl._save_cookies(session)
+
+    new_session = requests.Session()
+    edl._load_cookies(new_session)
+
+    assert new_session.cookies.get('fresh') == 'yes'
+    assert new_session.cookies.get('stale') is None
@@ -0,0 +1,128 @@
+import http.server
+import json
+import re
+import urllib.parse
+from typing import Dict, List
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from qgreenland.util import feature_server
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Object ID -> edit date, in ms.
+    features: Dict[int, int] = {}
+    last_edit_date = 0
+    page_requests: List[List[int]] = []
+
+    @classmethod
+    def reset(cls):
+        cls.features = dict.fromkeys(range(1, 6), 1000)
+        cls.last_edit_date = 1000
+        cls.page_requests = []
+
+    def _respond(self, result):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _query(self, params):
+        if 'objectIds' in params:
+            ids = [int(i) for i in params['objectIds'].split(',')]
+            _Handler.page_requests.append(ids)
+            return {'features': [
+                {'attributes': {'fid': i, 'edited': self.features[i]}} for i in ids
+            ]}
+
+        edited_after = re.search(r"EditDate > TIMESTAMP '(.*)'", params['where'])
+        ids = [
+            i for i, edited in self.features.items()
+            if not edited_after
+            or feature_server._timestamp(edited) > edited_after.group(1)
+        ]
+        return {'objectIds': ids}
+
+    def do_POST(self):  # noqa: N802
+        length = int(self.headers['Content-Length'])
+        params = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode('utf-8')))
+
+        if self.path.endswith('/query'):
+            self._respond(self._query(params))
+        else:
+            self._respond({
+                'maxRecordCount': 2,
+                'editingInfo': {'lastEditDate': self.last_edit_date},
+                'editFieldsInfo': {'editDateField': 'EditDate'},
+            })
+
+
+def _edit(fid, edit_date):
+    _Handler.features[fid] = edit_date
+    _Handler.last_edit_date = edit_date
+
+
+@pytest.fixture
+def query_url(serve, tmp_path):
+    base_url = serve(_Handler)
+    pages_patch = patch.object(
+        feature_server, 'FEATURE_SERVER_PAGES_DIR', str(tmp_path / 'pages'),
+    )
+    with pages_patch:
+        yield (
+            f'{base_url}/arcgis/rest/services/Test'
+            '/FeatureServer/0/query?where=1=1&outFields=*'
+        )
+
+
+def _fetch(query_url):
+    page_fps = feature_server.fetch_pages(query_url, session=requests.Session())
+    features = []
+    for fp in page_fps:
+        with open(fp) as f:
+            features.extend(json.load(f)['features'])
+
+    return [feature['attributes'] for feature in features]
+
+
+def test_fetch_pages(query_url):
+    features = _fetch(query_url)
+
+    assert [f['fid'] for f in features] == [1, 2, 3, 4, 5]
+    # Pages are no bigger than the server allows.
+    assert sorted(_Handler.page_requests) == [[1, 2], [3, 4], [5]]
+
+
+def test_fetch_pages_unchanged(query_url):
+    _fetch(query_url)
+    _Handler.page_requests = []
+
+    _fetch(query_url)
+
+    assert _Handler.page_requests == []
+
+
+def test_fetch_pages_changed(query_url):
+    _fetch(query_url)
+    _Handler.page_requests = []
+
+    _edit(3, 5000)
+    _edit(6, 5000)
+    features = _fetch(query_url)
+
+    # The page with the edited feature, and the new page.
+    assert sorted(_Handler.page_requests) == [[3, 4], [5, 6]]
+    assert {f['fid']: f['edited'] for f in features}[3] == 5000
+
+
+def test_fetch_pages_no_edit_tracking(query_url):
+    _fetch(query_url)
+    _Handler.page_requests = []
+
+    with patch.object(_Handler, 'last_edit_date', None):
+        _fetch(query_url)
+
+    assert len(_Handler.page_requests) == 3
@@ -0,0 +1,132 @@
+import ftplib
+import os
+from typing import List, Optional
+from unittest.mock import patch
+
+import pytest
+
+from qgreenland.util import ftp
+
+CONTENT = os.urandom(1024 * 1024 + 123)
+URL = 'ftp://ftp.example.com/pub/data.bin'
+
+
+class _DataConnection:
+    def __init__(self, data, *, fail_after=None):
+        self._data = data
+        self._fail_after = fail_after
+        self._sent = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def recv(self, n_bytes):
+        if self._fail_after is not None and self._sent >= self._fail_after:
+            raise ConnectionResetError('Dropped')
+        block = self._data[self._sent:self._sent + n_bytes]
+        self._sent += len(block)
+        return block
+
+
+class _FakeFTP:
+    """Serves `CONTENT`, dropping the first `failures` transfers part way."""
+
+    connections = 0
+    failures = 0
+    supports_rest = True
+    rest_offsets: List[Optional[int]] = []
+
+    def __init__(self, **_kwargs):
+        _FakeFTP.connections += 1
+
+    def connect(self, host, port):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def voidcmd(self, cmd):
+        pass
+
+    def voidresp(self):
+        pass
+
+    def close(self):
+        pass
+
+    def size(self, path):
+        return len(CONTENT)
+
+    def sendcmd(self, cmd):
+        return '213 20210101000000'
+
+    def transfercmd(self, cmd, rest=None):
+        if rest and not self.supports_rest:
+            raise ftplib.error_perm('502 REST not implemented')
+        _FakeFTP.rest_offsets.append(rest)
+
+        fail_after = None
+        if _FakeFTP.failures:
+            _FakeFTP.failures -= 1
+            fail_after = len(CONTENT) // 2
+
+        return _DataConnection(CONTENT[rest or 0:], fail_after=fail_after)
+
+
+@pytest.fixture
+def fake_ftp(tmp_path):
+    _FakeFTP.connections = 0
+    _FakeFTP.failures = 0
+    _FakeFTP.supports_rest = True
+    _FakeFTP.rest_offsets = []
+
+    staging_patch = patch.object(
+        ftp, 'DOWNLOAD_STAGING_DIR', str(tmp_path / 'staging'),
+    )
+    with patch.object(ftplib, 'FTP', _FakeFTP), \
+            patch.dict(ftp._idle, clear=True), \
+            staging_patch:
+        yield _FakeFTP
+
+
+def _read(fp):
+    with open(fp, 'rb') as f:
+        return f.read()
+
+
+def test_fetch_reuses_connections(fake_ftp, tmp_path):
+    for i in range(3):
+        fp = ftp.fetch(URL, str(tmp_path / f'data{i}.bin'), buffer_size=64 * 1024)
+        assert _read(fp) == CONTENT
+
+    assert fake_ftp.connections == 1
+    assert os.listdir(ftp.DOWNLOAD_STAGING_DIR) == []
+
+
+def test_fetch_resumes(fake_ftp, tmp_path):
+    fake_ftp.failures = 1
+    fp = str(tmp_path / 'data.bin')
+
+    with pytest.raises(ConnectionResetError):
+        ftp.fetch(URL, fp)
+    ftp.fetch(URL, fp)
+
+    assert _read(fp) == CONTENT
+    assert fake_ftp.rest_offsets[-1] >= len(CONTENT) // 2
+    # The dropped connection wasn't reused.
+    assert fake_ftp.connections == 2
+
+
+def test_fetch_without_rest(fake_ftp, tmp_path):
+    fake_ftp.failures = 1
+    fake_ftp.supports_rest = False
+    fp = str(tmp_path / 'data.bin')
+
+    with pytest.raises(ConnectionResetError):
+        ftp.fetch(URL, fp)
+    ftp.fetch(URL, fp)
+
+    assert _read(fp) == CONTENT
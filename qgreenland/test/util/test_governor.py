@@ -0,0 +1,58 @@
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from qgreenland.util import governor
+
+URL = 'https://example.com/data.zip'
+
+
+@pytest.fixture
+def limits():
+    limits = {'connections': 2, 'bytes_per_s': None}
+    limits_patch = patch.object(
+        governor, '_limits',
+        side_effect=lambda _host: (limits['connections'], limits['bytes_per_s']),
+    )
+    with patch.object(governor, 'SLOT_POLL_INTERVAL_S', 0.01), limits_patch:
+        yield limits
+
+
+def test_host_connections_limited(limits):
+    lock = threading.Lock()
+    active = []
+    max_active = []
+
+    def _download():
+        with governor.host_connection(URL):
+            with lock:
+                active.append(1)
+                max_active.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.pop()
+
+    threads = [threading.Thread(target=_download) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(max_active) == 2
+
+
+def test_host_bandwidth_capped(limits):
+    limits['bytes_per_s'] = 4 * governor.THROTTLE_INTERVAL_BYTES
+    before = governor.host_totals().get('example.com', {'bytes': 0})['bytes']
+
+    start = time.monotonic()
+    with governor.host_connection(URL) as transfer:
+        # One second's worth may be sent at once; the rest is throttled.
+        for _ in range(8):
+            transfer.add(governor.THROTTLE_INTERVAL_BYTES)
+
+    assert time.monotonic() - start >= 0.9
+    after = governor.host_totals()['example.com']['bytes']
+    assert after - before == 8 * governor.THROTTLE_INTERVAL_BYTES
@@ -0,0 +1,174 @@
+import copy
+from unittest.mock import patch
+
+import luigi
+
+from qgreenland.config import CONFIG
+from qgreenland.tasks.common.fetch import FetchDataFiles, FetchLocalDataFiles
+from qgreenland.tasks.common.misc import ExtractNcDataset, Unzip
+from qgreenland.tasks.common.raster import BuildRasterOverviews, WarpRaster
+from qgreenland.tasks.common.vector import Ogr2OgrVector
+from qgreenland.tasks.layers import INGEST_TASKS
+from qgreenland.util.luigi import (CPU_BOUND_RESOURCES,
+                                   LayerTask,
+                                   MEMORY_BOUND_RESOURCES,
+                                   NETWORK_BOUND_RESOURCES,
+                                   task_threads)
+from qgreenland.util.task import data_source_steps
+
+
+def test_process_resources_defaults():
+    task = Ogr2OgrVector(requires_task=None, layer_id='coastlines')
+
+    assert task.process_resources() == CPU_BOUND_RESOURCES
+
+
+def test_process_resources_task_class_default():
+    task = WarpRaster(requires_task=None, layer_id='bedmachine_bed')
+
+    assert task.process_resources() == MEMORY_BOUND_RESOURCES
+    # Warps on as many threads as it claims cores.
+    assert task_threads(task) == 1
+
+
+def test_process_resources_layer_override():
+    task = WarpRaster(requires_task=None, layer_id='arctic_dem')
+
+    assert task.process_resources() == {
+        **MEMORY_BOUND_RESOURCES, 'cpu': 4, 'memory': 16,
+    }
+    assert task_threads(task) == 4
+    # Class-level defaults are untouched by the override.
+    assert WarpRaster.resources == MEMORY_BOUND_RESOURCES
+
+
+def test_fetch_resources():
+    assert FetchDataFiles.resources == NETWORK_BOUND_RESOURCES
+    assert FetchLocalDataFiles.resources == {}
+
+
+def _arctic_dem_tasks():
+    # Luigi caches task instances by parameter values; config changes are only
+    # visible to new instances.
+    luigi.task_register.Register.clear_instance_cache()
+
+    layer_cfg = CONFIG['layers']['arctic_dem']
+    fetch = FetchDataFiles(
+        dataset_cfg=layer_cfg['dataset'],
+        source_cfg=layer_cfg['source'],
+    )
+    warp = WarpRaster(requires_task=fetch, layer_id='arctic_dem')
+    overviews = BuildRasterOverviews(requires_task=warp, layer_id='arctic_dem')
+
+    return warp, overviews
+
+
+def _arctic_dem_paths():
+    # `config_hash` is computed, from the current config, on first use.
+    return tuple(task.output().path for task in _arctic_dem_tasks())
+
+
+def _patched_layer_cfg(**updates):
+    layer_cfg = copy.deepcopy(CONFIG['layers']['arctic_dem'])
+    layer_cfg.update(updates)
+    return patch.dict(CONFIG['layers'], {'arctic_dem': layer_cfg})
+
+
+def test_config_hash_stable():
+    warp1, overviews1 = _arctic_dem_tasks()
+    warp2, overviews2 = _arctic_dem_tasks()
+
+    assert warp1 is not warp2
+    assert warp1.output().path == warp2.output().path
+    assert overviews1.output().path == overviews2.output().path
+
+
+def test_config_hash_changes_propagate_downstream():
+    warp, overviews = _arctic_dem_paths()
+
+    with _patched_layer_cfg(warp_kwargs={'resampleAlg': 'nearest'}):
+        changed_warp, changed_overviews = _arctic_dem_paths()
+
+    assert changed_warp != warp
+    assert changed_overviews != overviews
+
+
+def test_config_hash_ignores_unrelated_config():
+    warp, overviews = _arctic_dem_paths()
+
+    with _patched_layer_cfg(title='Something else'):
+        same_warp, same_overviews = _arctic_dem_paths()
+
+    assert same_warp == warp
+    assert same_overviews == overviews
+
+
+def test_config_hash_only_downstream_changes():
+    warp, overviews = _arctic_dem_paths()
+
+    with _patched_layer_cfg(overviews_kwargs={
+        'overview_levels': [2, 4],
+        'resampling_method': 'average',
+    }):
+        same_warp, changed_overviews = _arctic_dem_paths()
+
+    assert same_warp == warp
+    assert changed_overviews != overviews
+
+
+def _layer_step_paths(layer_id):
+    """Return the output paths of `layer_id`'s pipeline steps, by class."""
+    luigi.task_register.Register.clear_instance_cache()
+    layer_cfg = CONFIG['layers'][layer_id]
+    task = INGEST_TASKS[layer_cfg['ingest_task']](layer_id=layer_id).requires()
+
+    paths = {}
+    while isinstance(task, LayerTask):
+        paths[type(task).__name__] = task.output().path
+        task = task.requires_task
+
+    return paths
+
+
+def test_config_hash_ignores_layers_sharing_source():
+    snowfall_paths = _layer_step_paths('racmo_snowfall')
+
+    melt_cfg = copy.deepcopy(CONFIG['layers']['racmo_melt'])
+    melt_cfg['extract_nc_dataset_kwargs']['extract_dataset'] = 'runoff'
+    with patch.dict(CONFIG['layers'], {'racmo_melt': melt_cfg}):
+        assert _layer_step_paths('racmo_snowfall') == snowfall_paths
+
+
+def test_decompress_shared_by_data_source():
+    steps = data_source_steps('glims.only', Unzip)
+    source_tasks = {step.source_task for step in steps}
+
+    assert len(steps) == 2
+    assert len(source_tasks) == 1
+    source_task = source_tasks.pop()
+    assert set(source_task.extract_files) == {
+        fn for step in steps for fn in step.extract_files
+    }
+    # No layer raises its claim.
+    assert source_task.process_resources()['cpu'] == 1
+
+
+def test_decompress_shared_extracts_all():
+    # `racmo_wind_vectors` needs the whole archive.
+    steps = data_source_steps('racmo_qgreenland_jan2021.only', Unzip)
+    source_tasks = {step.source_task for step in steps}
+
+    assert len(source_tasks) == 1
+    assert source_tasks.pop().extract_files == ()
+
+
+def test_extract_nc_datasets_batched():
+    steps = data_source_steps('bedmachine.only', ExtractNcDataset)
+    source_tasks = {step.source_task for step in steps}
+
+    assert len(steps) == 4
+    assert len(source_tasks) == 1
+    assert (
+        {r['extract_dataset'] for r in source_tasks.pop().requests}
+        == {step.dataset_name for step in steps}
+    )
@@ -0,0 +1,35 @@
+from unittest.mock import patch
+
+import pytest
+
+from qgreenland.util import manifest
+
+
+@pytest.fixture
+def manifest_dir(tmp_path):
+    with patch.object(manifest, 'FETCH_MANIFEST_DIR', str(tmp_path / 'manifests')):
+        yield tmp_path
+
+
+def _files(tmp_path, content):
+    fp = tmp_path / 'a.txt'
+    fp.write_text(content)
+    return {'a.txt': manifest.file_entry(str(fp), url='https://example.com/a.txt')}
+
+
+def test_generation(manifest_dir):
+    assert manifest.read_manifest('ds.src') == {}
+
+    manifest.write_manifest('ds.src', _files(manifest_dir, 'v1'))
+    assert manifest.read_manifest('ds.src')['generation'] == 0
+
+    # Re-fetching identical content keeps the generation.
+    manifest.write_manifest('ds.src', _files(manifest_dir, 'v1'))
+    assert manifest.read_manifest('ds.src')['generation'] == 0
+
+    written = manifest.write_manifest(
+        'ds.src', _files(manifest_dir, 'v2'), cmr_revision_id=2,
+    )
+    assert written == manifest.read_manifest('ds.src')
+    assert written['generation'] == 1
+    assert written['cmr_revision_id'] == 2
@@ -0,0 +1,82 @@
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from qgreenland.util import mirrors
+
+# Nothing listens on port 1, so this URL is never available.
+UNAVAILABLE_URL = 'http://127.0.0.1:1/data/a.txt'
+
+
+@pytest.fixture
+def mirror_dirs(tmp_path):
+    dirs = []
+    for name in ('mirror1', 'mirror2'):
+        mirror_dir = tmp_path / name
+        mirror_dir.mkdir()
+        (mirror_dir / 'a.txt').write_text(name)
+        dirs.append(str(mirror_dir))
+
+    (tmp_path / 'out').mkdir()
+    throughput_fp = str(tmp_path / 'throughput.json')
+    with patch.object(mirrors, 'MIRROR_THROUGHPUT_FILE', throughput_fp):
+        yield dirs
+
+
+def _fetch(tmp_path, mirror_dirs, manifest):
+    return mirrors.fetch_from_mirrors(
+        UNAVAILABLE_URL,
+        output_dir=str(tmp_path / 'out'),
+        mirrors=mirror_dirs,
+        manifest=manifest,
+        session=requests.Session(),
+    )
+
+
+def test_mirror_urls():
+    assert mirrors.mirror_urls(
+        'https://example.com/data/a.zip',
+        ['https://mirror.example.org/qgr', 'file:///mirror/'],
+    ) == [
+        'https://example.com/data/a.zip',
+        'https://mirror.example.org/qgr/a.zip',
+        '/mirror/a.zip',
+    ]
+
+
+def test_fetch_from_local_mirror(tmp_path, mirror_dirs):
+    manifest = {}
+    fp = _fetch(tmp_path, mirror_dirs, manifest)
+
+    with open(fp) as f:
+        assert f.read() == 'mirror1'
+    assert manifest['a.txt']['url'] == UNAVAILABLE_URL
+    assert manifest['a.txt']['mirror'] == os.path.join(mirror_dirs[0], 'a.txt')
+
+    with open(mirrors.MIRROR_THROUGHPUT_FILE) as f:
+        assert mirror_dirs[0] in json.load(f)
+
+
+def test_fetch_fails_over(tmp_path, mirror_dirs):
+    fetch_one = mirrors._fetch_one
+
+    def _fail_first_mirror(url, **kwargs):
+        if url.startswith(mirror_dirs[0]):
+            raise requests.exceptions.ConnectionError('Connection reset')
+        return fetch_one(url, **kwargs)
+
+    manifest = {}
+    with patch.object(mirrors, '_fetch_one', side_effect=_fail_first_mirror):
+        fp = _fetch(tmp_path, mirror_dirs, manifest)
+
+    with open(fp) as f:
+        assert f.read() == 'mirror2'
+    assert manifest['a.txt']['mirror'] == os.path.join(mirror_dirs[1], 'a.txt')
+
+
+def test_no_mirror_available(tmp_path, mirror_dirs):
+    with pytest.raises(requests.exceptions.ConnectionError):
+        _fetch(tmp_path, [str(tmp_path / 'empty')], {})
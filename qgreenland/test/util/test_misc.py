@@ -1,9 +1,16 @@
+import gzip
+import multiprocessing
 import os
+import sys
+import tarfile
+import zipfile
 from unittest.mock import patch
 
+import luigi
 import pytest
 
 from qgreenland.constants import TaskType
+from qgreenland.exceptions import QgrRuntimeError
 from qgreenland.util import misc
 
 
@@ -73,3 +80,229 @@ def test_layer_path_remote_multiple_urls():
 
     with pytest.raises(RuntimeError):
         misc.get_layer_path(mock_layer_cfg)
+
+
+def test_link_or_copy_links(tmp_path):
+    src = tmp_path / 'src.tif'
+    src.write_text('data')
+
+    misc.link_or_copy(str(src), str(tmp_path / 'sub' / 'dst.tif'))
+
+    assert (tmp_path / 'sub' / 'dst.tif').stat().st_ino == src.stat().st_ino
+
+
+def test_link_or_copy_mutable(tmp_path):
+    src = tmp_path / 'src.tif'
+    src.write_text('data')
+    dst = tmp_path / 'dst.tif'
+
+    misc.link_or_copy(str(src), str(dst), mutable=True)
+    dst.write_text('edited')
+
+    assert dst.stat().st_ino != src.stat().st_ino
+    assert src.read_text() == 'data'
+
+
+@patch('os.link', side_effect=OSError)
+def test_link_or_copy_fallback(_mock_link, tmp_path):
+    src = tmp_path / 'src.tif'
+    src.write_text('data')
+    dst = tmp_path / 'dst.tif'
+
+    misc.link_or_copy(str(src), str(dst))
+
+    assert dst.read_text() == 'data'
+
+
+def test_link_tree(tmp_path):
+    src_dir = tmp_path / 'src'
+    (src_dir / 'sub').mkdir(parents=True)
+    (src_dir / 'a.shp').write_text('a')
+    (src_dir / 'sub' / 'b.dbf').write_text('b')
+
+    misc.link_tree(str(src_dir), str(tmp_path / 'all'))
+    misc.link_tree(str(src_dir), str(tmp_path / 'some'), relpaths=['sub/b.dbf'])
+
+    assert (tmp_path / 'all' / 'a.shp').read_text() == 'a'
+    assert (tmp_path / 'all' / 'sub' / 'b.dbf').read_text() == 'b'
+    assert os.listdir(tmp_path / 'some') == ['sub']
+
+
+def _write_parts_and_commit(target_path, n_parts=20):
+    with misc.temporary_path_dir(luigi.LocalTarget(target_path)) as tmp_dir:
+        for i in range(n_parts):
+            with open(os.path.join(tmp_dir, f'part{i}'), 'w') as f:
+                f.write(str(os.getpid()) * 1000)
+
+
+def test_open_output_decompresses(tmp_path):
+    fp = str(tmp_path / 'out.txt')
+    # Two gzip members, delivered in chunks which split them.
+    data = gzip.compress(b'hello ') + gzip.compress(b'world')
+
+    with misc._open_output(fp, decompress=True) as f:
+        for i in range(0, len(data), 7):
+            f.write(data[i:i + 7])
+
+    with open(fp, 'rb') as f:
+        assert f.read() == b'hello world'
+
+
+def test_open_output_truncated(tmp_path):
+    with pytest.raises(RuntimeError):
+        with misc._open_output(str(tmp_path / 'out.txt'), decompress=True) as f:
+            f.write(gzip.compress(b'hello')[:-8])
+
+
+@pytest.mark.parametrize('backend', [gzip, misc.gzip_backend])
+def test_gunzip_files(tmp_path, backend):
+    parts = {
+        f'part{i}.bin': os.urandom(3 * misc.DECOMPRESS_BUFFER_SIZE // 2) * (i + 1)
+        for i in range(5)
+    }
+    gzip_paths = []
+    for fn, data in parts.items():
+        gzip_path = tmp_path / f'{fn}.gz'
+        gzip_path.write_bytes(gzip.compress(data, compresslevel=1))
+        gzip_paths.append(str(gzip_path))
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+
+    with patch.object(misc, 'gzip_backend', backend):
+        misc.gunzip_files(gzip_paths, str(out_dir), workers=3)
+
+    assert sorted(os.listdir(out_dir)) == sorted(parts)
+    for fn, data in parts.items():
+        assert (out_dir / fn).read_bytes() == data
+
+
+def test_gzip_backend_fallback():
+    # `None` in `sys.modules` makes the import raise `ImportError`.
+    with patch.dict(sys.modules, {'isal': None, 'isal.igzip': None}):
+        assert misc._gzip_backend() is gzip
+
+
+def test_find_in_zip(tmp_path):
+    zip_path = tmp_path / 'data.zip'
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('data/lines.shp', b'')
+        zf.writestr('data/lines.dbf', b'')
+
+    assert misc.find_single_file_by_ext(
+        str(tmp_path), ext='.shp', search_archives=True,
+    ) == f'/vsizip/{zip_path}/data/lines.shp'
+    # Archives are only searched on request.
+    with pytest.raises(RuntimeError):
+        misc.find_single_file_by_ext(str(tmp_path), ext='.shp')
+    # Files outside archives are found first.
+    (tmp_path / 'other.shp').write_bytes(b'')
+    assert misc.find_single_file_by_ext(
+        str(tmp_path), ext='.shp', search_archives=True,
+    ) == str(tmp_path / 'other.shp')
+
+
+def test_find_in_tar_and_gzip(tmp_path):
+    tif_path = tmp_path / 'elevation.tif'
+    tif_path.write_bytes(b'')
+    with tarfile.open(tmp_path / 'data.tar.gz', 'w:gz') as tf:
+        tf.add(tif_path, arcname='data/elevation.tif')
+    with gzip.open(tmp_path / 'velocity.nc.gz', 'wb') as f:
+        f.write(b'')
+    tif_path.unlink()
+
+    assert misc.find_single_file_by_ext(
+        str(tmp_path), ext='.tif', search_archives=True,
+    ) == f"/vsitar/{tmp_path / 'data.tar.gz'}/data/elevation.tif"
+    assert misc.find_single_file_by_ext(
+        str(tmp_path), ext='.nc', search_archives=True,
+    ) == f"/vsigzip/{tmp_path / 'velocity.nc.gz'}"
+
+
+def test_with_sidecars():
+    available = [
+        'data/lines.shp', 'data/lines.SHX', 'data/lines.dbf', 'data/lines.prj',
+        'data/lines.shp.xml', 'data/lines.csv', 'data/points.shp', 'README.txt',
+    ]
+
+    assert misc.with_sidecars(['data/lines.shp'], available) == [
+        'data/lines.SHX', 'data/lines.dbf', 'data/lines.prj', 'data/lines.shp',
+        'data/lines.shp.xml',
+    ]
+    with pytest.raises(QgrRuntimeError, match='data/line.shp'):
+        misc.with_sidecars(['data/lines.shp', 'data/line.shp'], available)
+
+
+def test_temporary_path_dir_concurrent_commits(tmp_path):
+    """Many processes committing the same and distinct outputs at once."""
+    shared_target = str(tmp_path / 'shared')
+    distinct_targets = [str(tmp_path / 'group' / f'layer{i}') for i in range(32)]
+
+    with multiprocessing.Pool(8) as pool:
+        pool.map(_write_parts_and_commit, [shared_target] * 32 + distinct_targets)
+
+    for target in [shared_target, *distinct_targets]:
+        assert len(os.listdir(target)) == 20
+
+    # No temporary directories left behind.
+    assert sorted(os.listdir(tmp_path)) == ['group', 'shared']
+    assert len(os.listdir(tmp_path / 'group')) == len(distinct_targets)
+
+
+def test_temporary_path_dir_failure_leaves_nothing(tmp_path):
+    target = luigi.LocalTarget(str(tmp_path / 'out'))
+
+    with pytest.raises(ZeroDivisionError):
+        with misc.temporary_path_dir(target) as tmp_dir:
+            open(os.path.join(tmp_dir, 'partial'), 'w').close()
+            1 / 0
+
+    assert os.listdir(tmp_path) == []
+
+
+class _StressLayer(luigi.Task):
+    root = luigi.Parameter()
+    idx = luigi.IntParameter()
+
+    def output(self):
+        return luigi.LocalTarget(os.path.join(self.root, 'final', f'layer{self.idx}'))
+
+    def run(self):
+        staging_dir = os.path.join(self.root, 'staging')
+        with misc.temporary_path_dir(self.output(), staging_dir=staging_dir) as tmp:
+            for i in range(10):
+                with open(os.path.join(tmp, f'part{i}'), 'w') as f:
+                    f.write('x' * 10000)
+
+
+class _StressProject(luigi.Task):
+    """Stand-in for `CreateQgisProjectFile`: asserts a fully-written tree."""
+
+    root = luigi.Parameter()
+    count = luigi.IntParameter()
+
+    def requires(self):
+        return [_StressLayer(root=self.root, idx=i) for i in range(self.count)]
+
+    def output(self):
+        return luigi.LocalTarget(os.path.join(self.root, 'project'))
+
+    def run(self):
+        final_dir = os.path.join(self.root, 'final')
+        layer_dirs = os.listdir(final_dir)
+        assert sorted(layer_dirs) == sorted(f'layer{i}' for i in range(self.count))
+        for layer_dir in layer_dirs:
+            assert len(os.listdir(os.path.join(final_dir, layer_dir))) == 10
+
+        with self.output().open('w'):
+            pass
+
+
+def test_temporary_path_dir_luigi_multiple_workers(tmp_path):
+    success = luigi.build(
+        [_StressProject(root=str(tmp_path), count=100)],
+        workers=8,
+        local_scheduler=True,
+    )
+
+    assert success
+    assert os.listdir(tmp_path / 'staging') == []
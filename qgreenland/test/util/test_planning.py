@@ -0,0 +1,78 @@
+import luigi
+import pytest
+
+from qgreenland.util import planning
+
+
+# Two chains, `a -> b` and `c`, joined by `d`.
+_DEPS = {'a': [], 'b': ['a'], 'c': [], 'd': ['b', 'c']}
+
+
+class _Step(luigi.Task):
+    name = luigi.Parameter()
+    resources = {'cpu': 1}
+
+    def requires(self):
+        return [_Step(name=dep) for dep in _DEPS.get(self.name, [])]
+
+
+class _Build(luigi.WrapperTask):
+    def requires(self):
+        return _Step(name='d')
+
+
+def _record(name, wall_time_s):
+    return {
+        'task_id': _Step(name=name).task_id,
+        'task_family': '_Step',
+        'layer_id': None,
+        'status': 'success',
+        'wall_time_s': wall_time_s,
+    }
+
+
+@pytest.fixture
+def durations():
+    return planning.Durations([
+        _record('a', 10),
+        _record('b', 5),
+        _record('c', 8),
+        _record('d', 1),
+        # Failed runs are ignored.
+        {**_record('c', 1000), 'status': 'failure'},
+    ])
+
+
+@pytest.fixture
+def graph():
+    return planning.task_graph(_Build())
+
+
+def test_durations_fallback(durations):
+    # Unmeasured task falls back to the median of its class.
+    assert durations.predict(_Step(name='new')) == 6.5
+    assert not durations.is_measured(_Step(name='new'))
+
+
+def test_critical_path(graph, durations):
+    length, path = planning.critical_path(graph, durations)
+
+    assert length == 10 + 5 + 1 + planning.DEFAULT_DURATION_S
+    assert [t.name for t in path[:-1]] == ['a', 'b', 'd']
+
+
+def test_simulate_makespan(graph, durations):
+    def makespan(**kwargs):
+        return planning.simulate_makespan(graph, durations, **kwargs)
+
+    wrapper_s = planning.DEFAULT_DURATION_S
+    assert makespan(workers=1, resources={'cpu': 2}) == 24 + wrapper_s
+    # With two workers, the build is only as long as its critical path.
+    assert makespan(workers=2, resources={'cpu': 2}) == 16 + wrapper_s
+    # Resources limit concurrency, no matter the number of workers.
+    assert makespan(workers=2, resources={'cpu': 1}) == 24 + wrapper_s
+
+
+def test_pipeline_priority(durations):
+    assert planning.pipeline_priority(_Step(name='b'), durations) == 15
+    assert planning.pipeline_priority(_Step(name='c'), durations) == 8
@@ -0,0 +1,73 @@
+import csv
+import json
+import os
+import subprocess
+from unittest.mock import patch
+
+import luigi
+
+from qgreenland.util import governor, profiling
+
+
+class _ProfiledTask(luigi.Task):
+    outdir = luigi.Parameter()
+    name = luigi.Parameter()
+
+    def output(self):
+        return luigi.LocalTarget(os.path.join(self.outdir, self.name))
+
+    def run(self):
+        # Child processes' resource usage should be included.
+        subprocess.run(['true'], check=True)
+        with governor.host_connection('https://example.com/data.zip') as transfer:
+            transfer.add(100)
+        with self.output().open('w') as f:
+            f.write('x' * 1000)
+
+
+class _ProfiledWrapper(luigi.WrapperTask):
+    outdir = luigi.Parameter()
+
+    def requires(self):
+        for i in range(4):
+            yield _ProfiledTask(outdir=self.outdir, name=f'out{i}')
+
+
+profiling.register_event_handlers(_ProfiledTask)
+
+
+def test_profiling_report(tmp_path):
+    metrics_fp = str(tmp_path / 'metrics.jsonl')
+    # A stale record from an earlier build of a task outside the graph.
+    with open(metrics_fp, 'w') as f:
+        f.write(json.dumps({'task_id': 'Old', 'wall_time_s': 1}) + '\n')
+
+    task = _ProfiledWrapper(outdir=str(tmp_path / 'out'))
+    with patch.object(profiling, 'BUILD_METRICS_FILE', metrics_fp):
+        assert luigi.build([task], workers=2, local_scheduler=True)
+
+    records = profiling.read_metrics(metrics_fp)
+    assert len(records) == 5
+    for record in records[1:]:
+        assert set(record) == {*profiling.REPORT_FIELDS, 'downloads'}
+        assert record['downloads']['example.com']['bytes'] == 100
+        assert record['status'] == 'success'
+        assert record['output_bytes'] == 1000
+        assert record['wall_time_s'] >= 0
+        assert record['peak_rss_bytes'] > 0
+
+    report_basepath = str(tmp_path / 'report')
+    profiling.write_build_report(
+        task,
+        output_basepath=report_basepath,
+        metrics_fp=metrics_fp,
+    )
+
+    with open(f'{report_basepath}.json') as f:
+        assert len(json.load(f)) == 4
+    with open(f'{report_basepath}.csv') as f:
+        rows = list(csv.DictReader(f))
+        assert {r['task_family'] for r in rows} == {'_ProfiledTask'}
+    with open(f'{report_basepath}_hosts.csv') as f:
+        rows = list(csv.DictReader(f))
+        assert [(r['host'], r['bytes']) for r in rows] == [('example.com', '400')]
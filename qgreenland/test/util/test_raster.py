@@ -0,0 +1,199 @@
+from unittest.mock import patch
+
+import numpy as np
+import pyproj
+from osgeo import gdal, ogr, osr
+
+from qgreenland.config import CONFIG
+from qgreenland.util import raster
+from qgreenland.util.calc import GDAL_CALC_DEFAULT_NODATA
+from qgreenland.util.raster import (cog_overview_levels,
+                                    gdal_calc_vrt,
+                                    materialize_vrt,
+                                    warp_performance_kwargs,
+                                    warp_raster,
+                                    write_cog)
+
+CRS = CONFIG['project']['crs']
+
+
+def _global_raster(fp):
+    """Write a 1-degree WGS84 raster of ones covering the globe."""
+    ds = gdal.GetDriverByName('GTiff').Create(fp, 360, 180, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform((-180, 1, 0, 90, 0, -1))
+    ds.SetProjection(osr.SRS_WKT_WGS84_LAT_LONG)
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    band.WriteArray(np.ones((180, 360), dtype=np.uint8))
+    ds = None
+
+
+def _latitude_cutline(fp, *, latitude):
+    """Write a polygon following `latitude` around the pole, in `CRS`."""
+    transformer = pyproj.Transformer.from_crs('EPSG:4326', CRS, always_xy=True)
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for lon in range(-180, 181):
+        ring.AddPoint_2D(*transformer.transform(lon, latitude))
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    polygon.AddGeometry(ring)
+
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(CRS)
+    ds = ogr.GetDriverByName('GPKG').CreateDataSource(fp)
+    layer = ds.CreateLayer('cutline', srs, ogr.wkbPolygon)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(polygon)
+    layer.CreateFeature(feature)
+    ds = None
+
+    return polygon.GetEnvelope()
+
+
+def test_warp_raster_latitude_cutline(tmp_path):
+    """Cut along 40N while reprojecting from WGS84, across the antimeridian.
+
+    Cutting in the same warp as reprojecting fails with "Cutline polygon is
+    invalid"; see `_gdalwarp_cut_hack`.
+    """
+    inp_path = str(tmp_path / 'global.tif')
+    out_path = str(tmp_path / 'out.tif')
+    cutline_path = str(tmp_path / 'cutline.gpkg')
+    _global_raster(inp_path)
+    xmin, xmax, ymin, ymax = _latitude_cutline(cutline_path, latitude=40)
+
+    warp_raster(
+        inp_path, out_path,
+        layer_cfg={'id': 'test', 'boundary': {'bbox': [xmin, ymin, xmax, ymax]}},
+        warp_kwargs={
+            'cutlineDSName': cutline_path,
+            'cropToCutline': True,
+            'xRes': 100000,
+            'yRes': 100000,
+        },
+    )
+
+    ds = gdal.Open(out_path)
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    assert f'EPSG:{srs.GetAuthorityCode(None)}' == CRS
+    data = ds.GetRasterBand(1).ReadAsArray()
+    rows, cols = data.shape
+    # Data at the pole, none outside the cutline's circle.
+    assert data[rows // 2, cols // 2] == 1
+    assert data[0, 0] == 0
+    assert data[-1, -1] == 0
+    # Nothing was cut from the middle of the circle.
+    assert data[rows // 4:3 * rows // 4, cols // 4:3 * cols // 4].all()
+
+
+def test_gdal_calc_vrt(tmp_path):
+    inp_path = str(tmp_path / 'elevation.tif')
+    vrt_path = str(tmp_path / 'calc.vrt')
+    out_path = str(tmp_path / 'calc.tif')
+    data = np.array([[1.5, 2.25], [-9999, 0.5]], dtype=np.float32)
+    ds = gdal.GetDriverByName('GTiff').Create(inp_path, 2, 2, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((0, 1, 0, 0, 0, -1))
+    ds.GetRasterBand(1).SetNoDataValue(-9999)
+    ds.GetRasterBand(1).WriteArray(data)
+    ds = None
+
+    gdal_calc_vrt(inp_path, vrt_path, gdal_calc_kwargs={
+        'calc': "'A * 100.0'",
+        'type': 'Int32',
+        'NoDataValue': -1,
+    })
+    materialize_vrt(vrt_path, out_path, creation_options=['COMPRESS=DEFLATE'])
+
+    band = gdal.Open(out_path).GetRasterBand(1)
+    assert gdal.GetDataTypeName(band.DataType) == 'Int32'
+    assert band.GetNoDataValue() == -1
+    assert band.ReadAsArray().tolist() == [[150, 225], [-1, 50]]
+
+
+def test_gdal_calc_vrt_nan_nodata(tmp_path):
+    inp_path = str(tmp_path / 'velocity.tif')
+    vrt_path = str(tmp_path / 'calc.vrt')
+    out_path = str(tmp_path / 'calc.tif')
+    data = np.array([[1.5, np.nan]], dtype=np.float32)
+    ds = gdal.GetDriverByName('GTiff').Create(inp_path, 2, 1, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((0, 1, 0, 0, 0, -1))
+    ds.GetRasterBand(1).SetNoDataValue(float('nan'))
+    ds.GetRasterBand(1).WriteArray(data)
+    ds = None
+
+    gdal_calc_vrt(inp_path, vrt_path, gdal_calc_kwargs={'calc': 'A * 2'})
+    materialize_vrt(vrt_path, out_path, creation_options=[])
+
+    # NaN nodata is masked, as by `gdal_calc`.
+    band = gdal.Open(out_path).GetRasterBand(1)
+    nodata = np.float32(GDAL_CALC_DEFAULT_NODATA['Float32'])
+    assert band.ReadAsArray().tolist() == [[3.0, nodata]]
+
+
+def test_warp_performance_kwargs(tmp_path):
+    inp_path = str(tmp_path / 'global.tif')
+    _global_raster(inp_path)
+
+    with patch.object(raster, 'host_cores', return_value=8):
+        small = warp_performance_kwargs(inp_path, memory_gb=4, cpus=4)
+        large = warp_performance_kwargs(inp_path, memory_gb=4, cpus=4, profile='large')
+
+    assert small == {'warpMemoryLimit': 64, 'cache_max_mb': 64}
+    assert large == {
+        # Capped at half and a quarter of the task's memory.
+        'warpMemoryLimit': 2048,
+        'cache_max_mb': 1024,
+        'multithread': True,
+        # Capped at the task's cores.
+        'warpOptions': ['NUM_THREADS=4'],
+        'creationOptions': ['NUM_THREADS=4'],
+    }
+
+
+def test_cog_overview_levels():
+    assert cog_overview_levels(512, 100) == []
+    assert cog_overview_levels(2000, 1500) == [2, 4]
+
+
+def test_write_cog(tmp_path):
+    inp_dir = tmp_path / 'inp'
+    inp_dir.mkdir()
+    inp_path = str(inp_dir / 'inp.tif')
+    out_path = str(tmp_path / 'out.tif')
+    ds = gdal.GetDriverByName('GTiff').Create(inp_path, 2000, 1500, 1, gdal.GDT_Int16)
+    ds.SetGeoTransform((0, 1, 0, 0, 0, -1))
+    ds.GetRasterBand(1).WriteArray(np.arange(2000 * 1500).reshape(1500, 2000) % 100)
+    ds = None
+
+    write_cog(inp_path, out_path)
+
+    ds = gdal.Open(out_path)
+    band = ds.GetRasterBand(1)
+    assert band.GetBlockSize() == [512, 512]
+    assert band.GetOverviewCount() == 2
+    assert ds.GetMetadata('IMAGE_STRUCTURE')['COMPRESSION'] == 'DEFLATE'
+    assert band.ReadAsArray()[1, 3] == 2003 % 100
+    # The input is untouched, and no scratch files are left.
+    assert sorted(p.name for p in inp_dir.iterdir()) == ['inp.tif']
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['inp', 'out.tif']
+
+
+def test_write_cog_lazy(tmp_path):
+    inp_path = str(tmp_path / 'inp.tif')
+    vrt_path = str(tmp_path / 'calc.vrt')
+    out_path = str(tmp_path / 'out.tif')
+    ds = gdal.GetDriverByName('GTiff').Create(inp_path, 1200, 600, 1, gdal.GDT_Int16)
+    ds.SetGeoTransform((0, 1, 0, 0, 0, -1))
+    ds.GetRasterBand(1).SetNoDataValue(-9999)
+    ds.GetRasterBand(1).WriteArray(np.arange(1200 * 600).reshape(600, 1200) % 100)
+    ds = None
+    gdal_calc_vrt(inp_path, vrt_path, gdal_calc_kwargs={'calc': 'A * 2'})
+
+    write_cog(vrt_path, out_path)
+
+    band = gdal.Open(out_path).GetRasterBand(1)
+    assert band.GetOverviewCount() == 2
+    assert band.ReadAsArray()[1, 3] == 2 * (1203 % 100)
+    # No scratch files are left.
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'calc.vrt', 'inp.tif', 'out.tif',
+    ]
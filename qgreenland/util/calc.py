@@ -0,0 +1,225 @@
+"""Evaluate `gdal_calc.py` expressions in process, a window at a time.
+
+Windows are strips of whole rows of the first input's blocks, read from every
+input at the same offsets, and are computed on a thread pool; GDAL and NumPy
+release the GIL while reading and computing. Each thread opens its own handles
+to the inputs, as GDAL datasets can't be shared between threads. Expressions
+are evaluated with numexpr, when it's installed and supports the expression,
+or else with NumPy, with the same names available as in `gdal_calc.py`.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from osgeo import gdal
+from osgeo.gdal_array import GDALTypeCodeToNumericTypeCode
+from osgeo.gdalconst import GA_ReadOnly
+
+from qgreenland.exceptions import QgrRuntimeError
+
+try:
+    # Evaluates an expression in one pass over a window, instead of one pass
+    # per operation.
+    import numexpr
+except ImportError:
+    numexpr = None
+
+logger = logging.getLogger('luigi-interface')
+
+# `gdal_calc.py`'s output nodata value for each type, if none is given.
+GDAL_CALC_DEFAULT_NODATA = {
+    'Byte': 0,
+    'UInt16': 65535,
+    'Int16': -32767,
+    'UInt32': 4294967293,
+    'Int32': -2147483647,
+    'Float32': 3.402823466E+38,
+    'Float64': 1.7976931348623158E+308,
+}
+# Pixels read from each input per window.
+CALC_WINDOW_PIXELS = 4 * 1024 * 1024
+
+# `gdal_calc.py` evaluates expressions after `from numpy import *`.
+_NUMPY_NAMESPACE = {**vars(np), '__builtins__': {}}
+
+
+def _open(path):
+    ds = gdal.Open(path, GA_ReadOnly)
+    if ds is None:
+        raise QgrRuntimeError(f'GDAL failed to open {path}')
+
+    return ds
+
+
+class _Inputs:
+    """Read windows of the input bands, with each thread's own datasets."""
+
+    def __init__(self, inputs, *, bands):
+        self._inputs = inputs
+        self._bands = bands
+        self._local = threading.local()
+
+    def _band(self, letter):
+        if not hasattr(self._local, 'datasets'):
+            self._local.datasets = {
+                letter: _open(path) for letter, path in self._inputs.items()
+            }
+
+        return self._local.datasets[letter].GetRasterBand(self._bands.get(letter, 1))
+
+    def read(self, *, yoff, ysize):
+        arrays = {
+            letter: self._band(letter).ReadAsArray(0, yoff, None, ysize)
+            for letter in self._inputs
+        }
+        for letter, array in arrays.items():
+            if array is None:
+                raise QgrRuntimeError(
+                    f'GDAL failed to read {self._inputs[letter]}:'
+                    f' {gdal.GetLastErrorMsg()}'
+                )
+
+        return arrays
+
+
+def evaluate(calc, arrays):
+    """Evaluate the expression `calc` of the named `arrays`."""
+    if numexpr is not None:
+        try:
+            return numexpr.evaluate(calc, local_dict=arrays)
+        except (KeyError, NotImplementedError, SyntaxError, TypeError, ValueError):
+            # Uses e.g. a NumPy function numexpr doesn't have.
+            pass
+
+    return eval(calc, _NUMPY_NAMESPACE, arrays)
+
+
+def is_nodata(array, value):
+    """Return where `array` is the nodata `value`, which may be NaN.
+
+    Also the nodata test of `qgreenland.util.raster.gdal_calc_vrt`'s pixel
+    functions, which include this function's source; it must only use `np`.
+    """
+    return np.isnan(array) if np.isnan(value) else array == value
+
+
+def _nodata_mask(arrays, nodata):
+    """Return where any of `arrays` is its `nodata` value, or `None`."""
+    mask = None
+    for letter, array in arrays.items():
+        value = nodata[letter]
+        if value is None:
+            continue
+
+        array_nodata = is_nodata(array, value)
+        mask = array_nodata if mask is None else mask | array_nodata
+
+    return mask
+
+
+def _window_rows(band):
+    """Return the rows per window: whole rows of `band`'s blocks."""
+    block_rows = band.GetBlockSize()[1]
+    rows = CALC_WINDOW_PIXELS // band.XSize // block_rows * block_rows
+
+    return max(rows, block_rows)
+
+
+def _check_aligned(datasets):
+    sizes = {
+        letter: (ds.RasterXSize, ds.RasterYSize) for letter, ds in datasets.items()
+    }
+    if len(set(sizes.values())) > 1:
+        raise QgrRuntimeError(f'gdal_calc inputs must be the same size: {sizes}')
+
+
+def _create_output(out_filepath, like_ds, *, out_type, nodata_value, creation_options):
+    out_ds = gdal.GetDriverByName('GTiff').Create(
+        out_filepath, like_ds.RasterXSize, like_ds.RasterYSize, 1,
+        gdal.GetDataTypeByName(out_type), options=list(creation_options),
+    )
+    if out_ds is None:
+        raise QgrRuntimeError(
+            f'GDAL failed to create {out_filepath}: {gdal.GetLastErrorMsg()}'
+        )
+
+    out_ds.SetGeoTransform(like_ds.GetGeoTransform())
+    out_ds.SetProjection(like_ds.GetProjection())
+    out_ds.GetRasterBand(1).SetNoDataValue(nodata_value)
+
+    return out_ds
+
+
+def gdal_calc(
+    inputs, out_filepath, *,
+    calc,
+    out_type=None,
+    nodata_value=None,
+    creation_options=(),
+    bands=None,
+    workers=None,
+):
+    """Write the `gdal_calc.py` expression `calc` of `inputs` to a GeoTIFF.
+
+    `inputs` maps the expression's names, e.g. `A`, to rasters or other GDAL
+    dataset names, e.g. `NETCDF:file.nc:var`, of the same size; band 1 of each
+    is read, unless given in `bands`. The output has the georeferencing of the
+    first input. As with `gdal_calc.py`, the output type defaults to the
+    largest input type, and output pixels are `nodata_value` (by default, from
+    `GDAL_CALC_DEFAULT_NODATA`) wherever any input is nodata. Windows are
+    computed on `workers` threads, by default one per core; tasks pass their
+    `cpu` resource.
+    """
+    bands = bands or {}
+    datasets = {letter: _open(path) for letter, path in inputs.items()}
+    _check_aligned(datasets)
+    in_bands = {
+        letter: ds.GetRasterBand(bands.get(letter, 1)) for letter, ds in datasets.items()
+    }
+    src_nodata = {letter: band.GetNoDataValue() for letter, band in in_bands.items()}
+
+    out_type = out_type or gdal.GetDataTypeName(
+        max(band.DataType for band in in_bands.values())
+    )
+    if nodata_value is None:
+        nodata_value = GDAL_CALC_DEFAULT_NODATA[out_type]
+    out_dtype = GDALTypeCodeToNumericTypeCode(gdal.GetDataTypeByName(out_type))
+
+    first_ds = next(iter(datasets.values()))
+    width, height = first_ds.RasterXSize, first_ds.RasterYSize
+    rows = _window_rows(next(iter(in_bands.values())))
+
+    out_ds = _create_output(
+        out_filepath, first_ds,
+        out_type=out_type,
+        nodata_value=nodata_value,
+        creation_options=creation_options,
+    )
+    out_band = out_ds.GetRasterBand(1)
+    write_lock = threading.Lock()
+    reader = _Inputs(inputs, bands=bands)
+
+    def _calc_window(yoff):
+        ysize = min(rows, height - yoff)
+        arrays = reader.read(yoff=yoff, ysize=ysize)
+        # Constant expressions evaluate to a scalar.
+        result = np.broadcast_to(evaluate(calc, arrays), (ysize, width))
+        mask = _nodata_mask(arrays, src_nodata)
+        if mask is not None:
+            result = np.where(mask, nodata_value, result)
+
+        with write_lock:
+            # Returns a `CPLErr`, `CE_None` (0) if it succeeded.
+            if out_band.WriteArray(result.astype(out_dtype), 0, yoff):
+                raise QgrRuntimeError(
+                    f'GDAL failed to write {out_filepath}: {gdal.GetLastErrorMsg()}'
+                )
+
+    logger.info(f'Calculating {calc} -> {out_filepath}')
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for _ in executor.map(_calc_window, range(0, height, rows)):
+            pass
+
+    out_ds = None
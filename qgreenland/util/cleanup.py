@@ -6,7 +6,10 @@ import time
 
 import click
 
-from qgreenland.constants import (INPUT_DIR,
+from qgreenland.constants import (DOWNLOAD_STAGING_DIR,
+                                  FEATURE_SERVER_PAGES_DIR,
+                                  FETCH_MANIFEST_DIR,
+                                  INPUT_DIR,
                                   RELEASES_DIR,
                                   TaskType,
                                   WIP_DIR,
@@ -44,10 +47,11 @@ def cleanup_intermediate_dirs():
         if task_type != TaskType.FETCH:
             _rmtree(task_type.value)
 
+    # Remove temporary directories left behind by failed or killed workers.
     if os.path.isdir(WIP_DIR):
         for x in os.listdir(WIP_DIR):
-            if x.startswith('tmp'):
-                _rmtree(x)
+            if x.startswith('tmp') or '-luigi-tmp-' in x:
+                _rmtree(os.path.join(WIP_DIR, x))
 
 
 def _validate_boolean_choice(_ctx, _param, value):
@@ -151,13 +155,14 @@ def cleanup_cli(**kwargs):  # noqa: C901
     if inp_patterns := kwargs['delete_inputs_by_pattern']:
         for p in inp_patterns:
             print_and_run(
-                f'rm -rf {INPUT_DIR}/{p}',
+                f'rm -rf {INPUT_DIR}/{p} {FETCH_MANIFEST_DIR}/{p}.json',
                 dry_run=kwargs['dry_run']
             )
 
     if kwargs['delete_all_input']:
         print_and_run(
-            f'rm -rf {INPUT_DIR}/*',
+            f'rm -rf {INPUT_DIR}/* {DOWNLOAD_STAGING_DIR} {FETCH_MANIFEST_DIR}'
+            f' {FEATURE_SERVER_PAGES_DIR}',
             dry_run=kwargs['dry_run']
         )
 
@@ -1,117 +1,299 @@
-import csv
 import datetime
+import fcntl
+import json
 import logging
+import os
 import pprint
-from collections import namedtuple
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
-from qgreenland.constants import REQUEST_TIMEOUT
+from qgreenland.constants import (CMR_CACHE_DIR,
+                                  CMR_CACHE_MAX_AGE_S,
+                                  REQUEST_TIMEOUT)
 
 logger = logging.getLogger('luigi-interface')
 
 CMR_CLIENT_ID_HEADER = {'Client-Id': 'nsidc-qgreenland'}
 CMR_BASE_URL = 'https://cmr.earthdata.nasa.gov'
-CMR_GRANULES_URL = f'{CMR_BASE_URL}/search/granules.csv'
+CMR_GRANULES_UMM_URL = f'{CMR_BASE_URL}/search/granules.umm_json'
 
-CMR_GRANULES_SCROLL_URL = (
-    CMR_GRANULES_URL
-    + '?scroll=true&page_size=2000&'
-    + 'sort_key[]=%2Bstart_date&online_only=true'
+# Granule URs to look up per query, keeping URLs to a reasonable length.
+CMR_GRANULE_URS_PER_QUERY = 100
+# The maximum CMR allows.
+CMR_PAGE_SIZE = 2000
+
+Granule = namedtuple(
+    'Granule',
+    ['urls', 'start_time', 'revision_id', 'granule_ur'],
+    defaults=[None, None],
 )
 
-Granule = namedtuple('Granule', ['urls', 'start_time'])
 
+def _parse_time(time_str):
+    # In September 2020 or so, CMR changed the date format. Just in case of
+    # rollback... support both.
+    old_time_fmt = '%Y-%m-%dT%H:%M:%SZ'
+    new_time_fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+    try:
+        return datetime.datetime.strptime(time_str, new_time_fmt)
+    except ValueError as e:
+        logger.info(f'Error with date parsing: {e}. Trying old format...')
+        return datetime.datetime.strptime(time_str, old_time_fmt)
+
+
+def _cache_entry_from_umm(item):
+    """Extract what we use from a UMM-G granule search result.
+
+    NOTE: "GET DATA" URLs are the granule's "Online Access URLs". Some
+    collections list >1 of them.
+    """
+    umm = item['umm']
+    urls = [
+        related_url['URL']
+        for related_url in umm.get('RelatedUrls', [])
+        if related_url.get('Type') == 'GET DATA'
+    ]
+    if not urls:
+        msg = 'CMR response contains a granule without Online Access URLs:'
+        raise RuntimeError(f'{msg}: {umm["GranuleUR"]}')
+
+    temporal = umm.get('TemporalExtent', {})
+    start_time = (
+        temporal.get('RangeDateTime', {}).get('BeginningDateTime')
+        or temporal.get('SingleDateTime')
+    )
+
+    return {
+        'urls': urls,
+        'start_time': start_time,
+        'revision_id': item['meta']['revision-id'],
+        'cached_at': time.time(),
+    }
+
+
+def _granule_from_cache_entry(granule_ur, entry):
+    return Granule(
+        urls=tuple(entry['urls']),
+        start_time=_parse_time(entry['start_time']),
+        revision_id=entry['revision_id'],
+        granule_ur=granule_ur,
+    )
 
-def _clean_granules_csv(granules):
-    """Filter out blank lines."""
-    return [g for g in granules if g]
 
+def _query_cmr_granules(*, collection_concept_id, granule_urs):
+    """Query CMR for granules by Granule UR; return cache entries by UR."""
+    entries = {}
+    for i in range(0, len(granule_urs), CMR_GRANULE_URS_PER_QUERY):
+        chunk = granule_urs[i:i + CMR_GRANULE_URS_PER_QUERY]
+        response = requests.get(
+            CMR_GRANULES_UMM_URL,
+            params=[
+                ('collection_concept_id', collection_concept_id),
+                ('online_only', 'true'),
+                ('page_size', len(chunk)),
+                *(('granule_ur[]', granule_ur) for granule_ur in chunk),
+            ],
+            headers=CMR_CLIENT_ID_HEADER,
+            timeout=REQUEST_TIMEOUT,
+        )
+
+        if not response.ok:
+            raise RuntimeError(f'Error from CMR: {response.text}')
+
+        for item in response.json()['items']:
+            entries[item['umm']['GranuleUR']] = _cache_entry_from_umm(item)
+
+    if missing := set(granule_urs) - set(entries):
+        raise RuntimeError(
+            f'Granules not found in collection {collection_concept_id}:'
+            f' {sorted(missing)}'
+        )
+
+    return entries
+
+
+def _cache_fp(collection_concept_id):
+    return os.path.join(CMR_CACHE_DIR, f'{collection_concept_id}.json')
+
+
+def _read_cache(collection_concept_id):
+    try:
+        with open(_cache_fp(collection_concept_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-def _csv_granules_to_dicts(resp_text):
-    granules_csv = _clean_granules_csv(resp_text.split('\n'))
 
-    return list(csv.DictReader(granules_csv))
+def _update_cache(collection_concept_id, entries):
+    """Merge `entries` into the cache, which other workers may be updating."""
+    os.makedirs(CMR_CACHE_DIR, exist_ok=True)
+    fp = _cache_fp(collection_concept_id)
+    with open(f'{fp}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
 
+        cache = {**_read_cache(collection_concept_id), **entries}
+        tmp_fp = f'{fp}.tmp'
+        with open(tmp_fp, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_fp, fp)
 
-def get_cmr_granule(*, granule_ur, collection_concept_id):
-    """Query CMR for a granule by Granule UR, return a `Granule`."""
 
-    def _normalize_granule(granule):
-        """Create a standardized object from a row extracted from the CMR CSV.
+def get_cmr_granules(*, collection_concept_id, granule_urs,
+                     max_age_s=CMR_CACHE_MAX_AGE_S):
+    """Look up granules of one collection by Granule UR; return `Granule`s by UR.
 
-        NOTE: The CSV module uses the first row of the response to get the
-        labels. If CMR changes their labels, we will have problems. Same would
-        be true if the field order changed, and we have no control over that.
-        NOTE: The "Online Access URLs" field can have >1 entry for
-        some collections. Currently none of them are implemented.
-        """
-        # In September 2020 or so, CMR changed the date format. Just in case of
-        # rollback... support both.
-        old_time_fmt = '%Y-%m-%dT%H:%M:%SZ'
-        new_time_fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
-        url = granule['Online Access URLs']
+    Granules are cached on disk for `max_age_s` seconds. Those missing from
+    the cache, or older, are queried from CMR in as few requests as possible.
+    If CMR can't be reached, expired cache entries are used instead.
+    """
+    cache = _read_cache(collection_concept_id)
+    now = time.time()
+    expired = [
+        granule_ur for granule_ur in dict.fromkeys(granule_urs)
+        if now - cache.get(granule_ur, {}).get('cached_at', 0) >= max_age_s
+    ]
+
+    if expired:
         try:
-            start_time = datetime.datetime.strptime(
-                granule['Start Time'],
-                new_time_fmt
+            entries = _query_cmr_granules(
+                collection_concept_id=collection_concept_id,
+                granule_urs=expired,
             )
-        except ValueError as e:
-            logger.info(f'Error with date parsing: {e}. Trying old format...')
-            start_time = datetime.datetime.strptime(
-                granule['Start Time'],
-                old_time_fmt
+        except requests.exceptions.ConnectionError as e:
+            if not all(granule_ur in cache for granule_ur in expired):
+                raise
+            logger.warning(f'Using expired CMR granule metadata; {e}')
+        else:
+            _update_cache(collection_concept_id, entries)
+            cache.update(entries)
+
+    return {
+        granule_ur: _granule_from_cache_entry(granule_ur, cache[granule_ur])
+        for granule_ur in granule_urs
+    }
+
+
+def get_cmr_granule(*, granule_ur, collection_concept_id, **kwargs):
+    """Look up a granule by Granule UR, return a `Granule`.
+
+    See `get_cmr_granules`.
+    """
+    return get_cmr_granules(
+        collection_concept_id=collection_concept_id,
+        granule_urs=[granule_ur],
+        **kwargs,
+    )[granule_ur]
+
+
+def prefetch_cmr_granules(datasets_cfg):
+    """Cache every granule configured in `datasets_cfg`, one query per collection.
+
+    Done when building the task graph, so fetch tasks don't query CMR one
+    granule at a time. Failures are logged; fetch tasks will retry.
+    """
+    granule_urs_by_collection = defaultdict(list)
+    for dataset_cfg in datasets_cfg:
+        if dataset_cfg['access_method'] != 'cmr':
+            continue
+
+        for source_cfg in dataset_cfg['sources']:
+            granule_urs_by_collection[source_cfg['collection_concept_id']].append(
+                source_cfg['granule_ur']
+            )
+
+    for collection_concept_id, granule_urs in granule_urs_by_collection.items():
+        try:
+            get_cmr_granules(
+                collection_concept_id=collection_concept_id,
+                granule_urs=granule_urs,
+            )
+        except (RuntimeError, requests.exceptions.RequestException) as e:
+            logger.warning(
+                f'Failed to look up granules of {collection_concept_id}: {e}'
             )
 
-        if not url:
-            msg = 'CMR response contains a granule without Online Access URLs:'
-            raise RuntimeError(f'{msg}: {granule}')
 
-        return Granule(urls=tuple(url.split(',')), start_time=start_time)
+def _search_page(params, *, page_size, search_after=None):
+    """Fetch a page of UMM-G search results.
 
-    url = (f'{CMR_GRANULES_SCROLL_URL}'
-           f'&collection_concept_id[]={collection_concept_id}'
-           f'&granule_ur[]={granule_ur}')
-    response = requests.get(url,
-                            headers=CMR_CLIENT_ID_HEADER,
-                            timeout=REQUEST_TIMEOUT)
+    Return its items and the `CMR-Search-After` value for the next page, or
+    `None` if this is the last page.
+    """
+    headers = dict(CMR_CLIENT_ID_HEADER)
+    if search_after:
+        headers['CMR-Search-After'] = search_after
+
+    response = requests.get(
+        CMR_GRANULES_UMM_URL,
+        params=[*params, ('page_size', page_size)],
+        headers=headers,
+        timeout=REQUEST_TIMEOUT,
+    )
 
     if not response.ok:
         raise RuntimeError(f'Error from CMR: {response.text}')
 
-    granules = _csv_granules_to_dicts(response.text)
+    items = response.json()['items']
+    if len(items) < page_size:
+        return items, None
 
-    if len(granules) > 1:
-        raise RuntimeError('Expecting only one granule')
+    return items, response.headers.get('CMR-Search-After')
 
-    return _normalize_granule(granules[0])
 
+def search_cmr_granules(*, short_name, version, page_size=CMR_PAGE_SIZE,
+                        prefetch=False):
+    """Yield every online granule of a collection as a `Granule`, oldest first.
 
-def search_cmr_granules(*, short_name, version):
-    """Only supports one page of results, limited to 2000 granules."""
+    Follows CMR's search-after paging, so only one page of results is held in
+    memory at a time. With `prefetch`, the next page is requested while the
+    caller consumes the current one.
+    """
 
-    def _version_query_string(version):
+    def _version_params(version):
         max_pad_length = 3
         versions_needed = (max_pad_length - len(str(version))) + 1
         versions = [version.zfill(n + 1) for n in range(versions_needed)]
-        return ''.join([f'&version={v}' for v in versions])
+        return [('version', v) for v in versions]
 
-    url = (f'{CMR_GRANULES_SCROLL_URL}'
-           f'&short_name={short_name}'
-           f'{_version_query_string(version)}')
+    params = [
+        ('short_name', short_name),
+        *_version_params(version),
+        ('sort_key[]', '+start_date'),
+        ('online_only', 'true'),
+    ]
 
-    response = requests.get(url,
-                            headers=CMR_CLIENT_ID_HEADER,
-                            timeout=REQUEST_TIMEOUT)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        items, search_after = _search_page(params, page_size=page_size)
+        while True:
+            if search_after and prefetch:
+                next_page = executor.submit(
+                    _search_page, params,
+                    page_size=page_size,
+                    search_after=search_after,
+                )
 
-    if not response.ok:
-        raise RuntimeError(f'Error from CMR: {response.text}')
+            for item in items:
+                yield _granule_from_cache_entry(
+                    item['umm']['GranuleUR'], _cache_entry_from_umm(item),
+                )
+
+            if not search_after:
+                return
 
-    return _csv_granules_to_dicts(response.text)
+            if prefetch:
+                items, search_after = next_page.result()
+            else:
+                items, search_after = _search_page(
+                    params, page_size=page_size, search_after=search_after,
+                )
 
 
 def pretty_search_cmr_granules(**kwargs):
     try:
-        pprint.pprint(search_cmr_granules(**kwargs))
+        for granule in search_cmr_granules(prefetch=True, **kwargs):
+            pprint.pprint(granule._asdict())
     except BrokenPipeError:
         pass
@@ -0,0 +1,84 @@
+"""Download many files at once, with per-host limits and retries.
+
+Downloads are scheduled on an asyncio event loop. The transfers themselves
+run in threads using `fetch_and_write_file`, so they share its support for
+HTTP Range requests, FTP and Earthdata Login sessions, and fail over to
+mirrors (see `qgreenland.util.mirrors`).
+"""
+import asyncio
+import logging
+import random
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from qgreenland.constants import (FETCH_BACKOFF_S,
+                                  FETCH_FILES_PER_HOST,
+                                  FETCH_RETRIES)
+from qgreenland.util.mirrors import fetch_from_mirrors
+from qgreenland.util.misc import RETRYABLE_ERRORS
+
+logger = logging.getLogger('luigi-interface')
+
+
+async def _fetch_with_retries(url, *, semaphore, executor, **kwargs):
+    loop = asyncio.get_running_loop()
+    for attempt in range(FETCH_RETRIES + 1):
+        async with semaphore:
+            try:
+                return await loop.run_in_executor(
+                    executor, lambda: fetch_from_mirrors(url, **kwargs),
+                )
+            except RETRYABLE_ERRORS as e:
+                if attempt == FETCH_RETRIES:
+                    raise
+                delay_s = FETCH_BACKOFF_S * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning(
+                    f'Retrying download of {url} in {delay_s:.1f}s after: {e}'
+                )
+
+        # Don't hold a slot for this host while waiting.
+        await asyncio.sleep(delay_s)
+
+
+async def _fetch_all(urls, *, files_per_host, **kwargs):
+    semaphores = defaultdict(lambda: asyncio.Semaphore(files_per_host))
+    n_hosts = len({urllib.parse.urlparse(url).netloc for url in urls})
+
+    with ThreadPoolExecutor(max_workers=n_hosts * files_per_host) as executor:
+        results = await asyncio.gather(
+            *(
+                _fetch_with_retries(
+                    url,
+                    semaphore=semaphores[urllib.parse.urlparse(url).netloc],
+                    executor=executor,
+                    **kwargs,
+                )
+                for url in urls
+            ),
+            # Let every download finish or fail before the output directory
+            # may be removed.
+            return_exceptions=True,
+        )
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    return results
+
+
+def fetch_all(urls, *, output_dir, files_per_host=FETCH_FILES_PER_HOST, **kwargs):
+    """Download `urls` into `output_dir` concurrently; return the file paths.
+
+    At most `files_per_host` files are downloaded from each host at a time.
+    Failed downloads are retried with exponential backoff. Other `kwargs`,
+    e.g. `mirrors`, are passed to `fetch_from_mirrors`.
+    """
+    urls = list(urls)
+    if not urls:
+        return []
+
+    return asyncio.run(_fetch_all(
+        urls, output_dir=output_dir, files_per_host=files_per_host, **kwargs,
+    ))
@@ -0,0 +1,189 @@
+"""Resumable, multi-connection HTTP downloads using Range requests.
+
+Each download is staged in `DOWNLOAD_STAGING_DIR`, keyed on its URL, with
+the progress of every segment. A retry after a failure continues where each
+segment stopped, as long as the remote file hasn't changed.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from qgreenland.constants import (DOWNLOAD_STAGING_DIR,
+                                  FETCH_CONNECTIONS,
+                                  REQUEST_TIMEOUT)
+from qgreenland.util.governor import host_connection
+
+logger = logging.getLogger('luigi-interface')
+
+CHUNK_SIZE = 1024 * 1024
+# Don't split downloads into segments smaller than this.
+SEGMENT_MIN_BYTES = 16 * 1024 * 1024
+# How often to record each segment's progress.
+PROGRESS_INTERVAL_BYTES = 16 * 1024 * 1024
+
+
+class RangesNotSupportedError(Exception):
+    """The server didn't honor a Range request."""
+
+
+def supports_ranges(resp):
+    """Whether the response to a plain GET allows a segmented download."""
+    content_length = resp.headers.get('content-length', '')
+    return (
+        resp.headers.get('accept-ranges', '').lower() == 'bytes'
+        # An empty file has no ranges to request.
+        and content_length.isdigit() and int(content_length) > 0
+        # Ranges would apply to the encoded content, but `requests` decodes it.
+        and 'content-encoding' not in resp.headers
+    )
+
+
+def _staging_dir(url):
+    url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(DOWNLOAD_STAGING_DIR, url_hash)
+
+
+def _read_json(fp, default=None):
+    try:
+        with open(fp) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _write_json(fp, obj):
+    tmp_fp = f'{fp}.tmp'
+    with open(tmp_fp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_fp, fp)
+
+
+def _segments(size, connections):
+    """Split `size` bytes into inclusive `(start, end)` byte ranges."""
+    if not size:
+        return []
+
+    n_segments = max(1, min(connections, math.ceil(size / SEGMENT_MIN_BYTES)))
+    segment_size = math.ceil(size / n_segments)
+
+    return [
+        (start, min(start + segment_size, size) - 1)
+        for start in range(0, size, segment_size)
+    ]
+
+
+def _prepare_staging(staging_dir, *, url, size, validator, connections):
+    """Return the segments to download, resetting stale staged data."""
+    meta_fp = os.path.join(staging_dir, 'meta.json')
+    data_fp = os.path.join(staging_dir, 'data')
+    key = {'url': url, 'size': size, 'validator': validator}
+
+    meta = _read_json(meta_fp, default={})
+    if {k: meta.get(k) for k in key} == key and os.path.isfile(data_fp):
+        logger.info(f'Resuming download of {url}')
+        return [tuple(s) for s in meta['segments']]
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    with open(data_fp, 'wb') as f:
+        f.truncate(size)
+
+    segments = _segments(size, connections)
+    _write_json(meta_fp, {**key, 'segments': segments})
+
+    return segments
+
+
+def _fetch_segment(session, url, *, staging_dir, index, start, end, validator):
+    progress_fp = os.path.join(staging_dir, f'{index}.progress')
+    done = _read_json(progress_fp, default=0)
+    if start + done > end:
+        return
+
+    headers = {'Range': f'bytes={start + done}-{end}'}
+    if validator:
+        # Get the whole file (status 200) instead of a range if it changed.
+        headers['If-Range'] = validator
+
+    with host_connection(url) as transfer, session.get(
+        url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT,
+    ) as resp:
+        if resp.status_code != 206:
+            raise RangesNotSupportedError(
+                f"Received '{resp.status_code}' for range request to {url}."
+            )
+
+        with open(os.path.join(staging_dir, 'data'), 'r+b') as f:
+            f.seek(start + done)
+            unrecorded = 0
+            try:
+                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    transfer.add(len(chunk))
+                    done += len(chunk)
+                    unrecorded += len(chunk)
+                    if unrecorded >= PROGRESS_INTERVAL_BYTES:
+                        f.flush()
+                        _write_json(progress_fp, done)
+                        unrecorded = 0
+            finally:
+                # Keep the progress made before e.g. a dropped connection.
+                f.flush()
+                _write_json(progress_fp, done)
+
+    if start + done != end + 1:
+        raise RuntimeError(
+            f'Segment {index} of {url} ended after {done} of'
+            f' {end - start + 1} bytes.'
+        )
+
+
+def fetch_ranges(session, url, *, fp, headers, connections=FETCH_CONNECTIONS):
+    """Download `url` to `fp` over up to `connections` parallel connections.
+
+    `headers` are those of a plain GET of `url`, for which `supports_ranges`
+    must be true. Raises `RangesNotSupportedError` if the server doesn't honor
+    Range requests after all; staged data is discarded.
+    """
+    size = int(headers['content-length'])
+    validator = headers.get('etag') or headers.get('last-modified')
+    staging_dir = _staging_dir(url)
+
+    segments = _prepare_staging(
+        staging_dir,
+        url=url,
+        size=size,
+        validator=validator,
+        connections=connections,
+    )
+
+    logger.info(f'Downloading {url} ({size} bytes) in {len(segments)} segments')
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [
+                executor.submit(
+                    _fetch_segment, session, url,
+                    staging_dir=staging_dir,
+                    index=index,
+                    start=start,
+                    end=end,
+                    validator=validator,
+                )
+                for index, (start, end) in enumerate(segments)
+            ]
+            for future in futures:
+                future.result()
+    except RangesNotSupportedError:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    # The staging dir is on the same filesystem as fetch outputs, so this is
+    # usually a rename.
+    shutil.move(os.path.join(staging_dir, 'data'), fp)
+    shutil.rmtree(staging_dir)
+
+    return fp
@@ -1,8 +1,22 @@
+import fcntl
+import http.cookiejar
 import os
+import threading
+import time
+from typing import Dict, Tuple
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from qgreenland.constants import URS_COOKIE
+from qgreenland.constants import (EDL_COOKIE_JAR,
+                                  EDL_SESSION_MAX_AGE_S,
+                                  FETCH_CONNECTIONS,
+                                  URS_COOKIE)
+
+# Sessions shared by all fetches in this process, keyed by host and `verify`.
+_sessions: Dict[Tuple[str, bool], Tuple[requests.Session, float]] = {}
+_sessions_lock = threading.Lock()
 
 
 def create_earthdata_authenticated_session(s=None, *, hosts, verify):
@@ -45,6 +59,80 @@ def create_earthdata_authenticated_session(s=None, *, hosts, verify):
     return s
 
 
+def _load_cookies(session):
+    """Add unexpired cookies from `EDL_COOKIE_JAR` to `session`."""
+    jar = http.cookiejar.LWPCookieJar(EDL_COOKIE_JAR)
+    try:
+        jar.load()
+    except (OSError, http.cookiejar.LoadError):
+        return
+
+    for cookie in jar:
+        session.cookies.set_cookie(cookie)
+
+
+def _save_cookies(session):
+    """Merge `session`'s cookies into `EDL_COOKIE_JAR`.
+
+    Cookies without an expiry (i.e. browser-session cookies) are kept for
+    `EDL_SESSION_MAX_AGE_S`. The jar is shared by all worker processes.
+    """
+    os.makedirs(os.path.dirname(EDL_COOKIE_JAR), exist_ok=True)
+    with open(f'{EDL_COOKIE_JAR}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        jar = http.cookiejar.LWPCookieJar(EDL_COOKIE_JAR)
+        try:
+            jar.load()
+        except (OSError, http.cookiejar.LoadError):
+            pass
+
+        for cookie in session.cookies:
+            if cookie.expires is None:
+                cookie.expires = int(time.time() + EDL_SESSION_MAX_AGE_S)
+                cookie.discard = False
+            jar.set_cookie(cookie)
+
+        tmp_fp = f'{EDL_COOKIE_JAR}.tmp'
+        jar.save(tmp_fp)
+        # The jar holds credentials.
+        os.chmod(tmp_fp, 0o600)
+        os.replace(tmp_fp, EDL_COOKIE_JAR)
+
+
+def get_session(url, *, verify=True):
+    """Return this process's session for `url`'s host, authenticated if needed.
+
+    Sessions are reused for `EDL_SESSION_MAX_AGE_S`, and keep enough
+    connections alive for parallel downloads. Earthdata Login cookies are
+    persisted to disk, so other processes can skip logging in again.
+    """
+    host = urlparse(url).netloc
+    key = (host, verify)
+
+    with _sessions_lock:
+        if key in _sessions:
+            session, created = _sessions[key]
+            if time.monotonic() - created < EDL_SESSION_MAX_AGE_S:
+                return session
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max(10, 2 * FETCH_CONNECTIONS))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _load_cookies(session)
+
+        session = create_earthdata_authenticated_session(
+            session,
+            hosts=[url],
+            verify=verify,
+        )
+        _save_cookies(session)
+
+        _sessions[key] = (session, time.monotonic())
+        return session
+
+
 def _get_earthdata_creds():
     if not os.environ.get('EARTHDATA_USERNAME'):
         raise RuntimeError('Environment variable EARTHDATA_USERNAME must be defined.')
@@ -0,0 +1,217 @@
+"""Download features from ArcGIS feature server layers a page at a time.
+
+The layer's object IDs are listed in one request, then split into pages of at
+most the server's `maxRecordCount` features, which are downloaded concurrently
+as Esri JSON. Pages are kept in `FEATURE_SERVER_PAGES_DIR`, named by a hash of
+their IDs, so a re-fetch only downloads pages with features added, removed or
+edited since the last fetch (see `_stale_ids`).
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from qgreenland.constants import (FEATURE_SERVER_PAGES_DIR,
+                                  FEATURE_SERVER_PAGE_SIZE,
+                                  FETCH_FILES_PER_HOST,
+                                  REQUEST_TIMEOUT)
+from qgreenland.util.governor import host_connection
+
+logger = logging.getLogger('luigi-interface')
+
+
+class FeatureServerError(Exception):
+    """The feature server responded with an error."""
+
+
+def _split_query_url(query_url):
+    """Return the query endpoint of `query_url` and its parameters."""
+    parsed = urllib.parse.urlparse(query_url)
+    endpoint = urllib.parse.urlunparse(parsed._replace(query=''))
+    params = dict(urllib.parse.parse_qsl(parsed.query))
+    params['f'] = 'json'
+
+    return endpoint, params
+
+
+def _layer_url(endpoint):
+    return endpoint.rstrip('/').rsplit('/query', 1)[0]
+
+
+def _request(session, url, params):
+    # POST, so long lists of object IDs fit.
+    with host_connection(url) as transfer:
+        resp = session.post(url, data=params, timeout=REQUEST_TIMEOUT)
+        resp.raise_for_status()
+        transfer.add(len(resp.content))
+
+    result = resp.json()
+    # Errors are reported with status 200.
+    if 'error' in result:
+        raise FeatureServerError(f"{url} returned an error: {result['error']}")
+
+    return result
+
+
+def layer_info(query_url, *, session=None):
+    """Return the metadata of the layer queried by `query_url`."""
+    session = session or requests.Session()
+    endpoint, _ = _split_query_url(query_url)
+
+    return _request(session, _layer_url(endpoint), {'f': 'json'})
+
+
+def last_edit_date(info):
+    """Return when the layer described by `info` was last edited, if tracked."""
+    return (info.get('editingInfo') or {}).get('lastEditDate')
+
+
+def _object_ids(session, endpoint, params, *, where=None):
+    id_params = {
+        **params,
+        'returnIdsOnly': 'true',
+        'where': where or params.get('where', '1=1'),
+    }
+    id_params.pop('orderByFields', None)
+    result = _request(session, endpoint, id_params)
+
+    return sorted(result.get('objectIds') or [])
+
+
+def _timestamp(epoch_ms):
+    dt = datetime.datetime.utcfromtimestamp(epoch_ms / 1000)
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _stale_ids(session, endpoint, params, *, info, state):
+    """Return the IDs of features edited since `state` was recorded.
+
+    `None` means any feature may have changed.
+    """
+    edited = last_edit_date(info)
+    if not state or edited is None:
+        return None
+    if edited == state.get('last_edit_date'):
+        return set()
+
+    edit_date_field = (info.get('editFieldsInfo') or {}).get('editDateField')
+    if not edit_date_field or state.get('last_edit_date') is None:
+        return None
+
+    where = (
+        f"({params.get('where', '1=1')}) AND {edit_date_field} >"
+        f" TIMESTAMP '{_timestamp(state['last_edit_date'])}'"
+    )
+    try:
+        return set(_object_ids(session, endpoint, params, where=where))
+    except FeatureServerError as e:
+        logger.warning(f'Re-downloading all pages from {endpoint} after: {e}')
+        return None
+
+
+def _pages_dir(query_url):
+    url_hash = hashlib.sha256(query_url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(FEATURE_SERVER_PAGES_DIR, url_hash)
+
+
+def _page_key(ids):
+    return hashlib.sha256(json.dumps(ids).encode('utf-8')).hexdigest()[:16]
+
+
+def _read_state(pages_dir):
+    try:
+        with open(os.path.join(pages_dir, 'state.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(fp, obj):
+    tmp_fp = f'{fp}.tmp'
+    with open(tmp_fp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_fp, fp)
+
+
+def _fetch_page(session, endpoint, params, *, ids, fp):
+    result = _request(session, endpoint, {
+        **params,
+        'objectIds': ','.join(str(i) for i in ids),
+    })
+    if result.get('exceededTransferLimit'):
+        raise FeatureServerError(
+            f'{endpoint} returned only part of a page of {len(ids)} features.'
+        )
+
+    _write_json(fp, result)
+
+
+def fetch_pages(query_url, *, session=None, workers=FETCH_FILES_PER_HOST):
+    """Download the features matching `query_url`; return the page files.
+
+    `query_url` is a feature server layer's `query` endpoint, with parameters
+    such as `where` and `outFields`. Up to `workers` pages are downloaded at a
+    time. Pages are Esri JSON files, in object ID order.
+    """
+    session = session or requests.Session()
+    endpoint, params = _split_query_url(query_url)
+    info = layer_info(query_url, session=session)
+    page_size = min(
+        info.get('maxRecordCount') or FEATURE_SERVER_PAGE_SIZE,
+        FEATURE_SERVER_PAGE_SIZE,
+    )
+
+    ids = _object_ids(session, endpoint, params)
+    if not ids:
+        raise FeatureServerError(f'{query_url} matched no features.')
+    pages = [ids[i:i + page_size] for i in range(0, len(ids), page_size)]
+
+    pages_dir = _pages_dir(query_url)
+    os.makedirs(pages_dir, exist_ok=True)
+    stale_ids = _stale_ids(
+        session, endpoint, params, info=info, state=_read_state(pages_dir),
+    )
+
+    page_fps = [os.path.join(pages_dir, f'{_page_key(page)}.json') for page in pages]
+    to_fetch = [
+        (page, fp) for page, fp in zip(pages, page_fps)
+        if stale_ids is None or not os.path.exists(fp) or stale_ids.intersection(page)
+    ]
+    logger.info(
+        f'Downloading {len(to_fetch)} of {len(pages)} pages of {len(ids)}'
+        f' features from {endpoint}'
+    )
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [
+            executor.submit(_fetch_page, session, endpoint, params, ids=page, fp=fp)
+            for page, fp in to_fetch
+        ]
+        for future in futures:
+            future.result()
+
+    # Pages of features which have since been removed or regrouped.
+    for fn in set(os.listdir(pages_dir)) - {os.path.basename(fp) for fp in page_fps}:
+        if fn != 'state.json':
+            os.remove(os.path.join(pages_dir, fn))
+
+    _write_json(os.path.join(pages_dir, 'state.json'), {
+        'last_edit_date': last_edit_date(info),
+    })
+
+    return page_fps
+
+
+def pages_digest(page_fps):
+    """Hash the content of the page files `page_fps`."""
+    sha256 = hashlib.sha256()
+    for fp in page_fps:
+        with open(fp, 'rb') as f:
+            sha256.update(hashlib.sha256(f.read()).digest())
+
+    return sha256.hexdigest()
@@ -0,0 +1,229 @@
+"""FTP downloads which resume after failures, over reused connections.
+
+Logged-in connections are pooled per server in each process, so fetching many
+files from one server at once (see `qgreenland.util.concurrent_fetch`) doesn't
+log in for every file. Downloads are staged in `DOWNLOAD_STAGING_DIR`, like
+HTTP ones (see `qgreenland.util.download`); a retry continues from the staged
+size with a `REST` command, as long as the remote file's size and modification
+time are unchanged.
+"""
+import ftplib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import urllib.parse
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import DefaultDict, List, Tuple
+
+from qgreenland.constants import (DOWNLOAD_STAGING_DIR,
+                                  FTP_BUFFER_SIZE,
+                                  REQUEST_TIMEOUT)
+from qgreenland.util.governor import host_connection
+
+logger = logging.getLogger('luigi-interface')
+
+# Idle connections kept open per server.
+MAX_IDLE_CONNECTIONS = 8
+# How often to log a download's progress.
+PROGRESS_INTERVAL_BYTES = 256 * 1024 * 1024
+
+# (host, port, user, password) -> connections.
+_idle: DefaultDict[Tuple[str, int, str, str], List[ftplib.FTP]] = defaultdict(list)
+_idle_lock = threading.Lock()
+# Forked workers mustn't share their parent's connections.
+os.register_at_fork(after_in_child=_idle.clear)
+
+
+def _server(url):
+    parsed = urllib.parse.urlparse(url)
+    return (
+        parsed.hostname,
+        parsed.port or ftplib.FTP_PORT,
+        urllib.parse.unquote(parsed.username or 'anonymous'),
+        urllib.parse.unquote(parsed.password or ''),
+    )
+
+
+def _remote_path(url):
+    return urllib.parse.unquote(urllib.parse.urlparse(url).path)
+
+
+def _connect(server):
+    host, port, user, password = server
+    ftp = ftplib.FTP(timeout=REQUEST_TIMEOUT)
+    ftp.connect(host, port)
+    ftp.login(user, password)
+    ftp.voidcmd('TYPE I')
+
+    return ftp
+
+
+def _idle_connection(server):
+    """Return a pooled connection to `server` which is still alive, or `None`."""
+    while True:
+        with _idle_lock:
+            if not _idle[server]:
+                return None
+            ftp = _idle[server].pop()
+
+        try:
+            ftp.voidcmd('NOOP')
+            return ftp
+        except ftplib.all_errors:
+            ftp.close()
+
+
+@contextmanager
+def connection(url):
+    """Yield a logged-in connection to `url`'s server, reusing an idle one."""
+    server = _server(url)
+    ftp = _idle_connection(server) or _connect(server)
+
+    try:
+        yield ftp
+    except BaseException:
+        # The connection may be mid-transfer.
+        ftp.close()
+        raise
+
+    with _idle_lock:
+        if len(_idle[server]) < MAX_IDLE_CONNECTIONS:
+            _idle[server].append(ftp)
+            return
+
+    ftp.close()
+
+
+def _remote_stat(ftp, path):
+    """Return the size and modification time of `path`, where supported."""
+    try:
+        size = ftp.size(path)
+    except ftplib.error_perm:
+        size = None
+
+    try:
+        modified = ftp.sendcmd(f'MDTM {path}').split()[-1]
+    except ftplib.error_perm:
+        modified = None
+
+    return size, modified
+
+
+def _staging_dir(url):
+    url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(DOWNLOAD_STAGING_DIR, url_hash)
+
+
+def _prepare_staging(staging_dir, *, url, size, modified):
+    """Return the number of bytes already staged, resetting stale data."""
+    meta_fp = os.path.join(staging_dir, 'meta.json')
+    data_fp = os.path.join(staging_dir, 'data')
+    key = {'url': url, 'size': size, 'modified': modified}
+
+    try:
+        with open(meta_fp) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = {}
+
+    # Without the size, a complete download can't be told from a partial one.
+    if size is not None and meta == key and os.path.isfile(data_fp):
+        offset = os.path.getsize(data_fp)
+        logger.info(f'Resuming download of {url} from byte {offset}')
+        return offset
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    open(data_fp, 'wb').close()
+    tmp_fp = f'{meta_fp}.tmp'
+    with open(tmp_fp, 'w') as f:
+        json.dump(key, f)
+    os.replace(tmp_fp, meta_fp)
+
+    return 0
+
+
+class _Progress:
+    """Count a download's bytes, logging every `PROGRESS_INTERVAL_BYTES`."""
+
+    def __init__(self, url, *, size, done, transfer):
+        self.url = url
+        self.size = size
+        self.done = done
+        self._transfer = transfer
+        self._logged = done
+
+    def add(self, n_bytes):
+        self.done += n_bytes
+        self._transfer.add(n_bytes)
+        if self.done - self._logged >= PROGRESS_INTERVAL_BYTES:
+            total = f' of {self.size}' if self.size else ''
+            logger.info(f'Downloaded {self.done}{total} bytes of {self.url}')
+            self._logged = self.done
+
+
+def _open_transfer(ftp, path, data_fp, *, progress):
+    """Start sending `path` from the byte after those already in `data_fp`."""
+    offset = os.path.getsize(data_fp)
+    try:
+        return ftp.transfercmd(f'RETR {path}', rest=offset or None)
+    except ftplib.error_perm:
+        if not offset:
+            raise
+
+    logger.warning(f'{progress.url} can not be resumed; downloading from the start')
+    open(data_fp, 'wb').close()
+    progress.done = 0
+
+    return ftp.transfercmd(f'RETR {path}')
+
+
+def _retrieve(ftp, path, data_fp, *, progress, buffer_size):
+    """Append `path` to `data_fp`, resuming from the bytes already there."""
+    with _open_transfer(ftp, path, data_fp, progress=progress) as conn:
+        with open(data_fp, 'ab') as f:
+            for block in iter(lambda: conn.recv(buffer_size), b''):
+                f.write(block)
+                progress.add(len(block))
+
+    ftp.voidresp()
+
+
+def stream(url, write, *, buffer_size=FTP_BUFFER_SIZE):
+    """Call `write` with each block of `url`, without staging or resuming."""
+    with host_connection(url) as transfer, connection(url) as ftp:
+        def _write(block):
+            write(block)
+            transfer.add(len(block))
+
+        ftp.retrbinary(f'RETR {_remote_path(url)}', _write, blocksize=buffer_size)
+
+
+def fetch(url, fp, *, buffer_size=FTP_BUFFER_SIZE):
+    """Download `url` to `fp`, resuming a previous attempt if possible."""
+    path = _remote_path(url)
+    staging_dir = _staging_dir(url)
+    data_fp = os.path.join(staging_dir, 'data')
+
+    with host_connection(url) as transfer, connection(url) as ftp:
+        size, modified = _remote_stat(ftp, path)
+        offset = _prepare_staging(staging_dir, url=url, size=size, modified=modified)
+        progress = _Progress(url, size=size, done=offset, transfer=transfer)
+
+        if size is None or offset < size:
+            _retrieve(ftp, path, data_fp, progress=progress, buffer_size=buffer_size)
+
+    if size is not None and os.path.getsize(data_fp) != size:
+        raise RuntimeError(
+            f'Download of {url} ended after {os.path.getsize(data_fp)} of'
+            f' {size} bytes.'
+        )
+
+    shutil.move(data_fp, fp)
+    shutil.rmtree(staging_dir)
+
+    return fp
@@ -0,0 +1,180 @@
+"""Limit connections and bandwidth per remote host, across all workers.
+
+Every download holds one of a fixed number of connection slots for its host
+while transferring. Slots are lock files, so the limits apply to all Luigi
+worker processes on the build host and are released if a worker dies. Limits
+are configured in `luigi.toml`, e.g.:
+
+    [host_connections]
+    default = 8
+    "n5eil01u.ecs.nsidc.org" = 4
+
+    [host_bytes_per_second]
+    "data.geus.dk" = 20000000
+
+Hosts without a bandwidth cap aren't throttled. Bytes and transfer time are
+totalled per host for each process; `qgreenland.util.profiling` records them
+with each task run.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import DefaultDict, Dict
+
+import luigi
+
+from qgreenland.constants import HOST_CONNECTIONS_DEFAULT, HOST_GOVERNOR_DIR
+
+logger = logging.getLogger('luigi-interface')
+
+# Throttled transfers take bandwidth from the shared budget in batches of at
+# least this many bytes.
+THROTTLE_INTERVAL_BYTES = 256 * 1024
+SLOT_POLL_INTERVAL_S = 0.5
+
+# Bytes transferred and seconds spent transferring by this process, per host.
+# Updated by the threads of concurrent fetches.
+_totals: DefaultDict[str, Dict[str, float]] = defaultdict(
+    lambda: {'bytes': 0, 'seconds': 0.0},
+)
+_totals_lock = threading.Lock()
+
+
+def host_totals():
+    """Return a copy of this process' transfer totals, keyed by host."""
+    with _totals_lock:
+        return {host: dict(totals) for host, totals in _totals.items()}
+
+
+def _host(url):
+    return urllib.parse.urlparse(url).hostname or 'localhost'
+
+
+def _limits(host):
+    """Return the maximum connections and bytes/second (or `None`) for `host`."""
+    config = luigi.configuration.get_config()
+    connections = config.getintdict('host_connections')
+    rates = config.getintdict('host_bytes_per_second')
+
+    return (
+        connections.get(host, connections.get('default', HOST_CONNECTIONS_DEFAULT)),
+        rates.get(host, rates.get('default')),
+    )
+
+
+def _host_dir(host):
+    host_dir = os.path.join(HOST_GOVERNOR_DIR, host)
+    os.makedirs(host_dir, exist_ok=True)
+    return host_dir
+
+
+def _acquire_slot(host, max_connections):
+    """Lock one of `host`'s connection slots; return the open lock file."""
+    host_dir = _host_dir(host)
+    waiting_since = None
+    while True:
+        for slot in random.sample(range(max_connections), max_connections):
+            f = open(os.path.join(host_dir, f'slot-{slot}.lock'), 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                f.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                continue
+
+            if waiting_since is not None:
+                logger.debug(
+                    f'Waited {time.monotonic() - waiting_since:.1f}s for a'
+                    f' connection to {host}'
+                )
+            return f
+
+        if waiting_since is None:
+            waiting_since = time.monotonic()
+        time.sleep(SLOT_POLL_INTERVAL_S)
+
+
+class Transfer:
+    """Count, and optionally throttle, the bytes of one connection."""
+
+    def __init__(self, host, *, max_bytes_per_s):
+        self.host = host
+        self.max_bytes_per_s = max_bytes_per_s
+        self.bytes = 0
+        self._unthrottled_bytes = 0
+        self._started = time.monotonic()
+
+    def add(self, n_bytes):
+        """Record `n_bytes` transferred, waiting if the host's cap is exceeded."""
+        self.bytes += n_bytes
+        if not self.max_bytes_per_s:
+            return
+
+        self._unthrottled_bytes += n_bytes
+        if self._unthrottled_bytes >= THROTTLE_INTERVAL_BYTES:
+            time.sleep(self._take_budget(self._unthrottled_bytes))
+            self._unthrottled_bytes = 0
+
+    def _take_budget(self, n_bytes):
+        """Take `n_bytes` from the host's shared budget; return seconds to wait.
+
+        The budget refills at `max_bytes_per_s`, up to one second's worth.
+        """
+        bucket_fp = os.path.join(_host_dir(self.host), 'bucket.json')
+        with open(f'{bucket_fp}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            now = time.time()
+            try:
+                with open(bucket_fp) as f:
+                    bucket = json.load(f)
+            except (OSError, ValueError):
+                bucket = {'budget': self.max_bytes_per_s, 'updated': now}
+
+            budget = min(
+                self.max_bytes_per_s,
+                bucket['budget'] + (now - bucket['updated']) * self.max_bytes_per_s,
+            ) - n_bytes
+            with open(bucket_fp, 'w') as f:
+                json.dump({'budget': budget, 'updated': now}, f)
+
+        return max(0, -budget / self.max_bytes_per_s)
+
+    def finish(self):
+        seconds = time.monotonic() - self._started
+        with _totals_lock:
+            _totals[self.host]['bytes'] += self.bytes
+            _totals[self.host]['seconds'] += seconds
+        if self.bytes:
+            logger.debug(
+                f'Transferred {self.bytes} bytes from {self.host} in'
+                f' {seconds:.1f}s ({self.bytes / max(seconds, 1e-6):.0f} B/s)'
+            )
+
+
+@contextmanager
+def host_connection(url):
+    """Hold a connection slot for `url`'s host; yield a `Transfer` to count bytes.
+
+    Callers which can't count bytes as they go, e.g. external commands, can
+    `add` the total at the end.
+    """
+    host = _host(url)
+    max_connections, max_bytes_per_s = _limits(host)
+
+    slot = _acquire_slot(host, max_connections)
+    transfer = Transfer(host, max_bytes_per_s=max_bytes_per_s)
+    try:
+        yield transfer
+    finally:
+        transfer.finish()
+        slot.close()
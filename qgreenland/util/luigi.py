@@ -1,12 +1,39 @@
+import functools
 import os
-import shutil
-from typing import Optional
+from typing import Optional, Tuple
 
 import luigi
 
 from qgreenland.config import CONFIG
-from qgreenland.constants import TaskType
-from qgreenland.util.misc import get_layer_dir, get_layer_fn, temporary_path_dir
+from qgreenland.constants import TMP_DIR, TaskType
+from qgreenland.util.misc import (get_layer_dir,
+                                  get_layer_fn,
+                                  json_hash,
+                                  link_tree,
+                                  temporary_path_dir)
+from qgreenland.util.planning import pipeline_priority
+
+
+# Resources are enforced by the Luigi scheduler. The totals available on the
+# build host are configured in the `[resources]` section of
+# `luigi/conf/luigi.toml`; `memory` is in GB.
+NETWORK_BOUND_RESOURCES = {'network': 1}
+CPU_BOUND_RESOURCES = {'cpu': 1, 'memory': 1}
+MEMORY_BOUND_RESOURCES = {'cpu': 1, 'memory': 4}
+
+
+def task_threads(task):
+    """Return how many threads `task` may run: its claimed `cpu` resource.
+
+    Tasks which run thread pools size them with this, so the scheduler doesn't
+    oversubscribe the build host. Claims default to one core; layers raise
+    them for large data with `task_resources`.
+    """
+    return max(1, task.process_resources().get('cpu', 1))
+
+
+# Subdirectory of the WIP dir containing `SourceTask` outputs.
+SOURCES_DIRNAME = '_sources'
 
 
 class LayerTask(luigi.Task):
@@ -14,11 +41,24 @@ class LayerTask(luigi.Task):
 
     Used for all tasks that require a layer config. This way, we only have to
     pass a string instead of a whole config object as a parameter.
+
+    Resources default to `CPU_BOUND_RESOURCES` and can be overridden per task
+    class in layer config, e.g.:
+
+        task_resources:
+          WarpRaster:
+            memory: 16
+
+    WIP outputs are keyed on `config_hash`, so editing the config a task uses
+    causes that task, and everything downstream of it, to re-run.
     """
 
     requires_task = luigi.Parameter()
     layer_id = luigi.Parameter()
     task_type: Optional[TaskType] = None
+    resources = CPU_BOUND_RESOURCES
+    # Layer config keys which affect this task's output.
+    config_keys: Tuple[str, ...] = ('file_type',)
 
     def __repr__(self):
         return (
@@ -29,6 +69,68 @@ class LayerTask(luigi.Task):
     def requires(self):
         return self.requires_task
 
+    def process_resources(self):
+        resources = dict(self.resources)
+        resources.update(
+            self.layer_cfg.get('task_resources', {}).get(type(self).__name__, {})
+        )
+        return resources
+
+    def config_slice(self):
+        """Return all configuration which determines this task's output."""
+        params = {
+            k: v for k, v in self.to_str_params().items()
+            if k not in ('requires_task', 'layer_id')
+        }
+        layer_cfg = {k: self.layer_cfg.get(k) for k in self.config_keys}
+        if 'boundary' in layer_cfg:
+            # The boundary's features aren't reliably serializable; its file
+            # and bbox identify it.
+            layer_cfg['boundary'] = {
+                k: self.layer_cfg['boundary'][k] for k in ('fp', 'bbox')
+            }
+
+        return {
+            'task': type(self).__name__,
+            'params': params,
+            'layer_cfg': layer_cfg,
+            'project_crs': CONFIG['project']['crs'],
+        }
+
+    @property
+    def hash_upstream(self):
+        """The task whose output this task's `config_hash` depends on.
+
+        Steps which require a `SourceTask` shared with other layers hash the
+        step upstream of it instead, as the shared task's parameters include
+        the other layers' config.
+        """
+        return self.requires()
+
+    @functools.cached_property
+    def config_hash(self):
+        """Hash this task's config slice and its upstream output.
+
+        Upstream `LayerTask` output paths contain their own `config_hash`, so
+        changes propagate down the pipeline. Fetched data is identified by its
+        `content_version`, which changes when a refresh fetches new data.
+        """
+        upstream = self.hash_upstream
+        return json_hash([
+            self.config_slice(),
+            upstream.task_id,
+            upstream.output().path,
+            getattr(upstream, 'content_version', None),
+        ])
+
+    @property
+    def reads_archives(self):
+        """Whether input files may be members of archives read in place.
+
+        See `Decompress`.
+        """
+        return self.layer_cfg.get('decompress_kwargs', {}).get('in_place', False)
+
     # TODO: return a deepcopy of these properties.
     @property
     def layer_cfg(self):
@@ -44,6 +146,13 @@ class LayerTask(luigi.Task):
 
     @property
     def outdir(self):
+        """Directory containing this layer's outputs for `self.task_type`.
+
+        The directory is not created here; `output()` is called by the
+        scheduler to check completeness, and creating directories as a side
+        effect can make incomplete outputs look complete to other workers.
+        `temporary_path_dir` creates parent directories on commit.
+        """
         # We could possibly DRY this out by adding a task_type param to
         # get_layer_path
         if self.task_type not in TaskType:
@@ -52,18 +161,61 @@ class LayerTask(luigi.Task):
             raise RuntimeError(msg)
 
         if self.task_type is TaskType.FINAL:
-            outdir = (f"{TaskType.FINAL.value}/{self.layer_cfg['layer_group']}/"
-                      f'{self.id}')
-        else:
-            outdir = f'{self.task_type.value}/{self.id}'
+            return get_layer_dir(self.layer_cfg)
 
-        os.makedirs(outdir, exist_ok=True)
-        return outdir
+        if self.task_type is TaskType.WIP:
+            return f'{self.task_type.value}/{self.id}/{self.config_hash}'
+
+        return f'{self.task_type.value}/{self.id}'
 
     # TODO: Standardize the output method of layer tasks
     # def output(self):
 
 
+class SourceTask(luigi.Task):
+    """A processing step shared by every layer using the same data source.
+
+    Outputs are keyed on `<dataset_id>.<source_id>`, like fetch outputs, and a
+    hash of the task's parameters, so e.g. an archive is expanded once no matter
+    how many layers read from it.
+    """
+
+    requires_task = luigi.Parameter()
+    # Cores claimed; set from the `task_resources` of the layers using the
+    # source, keyed by this task's class name.
+    cpu = luigi.IntParameter(default=CPU_BOUND_RESOURCES['cpu'], significant=False)
+    resources = CPU_BOUND_RESOURCES
+
+    def requires(self):
+        return self.requires_task
+
+    def process_resources(self):
+        return {**self.resources, 'cpu': self.cpu}
+
+    @property
+    def output_name(self):
+        return self.requires_task.output_name
+
+    @property
+    def content_version(self):
+        return getattr(self.requires_task, 'content_version', None)
+
+    @property
+    def outdir(self):
+        params_hash = json_hash([
+            self.to_str_params(only_significant=True), self.content_version,
+        ])
+        return os.path.join(
+            TaskType.WIP.value,
+            SOURCES_DIRNAME,
+            self.output_name,
+            f'{self.get_task_family()}-{params_hash}',
+        )
+
+    def output(self):
+        return luigi.LocalTarget(self.outdir)
+
+
 class LayerPipeline(luigi.Task):
     """Allow top-level layer tasks to lookup config from class attr layer_id.
 
@@ -82,14 +234,50 @@ class LayerPipeline(luigi.Task):
     def cfg(self):
         return CONFIG['layers'][self.layer_id]
 
+    @property
+    def priority(self):
+        """Start the layers which took longest in previous builds first."""
+        return pipeline_priority(self)
+
     def output(self):
         return luigi.LocalTarget(get_layer_dir(self.cfg))
 
+    @property
+    def _committed_input_fp(self):
+        """Record of which upstream output is in the FINAL location.
+
+        Kept outside the FINAL tree so it isn't packaged.
+        """
+        return os.path.join(TaskType.WIP.value, self.layer_id, 'committed_input')
+
+    def complete(self):
+        """Also require the FINAL output to come from the current upstream.
+
+        The FINAL location doesn't change with config, but the upstream WIP
+        location does (see `LayerTask.config_hash`).
+        """
+        if not super().complete():
+            return False
+
+        try:
+            with open(self._committed_input_fp) as f:
+                return f.read() == self.input().path
+        except FileNotFoundError:
+            return False
+
     def run(self):
         if os.path.isdir(self.input().path):
             source_path = self.input().path
         else:
             source_path = os.path.dirname(self.input().path)
 
-        with temporary_path_dir(self.output()) as temp_path:
-            shutil.copytree(source_path, temp_path, dirs_exist_ok=True)
+        # Stage outside the FINAL tree so that a crashed or in-progress copy
+        # never shows up in the QGreenland package. Replace any output built
+        # from outdated config.
+        with temporary_path_dir(
+            self.output(), staging_dir=TMP_DIR, replace=True,
+        ) as temp_path:
+            link_tree(source_path, temp_path)
+
+        with luigi.LocalTarget(self._committed_input_fp).open('w') as f:
+            f.write(self.input().path)
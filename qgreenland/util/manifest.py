@@ -0,0 +1,96 @@
+"""Record what was fetched for each data source, to detect upstream changes.
+
+Every fetch writes a manifest to `FETCH_MANIFEST_DIR`, named like its output
+directory (`<dataset_id>.<source_id>.json`), containing the HTTP validators,
+size and SHA-256 of each file. `qgreenland.util.refresh` uses the validators
+to make conditional requests, and re-fetches only sources which changed.
+
+A manifest's `generation` is incremented each time a refresh fetches
+different content. Fetch tasks expose it as `content_version`, which is part
+of the hash of every downstream WIP output, so only layers using changed
+sources are rebuilt.
+"""
+import datetime
+import hashlib
+import json
+import os
+
+from qgreenland.constants import FETCH_MANIFEST_DIR
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _manifest_path(output_name):
+    return os.path.join(FETCH_MANIFEST_DIR, f'{output_name}.json')
+
+
+def _sha256(fp):
+    sha256 = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def file_entry(fp, *, url, headers=None):
+    """Describe the file at `fp`, fetched from `url` with response `headers`."""
+    headers = headers or {}
+    # The size of the remote file, which differs from the local file's if it
+    # was decompressed.
+    content_length = headers.get('content-length', '')
+    return {
+        'url': url,
+        'etag': headers.get('etag'),
+        'last_modified': headers.get('last-modified'),
+        'content_length': (
+            int(content_length) if content_length.isdigit() else os.path.getsize(fp)
+        ),
+        'sha256': _sha256(fp),
+    }
+
+
+def files_digest(files):
+    """Hash the content of the files described by `files`."""
+    content = sorted((fn, entry['sha256']) for fn, entry in files.items())
+    return hashlib.sha256(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+def read_manifest(output_name):
+    """Return the manifest of the fetch output `output_name`, or `{}`."""
+    try:
+        with open(_manifest_path(output_name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(output_name, files, **extra):
+    """Record `files`, a mapping of relative paths to `file_entry`s.
+
+    `extra` items, e.g. a CMR granule's revision, are stored alongside. The
+    generation is incremented if the files' content differs from the previous
+    manifest's.
+    """
+    previous = read_manifest(output_name)
+    digest = files_digest(files)
+    generation = previous.get('generation', 0)
+    if previous and previous.get('digest') != digest:
+        generation += 1
+
+    manifest = {
+        **extra,
+        'fetched_at': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+        'generation': generation,
+        'digest': digest,
+        'files': files,
+    }
+
+    fp = _manifest_path(output_name)
+    os.makedirs(FETCH_MANIFEST_DIR, exist_ok=True)
+    tmp_fp = f'{fp}.tmp'
+    with open(tmp_fp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_fp, fp)
+
+    return manifest
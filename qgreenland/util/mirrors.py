@@ -0,0 +1,230 @@
+"""Download files from the fastest of their mirrors.
+
+Sources in `datasets.yml` may list `mirrors`: base URLs, or local directories,
+serving the same files as the source's `urls` under the same filenames, e.g.:
+
+    urls:
+      - 'https://example.com/data/a.zip'
+    mirrors:
+      - 'https://mirror.example.org/qgreenland/'
+      - '/mirror/example'
+
+Available mirrors are probed by downloading the start of the file, and tried
+fastest first; a local copy is always preferred. If a download fails, even
+part way, the next mirror is tried. The throughput of every completed
+download is recorded in `MIRROR_THROUGHPUT_FILE`, and used to rank mirrors
+which can't be probed (FTP). The mirror a file came from is recorded in the
+fetch manifest.
+"""
+import fcntl
+import gzip
+import json
+import logging
+import math
+import os
+import shutil
+import time
+import urllib.parse
+
+import requests
+
+from qgreenland.constants import MIRROR_THROUGHPUT_FILE, REQUEST_TIMEOUT
+from qgreenland.util.edl import get_session
+from qgreenland.util.governor import host_connection
+from qgreenland.util.manifest import file_entry
+from qgreenland.util.misc import (RETRYABLE_ERRORS,
+                                  fetch_and_write_file,
+                                  link_or_copy)
+
+logger = logging.getLogger('luigi-interface')
+
+# Bytes downloaded from each mirror to measure its throughput.
+PROBE_BYTES = 256 * 1024
+
+
+def _local_path(url):
+    """Return the path of a local mirror URL, or `None` for remote URLs."""
+    if url.startswith('file://'):
+        return urllib.parse.urlparse(url).path
+    if '://' not in url:
+        return url
+
+    return None
+
+
+def mirror_urls(url, mirrors):
+    """Return `url` followed by the URL of the same file on each mirror."""
+    filename = os.path.basename(urllib.parse.urlparse(url).path)
+    urls = [url]
+    for mirror in mirrors:
+        if _local_path(mirror) is not None:
+            urls.append(os.path.join(_local_path(mirror), filename))
+        else:
+            urls.append(urllib.parse.urljoin(mirror.rstrip('/') + '/', filename))
+
+    return urls
+
+
+def _mirror_key(url):
+    """Identify the mirror serving `url`, for recording its throughput."""
+    if (path := _local_path(url)) is not None:
+        return os.path.dirname(path)
+
+    parsed = urllib.parse.urlparse(url)
+    return f'{parsed.scheme}://{parsed.netloc}'
+
+
+def _read_throughputs():
+    try:
+        with open(MIRROR_THROUGHPUT_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _record_throughput(url, bytes_per_s):
+    """Record the throughput of `url`'s mirror, which other workers may update."""
+    os.makedirs(os.path.dirname(MIRROR_THROUGHPUT_FILE), exist_ok=True)
+    with open(f'{MIRROR_THROUGHPUT_FILE}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        throughputs = _read_throughputs()
+        throughputs[_mirror_key(url)] = {
+            'bytes_per_s': round(bytes_per_s),
+            'measured_at': time.time(),
+        }
+        tmp_fp = f'{MIRROR_THROUGHPUT_FILE}.tmp'
+        with open(tmp_fp, 'w') as f:
+            json.dump(throughputs, f, indent=2)
+        os.replace(tmp_fp, MIRROR_THROUGHPUT_FILE)
+
+
+def probe(url, *, session=None, verify=True):
+    """Return the throughput of `url` in bytes/second, or `None` if unavailable.
+
+    Local files are infinitely fast. FTP mirrors aren't probed; their last
+    recorded throughput, or 0, is returned.
+    """
+    if (path := _local_path(url)) is not None:
+        return math.inf if os.path.isfile(path) else None
+
+    if url.startswith('ftp://'):
+        return _read_throughputs().get(_mirror_key(url), {}).get('bytes_per_s', 0)
+
+    session = session or get_session(url, verify=verify)
+    start = time.monotonic()
+    try:
+        with host_connection(url) as transfer, session.get(
+            url,
+            headers={'Range': f'bytes=0-{PROBE_BYTES - 1}'},
+            timeout=REQUEST_TIMEOUT,
+            stream=True,
+        ) as resp:
+            if resp.status_code not in (200, 206):
+                return None
+
+            n_bytes = 0
+            for chunk in resp.iter_content(chunk_size=64 * 1024):
+                n_bytes += len(chunk)
+                transfer.add(len(chunk))
+                if n_bytes >= PROBE_BYTES:
+                    break
+    except requests.exceptions.RequestException as e:
+        logger.info(f'Mirror unavailable: {url}: {e}')
+        return None
+
+    return n_bytes / max(time.monotonic() - start, 1e-6)
+
+
+def rank_mirrors(urls, **kwargs):
+    """Return the available `urls`, fastest first."""
+    throughputs = {url: probe(url, **kwargs) for url in urls}
+    logger.info(f'Probed mirrors (bytes/s): {throughputs}')
+
+    return sorted(
+        (url for url in urls if throughputs[url] is not None),
+        key=lambda url: throughputs[url],
+        reverse=True,
+    )
+
+
+def _copy_local(path, *, output_dir, decompress=False):
+    """Copy the local mirror file `path` into `output_dir`; return its path."""
+    if decompress and path.endswith('.gz'):
+        fp = os.path.join(output_dir, os.path.basename(path)[:-len('.gz')])
+        with gzip.open(path, 'rb') as gf, open(fp, 'wb') as f:
+            shutil.copyfileobj(gf, f)
+    else:
+        fp = os.path.join(output_dir, os.path.basename(path))
+        link_or_copy(path, fp)
+
+    return fp
+
+
+def _fetch_one(url, *, output_dir, **kwargs):
+    """Download `url` into `output_dir`; return its path and manifest entry."""
+    if (path := _local_path(url)) is not None:
+        fp = _copy_local(
+            path, output_dir=output_dir, decompress=kwargs.get('decompress', False),
+        )
+        return fp, file_entry(fp, url=url)
+
+    entries = {}
+    fp = fetch_and_write_file(url, output_dir=output_dir, manifest=entries, **kwargs)
+    return fp, entries[os.path.basename(fp)]
+
+
+def _fetch_first_available(candidates, *, output_dir, **kwargs):
+    """Download from each of `candidates` in turn until one succeeds.
+
+    Return the URL downloaded from, the file's path and its manifest entry.
+    """
+    for i, candidate in enumerate(candidates):
+        start = time.monotonic()
+        try:
+            fp, entry = _fetch_one(candidate, output_dir=output_dir, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if i == len(candidates) - 1:
+                raise
+            logger.warning(f'Failed to download {candidate}, failing over: {e}')
+            continue
+
+        _record_throughput(
+            candidate,
+            os.path.getsize(fp) / max(time.monotonic() - start, 1e-6),
+        )
+        return candidate, fp, entry
+
+
+def fetch_from_mirrors(url, *, output_dir, mirrors=(), manifest=None, **kwargs):
+    """Download `url`, or the same file from one of `mirrors`; return its path.
+
+    Other `kwargs` are passed to `fetch_and_write_file`.
+    """
+    if not mirrors:
+        return fetch_and_write_file(
+            url, output_dir=output_dir, manifest=manifest, **kwargs,
+        )
+
+    candidates = rank_mirrors(
+        mirror_urls(url, mirrors),
+        session=kwargs.get('session'),
+        verify=kwargs.get('verify', True),
+    )
+    if not candidates:
+        raise requests.exceptions.ConnectionError(
+            f'Neither {url} nor any of its mirrors are available.'
+        )
+
+    source_url, fp, entry = _fetch_first_available(
+        candidates, output_dir=output_dir, **kwargs,
+    )
+
+    if manifest is not None:
+        if source_url != url:
+            # A mirror's validators don't apply to `url`; refreshes compare the
+            # size instead.
+            entry = {**entry, 'url': url, 'etag': None, 'last_modified': None}
+        manifest[os.path.basename(fp)] = {**entry, 'mirror': source_url}
+
+    return fp
@@ -1,18 +1,66 @@
 import cgi
+import errno
+import fcntl
+import fnmatch
+import ftplib
 import glob
+import gzip
+import hashlib
+import json
+import logging
 import os
 import re
+import shutil
 import subprocess
-import urllib.request
-from contextlib import closing, contextmanager
+import tarfile
+import tempfile
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Any
 
+import requests
+
 from qgreenland.constants import REQUEST_TIMEOUT, TaskType
 from qgreenland.exceptions import QgrRuntimeError
-from qgreenland.util.edl import create_earthdata_authenticated_session
+from qgreenland.util import download, ftp
+from qgreenland.util.edl import get_session
+from qgreenland.util.governor import host_connection
+from qgreenland.util.manifest import file_entry
+
+logger = logging.getLogger('luigi-interface')
 
 CHUNK_SIZE = 8 * 1024
+# Makes `zlib` expect a gzip header and trailer.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+DECOMPRESS_BUFFER_SIZE = 1024 * 1024
+
+# Errors from `fetch_and_write_file` which may go away if the download is
+# retried.
+RETRYABLE_ERRORS = (
+    requests.exceptions.RequestException,
+    OSError,
+    EOFError,
+    ftplib.error_temp,
+)
+
+# `FICLONE` from linux/fs.h.
+_FICLONE = 0x40049409
+
+
+def _gzip_backend():
+    """Return ISA-L's gzip module, which decompresses several times faster, if any."""
+    try:
+        from isal import igzip
+    except ImportError:
+        return gzip
+
+    return igzip
+
+
+gzip_backend = _gzip_backend()
 
 
 def _filename_from_url(url):
@@ -25,27 +73,170 @@ def _filename_from_url(url):
     return fn
 
 
-def _ftp_fetch_and_write(url, output_dir):
+class _GunzipWriter:
+    """Write the decompressed content of gzip data to `f` as it arrives."""
+
+    def __init__(self, f):
+        self._f = f
+        self._decompressor = zlib.decompressobj(GZIP_WBITS)
+
+    def write(self, data):
+        while data:
+            # Files may consist of several gzip members.
+            if self._decompressor.eof:
+                self._decompressor = zlib.decompressobj(GZIP_WBITS)
+            self._f.write(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data
+
+    def finish(self):
+        self._f.write(self._decompressor.flush())
+        if not self._decompressor.eof:
+            raise RuntimeError(f'Truncated gzip data written to {self._f.name}')
+
+
+@contextmanager
+def _open_output(fp, *, decompress=False):
+    """Open `fp` for writing, decompressing gzip data written to it if asked."""
+    with open(fp, 'wb') as f:
+        if not decompress:
+            yield f
+            return
+
+        writer = _GunzipWriter(f)
+        yield writer
+        writer.finish()
+
+
+def _gunzip(gzip_path, output_dir):
+    """Decompress `gzip_path` into `output_dir` with a fixed-size buffer."""
+    fp = os.path.join(output_dir, _decompressed_filename(os.path.basename(gzip_path)))
+    with gzip_backend.open(gzip_path, 'rb') as gf:
+        with open(fp, 'wb') as f:
+            shutil.copyfileobj(gf, f, DECOMPRESS_BUFFER_SIZE)
+
+
+def gunzip_files(gzip_paths, output_dir, *, workers):
+    """Decompress `gzip_paths` into `output_dir`, `workers` files at a time."""
+    # zlib releases the GIL while decompressing, so threads run in parallel.
+    n_workers = max(1, min(len(gzip_paths), workers))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(_gunzip, gzip_path, output_dir)
+            for gzip_path in gzip_paths
+        ]
+        for future in futures:
+            future.result()
+
+
+def _decompressed_filename(fn):
+    return fn[:-len('.gz')] if fn.endswith('.gz') else fn
+
+
+def _ftp_fetch_and_write(url, output_dir, *, decompress=False):
     # TODO support earthdata login
     fn = _filename_from_url(url)
-    fp = os.path.join(output_dir, fn)
+    if not decompress:
+        return ftp.fetch(url, os.path.join(output_dir, fn))
+
+    # Decompressed downloads can't be resumed.
+    fp = os.path.join(output_dir, _decompressed_filename(fn))
+    with _open_output(fp, decompress=True) as f:
+        ftp.stream(url, f.write)
+
+    return fp
+
+
+def _filename_from_response(resp, url):
+    """Get the filename from the `content-disposition` header or the URL."""
+    if (
+        (disposition := resp.headers.get('content-disposition'))
+        and 'filename' in disposition
+    ):
+        # Sometimes the filename is quoted, sometimes it's not.
+        parsed = cgi.parse_header(disposition)
+        # Handle case where disposition itself (usually "attachment")
+        # isn't present (geothermal heat flux :bell:).
+        if 'filename' in parsed[0]:
+            return re.match(
+                'filename="?(.*)"?',
+                parsed[0]
+            ).groups()[0].strip('\'"')
+
+        return parsed[1]['filename']
+
+    if not (fn := _filename_from_url(url)):
+        raise RuntimeError(
+            f'Failed to retrieve output filename from {url}'
+        )
 
-    # TODO: do we need `closing`?
-    with closing(urllib.request.urlopen(url)) as r:
-        with open(fp, 'wb') as f:
-            while True:
-                chunk = r.read(CHUNK_SIZE)
-                if not chunk:
-                    break
-                f.write(chunk)
+    return fn
 
 
-# Ignore complexity rule C901
-# TODO: make this less complex!
-def fetch_and_write_file(url, *, output_dir, session=None, verify=True):  # noqa:C901
+def _write_response(resp, fp, *, transfer, decompress=False):
+    # `requests` already decoded gzip content encoding.
+    decompress = decompress and 'gzip' not in resp.headers.get('content-encoding', '')
+    with _open_output(fp, decompress=decompress) as f:
+        for chunk in resp.iter_content(chunk_size=download.CHUNK_SIZE):
+            f.write(chunk)
+            transfer.add(len(chunk))
+
+
+def _http_fetch_and_write(url, output_dir, *, session, decompress=False):
+    """Download `url` into `output_dir`; return the path and response headers.
+
+    Every connection holds a slot of the host's; see `qgreenland.util.governor`.
+    Decompressed downloads use a single connection.
+    """
+    with host_connection(url) as transfer, \
+            session.get(url, timeout=REQUEST_TIMEOUT, stream=True) as resp:
+        fn = _filename_from_response(resp, url)
+        if decompress:
+            fn = _decompressed_filename(fn)
+        fp = os.path.join(output_dir, fn)
+
+        if resp.status_code != 200:
+            # Server errors and rate limiting raise `requests.HTTPError`,
+            # which callers may retry.
+            if resp.status_code == 429 or resp.status_code >= 500:
+                resp.raise_for_status()
+
+            raise RuntimeError(
+                f"Received '{resp.status_code}' from {resp.request.url}."
+                f'Content: {resp.text}'
+            )
+
+        if decompress or not download.supports_ranges(resp):
+            _write_response(resp, fp, transfer=transfer, decompress=decompress)
+            return fp, resp.headers
+
+    # The response above is closed without reading its content.
+    try:
+        download.fetch_ranges(session, url, fp=fp, headers=resp.headers)
+        return fp, resp.headers
+    except download.RangesNotSupportedError as e:
+        logger.warning(f'{e} Falling back to a single connection.')
+
+    with host_connection(url) as transfer, \
+            session.get(url, timeout=REQUEST_TIMEOUT, stream=True) as resp:
+        resp.raise_for_status()
+        _write_response(resp, fp, transfer=transfer)
+
+    return fp, resp.headers
+
+
+def fetch_and_write_file(url, *, output_dir, session=None, verify=True,
+                         manifest=None, decompress=False):
     """Attempt to download and write file from url.
 
-    Assumes filename from URL or content-disposition header.
+    Assumes filename from URL or content-disposition header. With
+    `decompress`, gzip files are decompressed as they are downloaded, and
+    written without their `.gz` extension.
+
+    HTTP downloads from servers supporting Range requests use several
+    connections and resume after failures; see `qgreenland.util.download`.
+
+    If `manifest` is given, the file is recorded in it by filename; see
+    `qgreenland.util.manifest`.
     """
     if url.startswith('ftp://'):
         if not verify:
@@ -53,68 +244,173 @@ def fetch_and_write_file(url, *, output_dir, session=None, verify=True):  # noqa
                 'Ignoring TLS certificate verification is not supported for FTP sources.'
             )
 
-        _ftp_fetch_and_write(url, output_dir)
+        fp = _ftp_fetch_and_write(url, output_dir, decompress=decompress)
+        headers = None
+    else:
+        fp, headers = _http_fetch_and_write(
+            url,
+            output_dir,
+            session=session or get_session(url, verify=verify),
+            decompress=decompress,
+        )
+
+    if manifest is not None:
+        manifest[os.path.basename(fp)] = file_entry(fp, url=url, headers=headers)
+
+    return fp
+
+
+def remote_file_changed(url, entry, *, session=None, verify=True):
+    """Whether `url` may differ from the file described by manifest `entry`.
+
+    Makes a conditional request with the validators recorded in `entry`.
+    Without validators, compares the size. FTP files are never considered
+    changed, since there's no cheap way to tell.
+    """
+    if url.startswith('ftp://'):
+        logger.info(f'Not checking FTP source for changes: {url}')
+        return False
+
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    session = session or get_session(url, verify=verify)
+    # The body is never read, so the response is closed without downloading it.
+    with host_connection(url), session.get(
+        url, headers=headers, timeout=REQUEST_TIMEOUT, stream=True,
+    ) as resp:
+        if resp.status_code == 304:
+            return False
+        resp.raise_for_status()
+
+        # Some servers ignore conditional headers.
+        if headers:
+            return (
+                resp.headers.get('etag') != entry.get('etag')
+                or resp.headers.get('last-modified') != entry.get('last_modified')
+            )
+
+        content_length = resp.headers.get('content-length')
+        return content_length != str(entry['content_length'])
+
+
+# Archives GDAL reads members of in place, and the file system prefix to use.
+# `.tar.gz` must be checked before `.gz`.
+VSI_PREFIXES = (
+    ('.zip', '/vsizip/'),
+    ('.tar', '/vsitar/'),
+    ('.tar.gz', '/vsitar/'),
+    ('.tgz', '/vsitar/'),
+    ('.gz', '/vsigzip/'),
+)
+# Files read together with a data file of the same name, e.g. a shapefile's
+# index, attributes and projection.
+SIDECAR_EXTS = (
+    '.shx', '.dbf', '.prj', '.cpg', '.qpj', '.sbn', '.sbx', '.qix',
+    '.tfw', '.aux.xml', '.ovr', '.xml',
+)
+
+
+def _vsi_prefix(archive_path):
+    for ext, prefix in VSI_PREFIXES:
+        if archive_path.lower().endswith(ext):
+            return ext, prefix
+
+    return None, None
+
+
+def _archive_members(archive_path):
+    """Return the names of the files in `archive_path` and their GDAL paths."""
+    abs_path = os.path.abspath(archive_path)
+    ext, prefix = _vsi_prefix(abs_path)
+
+    if prefix == '/vsizip/':
+        with zipfile.ZipFile(abs_path) as zf:
+            names = [name for name in zf.namelist() if not name.endswith('/')]
+    elif prefix == '/vsitar/':
+        with tarfile.open(abs_path) as tf:
+            names = [member.name for member in tf.getmembers() if member.isfile()]
     else:
-        # TODO: Share the session across requests somehow?
-        if not session:
-            session = create_earthdata_authenticated_session(hosts=[url], verify=verify)
-
-        with session.get(url, timeout=REQUEST_TIMEOUT, stream=True) as resp:
-
-            # Try to extract the filename from the `content-disposition` header
-            if (
-                (disposition := resp.headers.get('content-disposition'))
-                and 'filename' in disposition
-            ):
-                # Sometimes the filename is quoted, sometimes it's not.
-                parsed = cgi.parse_header(disposition)
-                # Handle case where disposition itself (usually "attachment")
-                # isn't present (geothermal heat flux :bell:).
-                if 'filename' in parsed[0]:
-                    fn = re.match(
-                        'filename="?(.*)"?',
-                        parsed[0]
-                    ).groups()[0].strip('\'"')
-                else:
-                    fn = parsed[1]['filename']
-            else:
-                if not (fn := _filename_from_url(url)):
-                    raise RuntimeError(
-                        f'Failed to retrieve output filename from {url}'
-                    )
-
-            fp = os.path.join(output_dir, fn)
-
-            if resp.status_code != 200:
-                raise RuntimeError(
-                    f"Received '{resp.status_code}' from {resp.request.url}."
-                    f'Content: {resp.text}'
-                )
-
-            with open(fp, 'wb') as f:
-                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
-                    f.write(chunk)
-
-        return fp
-
-
-def find_in_dir_by_pattern(path, *, pattern):
+        # A gzip file holds a single file, named like the archive.
+        return [(os.path.basename(abs_path)[:-len(ext)], f'{prefix}{abs_path}')]
+
+    return [(name, f'{prefix}{abs_path}/{name}') for name in names]
+
+
+def _find_in_archives_by_pattern(path, *, pattern):
+    """Find members of archives in a directory with matching filenames.
+
+    Returns GDAL `/vsizip/`, `/vsitar/` or `/vsigzip/` paths, so members can be
+    read without extracting them.
+    """
+    matches = []
+    for archive_path in sorted(glob.glob(os.path.join(path, '**', '*'), recursive=True)):
+        if not os.path.isfile(archive_path) or not _vsi_prefix(archive_path)[1]:
+            continue
+
+        matches.extend(
+            vsi_path
+            for name, vsi_path in _archive_members(archive_path)
+            if fnmatch.fnmatch(os.path.basename(name), pattern)
+        )
+
+    return matches
+
+
+def find_in_dir_by_pattern(path, *, pattern, search_archives=False):
     """Find all files in a directory with matching pattern.
 
     Expects an extension with the dot included, e.g. `pattern=".shp"`.
+
+    With `search_archives`, if no files match, members of archives in the
+    directory are searched instead; see `_find_in_archives_by_pattern`.
     """
     matches = glob.glob(os.path.join(path, '**', pattern),
                         recursive=True)
+    if not matches and search_archives:
+        return _find_in_archives_by_pattern(path, pattern=pattern)
 
     return [os.path.abspath(os.path.join(path, f)) for f in matches]
 
 
-def find_single_file_by_name(path, *, filename):
+def with_sidecars(relpaths, available):
+    """Return the `available` paths in `relpaths`, or sidecars of one of them.
+
+    For example, a shapefile's .shx, .dbf and .prj files are sidecars of its
+    .shp file. Extensions are compared case-insensitively. Fails if any of
+    `relpaths` isn't `available`, e.g. a typo in a layer's `extract_files`.
+    """
+    available_lower = {path.lower() for path in available}
+    missing = [
+        relpath for relpath in relpaths if relpath.lower() not in available_lower
+    ]
+    if missing:
+        raise QgrRuntimeError(f'Requested files not found: {missing}')
+
+    wanted = set()
+    for relpath in relpaths:
+        stem = os.path.splitext(relpath)[0]
+        wanted.add(relpath.lower())
+        wanted.update(
+            f'{base}{ext}'.lower()
+            for base in (stem, relpath)
+            for ext in SIDECAR_EXTS
+        )
+
+    return sorted(path for path in available if path.lower() in wanted)
+
+
+def find_single_file_by_name(path, *, filename, search_archives=False):
     """Return a single file with matching name.
 
-    Fails for any number of results except 1.
+    Fails for any number of results except 1. See `find_in_dir_by_pattern`.
     """
-    files = find_in_dir_by_pattern(path, pattern=filename)
+    files = find_in_dir_by_pattern(
+        path, pattern=filename, search_archives=search_archives,
+    )
     if len(files) > 1:
         raise NotImplementedError(
             f"We're not ready to handle multiple '{filename}' files in one task yet!"
@@ -126,12 +422,14 @@ def find_single_file_by_name(path, *, filename):
         raise RuntimeError(f"No files with name '{filename}' found at '{path}'")
 
 
-def find_single_file_by_ext(path, *, ext):
+def find_single_file_by_ext(path, *, ext, search_archives=False):
     """Return a single file with matching extension.
 
-    Fails for any number of results except 1.
+    Fails for any number of results except 1. See `find_in_dir_by_pattern`.
     """
-    files = find_in_dir_by_pattern(path, pattern=f'*{ext}')
+    files = find_in_dir_by_pattern(
+        path, pattern=f'*{ext}', search_archives=search_archives,
+    )
     if len(files) > 1:
         raise NotImplementedError(
             f"We're not ready to handle multiple '{ext}' files in one task yet!"
@@ -143,20 +441,137 @@ def find_single_file_by_ext(path, *, ext):
         raise RuntimeError(f"No files with extension '{ext}' found at '{path}'")
 
 
+def _commit_dir(tmp_path, final_path, *, replace=False):
+    """Atomically rename `tmp_path` to `final_path`.
+
+    If another worker already committed `final_path`, keep its result and
+    discard ours instead of failing; outputs of the same task are expected to
+    be identical. With `replace`, an existing `final_path` is moved aside and
+    deleted instead.
+    """
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+
+    if replace and os.path.isdir(final_path):
+        old_path = f'{tmp_path}-old'
+        os.rename(final_path, old_path)
+        os.rename(tmp_path, final_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        return
+
+    try:
+        os.rename(tmp_path, final_path)
+    except OSError as e:
+        # A non-empty directory already exists at `final_path`.
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+
+        logger.warning(
+            f'{final_path} was committed by another worker. Discarding {tmp_path}.'
+        )
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
 @contextmanager
-def temporary_path_dir(target):
+def temporary_path_dir(target, *, staging_dir=None, replace=False):
     """Standardizes Luigi task file output behavior.
 
+    Yields a uniquely-named empty directory. If the block exits cleanly, the
+    directory is atomically renamed to the target's path; otherwise it is
+    deleted. Parallel workers therefore never observe partial outputs.
+
     target: a Luigi.FileSystemTarget
             https://luigi.readthedocs.io/en/stable/api/luigi.target.html#luigi.target.FileSystemTarget.temporary_path
+    staging_dir: where to create the temporary directory. Defaults to the
+                 target's parent directory. `os.rename` doesn't allow
+                 cross-mount renaming, so this must be on the same mount as
+                 the target.
+    replace: overwrite an existing target instead of keeping it.
+    """
+    final_path = target.path.rstrip('/')
+    staging_dir = staging_dir or os.path.dirname(final_path)
+    os.makedirs(staging_dir, exist_ok=True)
+
+    # `mkdtemp` names are unique across processes; Luigi's
+    # `target.temporary_path()` relies on the `random` module state instead.
+    tmp_path = tempfile.mkdtemp(
+        prefix=f'{os.path.basename(final_path)}-luigi-tmp-',
+        dir=staging_dir,
+    )
+    try:
+        yield tmp_path
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    _commit_dir(tmp_path, final_path, replace=replace)
+
+
+def _reflink(src, dst):
+    """Clone `src` to `dst`, sharing data blocks until either is modified.
+
+    Only copy-on-write filesystems (e.g. Btrfs, XFS) support this. Returns
+    whether `dst` was created.
     """
-    with target.temporary_path() as p:
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
         try:
-            os.makedirs(p, exist_ok=True)
-            yield p
-        finally:
+            fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+            cloned = True
+        except OSError:
+            cloned = False
+
+    if not cloned:
+        os.remove(dst)
+        return False
+
+    shutil.copystat(src, dst)
+    return True
+
+
+def link_or_copy(src, dst, *, mutable=False):
+    """Make `src` available at `dst`, avoiding copying data where possible.
+
+    Tries a hardlink, then a reflink, then falls back to a copy. A hardlink is
+    the same file as `src`, so pass `mutable=True` if `dst` will be modified in
+    place; `dst` will then be a reflink or a copy.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    if not mutable:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            # E.g. crossing filesystems, or unsupported by network storage.
             pass
-    return
+
+    if not _reflink(src, dst):
+        shutil.copy2(src, dst)
+
+
+def relpaths_in(dir_path):
+    """Return the paths of all files under `dir_path`, relative to it."""
+    return [
+        os.path.relpath(os.path.join(dirpath, fn), dir_path)
+        for dirpath, _, filenames in os.walk(dir_path)
+        for fn in filenames
+    ]
+
+
+def link_tree(src_dir, dst_dir, *, relpaths=None, mutable=False):
+    """`link_or_copy` files under `src_dir` into `dst_dir`.
+
+    Relative paths are preserved. Links only `relpaths` if given, otherwise
+    every file.
+    """
+    if relpaths is None:
+        relpaths = relpaths_in(src_dir)
+
+    for relpath in relpaths:
+        link_or_copy(
+            os.path.join(src_dir, relpath),
+            os.path.join(dst_dir, relpath),
+            mutable=mutable,
+        )
 
 
 def get_layer_fn(layer_cfg):
@@ -228,5 +643,11 @@ def directory_size_bytes(dir_path):
     return total_size
 
 
+def json_hash(obj, *, length=12):
+    """Return a short, stable hash of a JSON-serializable object."""
+    serialized = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()[:length]
+
+
 def datasource_dirname(*, dataset_id: str, source_id: str) -> str:
     return f'{dataset_id}.{source_id}'
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""Plan builds using task durations recorded by previous builds.
+
+See `qgreenland.util.profiling` for how durations are recorded.
+"""
+import functools
+import heapq
+import os
+import statistics
+from collections import defaultdict
+
+import click
+import luigi
+
+from qgreenland.constants import BUILD_METRICS_FILE
+from qgreenland.util.profiling import read_metrics
+
+# Predicted duration of tasks which have never run, in seconds.
+DEFAULT_DURATION_S = 1.0
+
+
+class Durations:
+    """Predict how long tasks take from their recorded runs.
+
+    Uses, in order of preference, the latest successful run of the same task,
+    of the same step of the same layer (e.g. after the task's upstream config
+    changed), or the median run of the same task class.
+    """
+
+    def __init__(self, records):
+        successes = [r for r in records if r.get('status') == 'success']
+
+        self._by_task_id = {r['task_id']: r['wall_time_s'] for r in successes}
+        self._by_layer_step = {
+            (r['task_family'], r['layer_id']): r['wall_time_s']
+            for r in successes if r.get('layer_id')
+        }
+
+        by_family = defaultdict(list)
+        for r in successes:
+            by_family[r['task_family']].append(r['wall_time_s'])
+        self._by_family = {
+            family: statistics.median(durations)
+            for family, durations in by_family.items()
+        }
+
+    def is_measured(self, task):
+        return task.task_id in self._by_task_id
+
+    def predict(self, task):
+        if task.task_id in self._by_task_id:
+            return self._by_task_id[task.task_id]
+
+        layer_step = (task.get_task_family(), getattr(task, 'layer_id', None))
+        if layer_step in self._by_layer_step:
+            return self._by_layer_step[layer_step]
+
+        return self._by_family.get(task.get_task_family(), DEFAULT_DURATION_S)
+
+
+@functools.lru_cache(maxsize=None)
+def recorded_durations(metrics_fp=BUILD_METRICS_FILE):
+    return Durations(read_metrics(metrics_fp))
+
+
+def task_graph(root):
+    """Return a mapping of `root` and every task upstream of it to its deps."""
+    graph = {}
+    stack = [root]
+    while stack:
+        task = stack.pop()
+        if task in graph:
+            continue
+
+        graph[task] = luigi.task.flatten(task.requires())
+        stack.extend(graph[task])
+
+    return graph
+
+
+def _topological_order(graph):
+    """Return the tasks in `graph`, each after all of its deps."""
+    order = []
+    visited = set()
+    for root in graph:
+        stack = [(root, False)]
+        while stack:
+            task, deps_done = stack.pop()
+            if deps_done:
+                order.append(task)
+                continue
+            if task in visited:
+                continue
+
+            visited.add(task)
+            stack.append((task, True))
+            stack.extend((dep, False) for dep in graph[task] if dep not in visited)
+
+    return order
+
+
+def pipeline_priority(task, durations=None):
+    """Return the predicted seconds to run `task` and everything upstream of it.
+
+    Used as a Luigi priority so the longest layer pipelines start first. The
+    scheduler raises the priority of a task's dependencies to at least its own.
+    """
+    durations = durations or recorded_durations()
+    return int(sum(durations.predict(t) for t in task_graph(task)))
+
+
+def critical_path(graph, durations):
+    """Return the longest chain of dependent tasks in `graph` and its duration.
+
+    No number of workers can build the graph faster than this.
+    """
+    finish = {}
+    longest_dep = {}
+    for task in _topological_order(graph):
+        deps = graph[task]
+        longest_dep[task] = max(deps, key=finish.get, default=None)
+        start = 0 if longest_dep[task] is None else finish[longest_dep[task]]
+        finish[task] = start + durations.predict(task)
+
+    if not finish:
+        return 0, []
+
+    task = max(finish, key=finish.get)
+    length = finish[task]
+    path = []
+    while task is not None:
+        path.append(task)
+        task = longest_dep[task]
+
+    return length, list(reversed(path))
+
+
+def _dependents(graph):
+    """Return a mapping of tasks in `graph` to the tasks which require them."""
+    dependents = defaultdict(set)
+    for task, deps in graph.items():
+        for dep in deps:
+            dependents[dep].add(task)
+
+    return dependents
+
+
+def _remaining_path_lengths(graph, durations):
+    """Return the longest path from each task to the end of the build."""
+    dependents = _dependents(graph)
+    remaining = {}
+    for task in reversed(_topological_order(graph)):
+        remaining[task] = durations.predict(task) + max(
+            (remaining[d] for d in dependents[task]), default=0,
+        )
+
+    return remaining
+
+
+class _ResourcePool:
+    """Track scheduler resources like `luigi.scheduler.Scheduler` does."""
+
+    def __init__(self, totals):
+        self.totals = totals
+        self.used = defaultdict(int)
+
+    def fits(self, task):
+        return all(
+            self.used[resource] + amount <= self.totals.get(resource, 1)
+            for resource, amount in task.process_resources().items()
+        )
+
+    def claim(self, task, *, sign=1):
+        for resource, amount in task.process_resources().items():
+            self.used[resource] += sign * amount
+
+    def release(self, task):
+        self.claim(task, sign=-1)
+
+
+def simulate_makespan(graph, durations, *, workers, resources=None):
+    """Predict the wall time to build `graph` with `workers` workers.
+
+    Mimics the Luigi scheduler: ready tasks start longest-remaining-path first,
+    skipping those whose `process_resources()` don't fit in `resources`.
+    """
+    pool = _ResourcePool(resources or {})
+    priority = _remaining_path_lengths(graph, durations)
+    n_pending_deps = {task: len(set(deps)) for task, deps in graph.items()}
+    dependents = _dependents(graph)
+
+    ready = [task for task, n in n_pending_deps.items() if n == 0]
+    running = []
+    now = 0.0
+
+    while ready or running:
+        ready.sort(key=lambda t: priority[t], reverse=True)
+        for task in list(ready):
+            if len(running) >= workers or not pool.fits(task):
+                continue
+
+            ready.remove(task)
+            pool.claim(task)
+            heapq.heappush(
+                running, (now + durations.predict(task), task.task_id, task),
+            )
+
+        if not running:
+            raise RuntimeError(
+                f'Tasks can never be scheduled with resources {pool.totals}: {ready}'
+            )
+
+        now, _, task = heapq.heappop(running)
+        pool.release(task)
+        for dependent in dependents[task]:
+            n_pending_deps[dependent] -= 1
+            if n_pending_deps[dependent] == 0:
+                ready.append(dependent)
+
+    return now
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02d}m{seconds:02d}s'
+
+
+@click.command(context_settings={'help_option_names': ['-h', '--help']})
+@click.option('workers', '--workers', '-w',
+              help='Number of Luigi workers to predict the build time for.',
+              type=int, multiple=True, default=(os.cpu_count(),),
+              show_default=True)
+@click.option('incremental', '--incremental', '-i',
+              help='Skip tasks which are already complete.',
+              is_flag=True)
+@click.option('metrics_fp', '--metrics-file', '-m',
+              help='Metrics recorded by previous builds.',
+              default=BUILD_METRICS_FILE, show_default=True)
+def plan_cli(**kwargs):
+    """Print the critical path and predicted time of a QGreenland build."""
+    # Imported here to avoid a circular import; tasks use this module for
+    # their priorities.
+    from qgreenland.tasks.main import ZipQGreenland
+
+    durations = recorded_durations(kwargs['metrics_fp'])
+    graph = task_graph(ZipQGreenland())
+    if kwargs['incremental']:
+        complete = {task for task in graph if task.complete()}
+        graph = {
+            task: [d for d in deps if d not in complete]
+            for task, deps in graph.items()
+            if task not in complete
+        }
+
+    unmeasured = [t for t in graph if not durations.is_measured(t)]
+    total_s = sum(durations.predict(t) for t in graph)
+    print(f'{len(graph)} tasks ({len(unmeasured)} never measured),'
+          f' {_format_duration(total_s)} of work in total.')
+
+    length_s, path = critical_path(graph, durations)
+    print(f'\nCritical path ({_format_duration(length_s)}):')
+    for task in path:
+        print(f'  {_format_duration(durations.predict(task))}  {task}')
+
+    resources = luigi.configuration.get_config().getintdict('resources')
+    print(f'\nPredicted build time with resources {resources}:')
+    for workers in kwargs['workers']:
+        makespan_s = simulate_makespan(
+            graph, durations, workers=workers, resources=resources,
+        )
+        print(f'  {workers:>3} workers: {_format_duration(makespan_s)}')
+
+
+if __name__ == '__main__':
+    plan_cli()
@@ -0,0 +1,265 @@
+"""Record resource usage of every task run, and report on it.
+
+Measurements are taken by Luigi event handlers (see
+`register_event_handlers`), so tasks don't have to opt in. Each task run
+appends one JSON record to `BUILD_METRICS_FILE`. Luigi runs each task in its
+own forked process when there is more than one worker, so peak RSS is per
+task; with one worker it's the peak of the whole build so far.
+
+Bytes downloaded per remote host, and the time spent downloading them, are
+recorded too (see `qgreenland.util.governor`) and summarized per host in the
+build report.
+"""
+import csv
+import datetime
+import json
+import logging
+import os
+import resource
+import time
+from typing import Any, Dict
+
+import luigi
+
+from qgreenland.constants import BUILD_METRICS_FILE
+from qgreenland.util.governor import host_totals
+from qgreenland.util.misc import directory_size_bytes
+
+logger = logging.getLogger('luigi-interface')
+
+REPORT_FIELDS = (
+    'task_id',
+    'task_family',
+    'layer_id',
+    'status',
+    'started_at',
+    'wall_time_s',
+    'cpu_time_s',
+    'peak_rss_bytes',
+    'read_bytes',
+    'write_bytes',
+    'output_bytes',
+)
+HOST_REPORT_FIELDS = ('host', 'bytes', 'transfer_s', 'bytes_per_s')
+
+# Measurements at task start, keyed by task_id.
+_started: Dict[str, Dict[str, Any]] = {}
+
+
+def _cpu_time_s():
+    """CPU time of this process and its reaped children, e.g. GDAL commands."""
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return sum((
+        self_usage.ru_utime, self_usage.ru_stime,
+        children_usage.ru_utime, children_usage.ru_stime,
+    ))
+
+
+def _peak_rss_bytes():
+    """Peak RSS of this process or its largest reaped child."""
+    # `ru_maxrss` is in KB on Linux.
+    return 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def _io_bytes():
+    """Bytes this process and its reaped children read from/wrote to storage.
+
+    Returns `(None, None)` where `/proc/self/io` isn't available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return None, None
+
+    return int(counters['read_bytes']), int(counters['write_bytes'])
+
+
+def _output_bytes(task):
+    """Total size of the task's local outputs which exist."""
+    total = 0
+    for target in luigi.task.flatten(task.output()):
+        path = getattr(target, 'path', None)
+        if path is None or not os.path.exists(path):
+            continue
+
+        if os.path.isdir(path):
+            total += directory_size_bytes(path)
+        else:
+            total += os.path.getsize(path)
+
+    return total
+
+
+def _downloads_since(started_totals):
+    """Return bytes and seconds transferred per host since `started_totals`."""
+    downloads = {}
+    for host, totals in host_totals().items():
+        started = started_totals.get(host, {'bytes': 0, 'seconds': 0.0})
+        if totals['seconds'] > started['seconds']:
+            downloads[host] = {
+                'bytes': totals['bytes'] - started['bytes'],
+                'seconds': round(totals['seconds'] - started['seconds'], 3),
+            }
+
+    return downloads
+
+
+def _task_started(task):
+    read_bytes, write_bytes = _io_bytes()
+    _started[task.task_id] = {
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'wall_time': time.perf_counter(),
+        'cpu_time': _cpu_time_s(),
+        'read_bytes': read_bytes,
+        'write_bytes': write_bytes,
+        'host_totals': host_totals(),
+    }
+
+
+def _record(task, *, status):
+    started = _started.pop(task.task_id, None)
+    if started is None:
+        return
+
+    read_bytes, write_bytes = _io_bytes()
+    try:
+        output_bytes = _output_bytes(task)
+    except Exception as e:
+        logger.warning(f'Could not measure outputs of {task}: {e}')
+        output_bytes = None
+
+    record = {
+        'task_id': task.task_id,
+        'task_family': task.get_task_family(),
+        'layer_id': getattr(task, 'layer_id', None),
+        'status': status,
+        'started_at': started['started_at'],
+        'wall_time_s': round(time.perf_counter() - started['wall_time'], 3),
+        'cpu_time_s': round(_cpu_time_s() - started['cpu_time'], 3),
+        'peak_rss_bytes': _peak_rss_bytes(),
+        'read_bytes': (
+            None if read_bytes is None else read_bytes - started['read_bytes']
+        ),
+        'write_bytes': (
+            None if write_bytes is None else write_bytes - started['write_bytes']
+        ),
+        'output_bytes': output_bytes,
+        'downloads': _downloads_since(started['host_totals']),
+    }
+
+    os.makedirs(os.path.dirname(BUILD_METRICS_FILE), exist_ok=True)
+    # One write per record in append mode, so concurrent workers' records
+    # don't interleave.
+    with open(BUILD_METRICS_FILE, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def _task_succeeded(task):
+    _record(task, status='success')
+
+
+def _task_failed(task, _exception):
+    _record(task, status='failure')
+
+
+def register_event_handlers(task_cls=luigi.Task):
+    """Profile every run of `task_cls` and its subclasses."""
+    task_cls.event_handler(luigi.Event.START)(_task_started)
+    task_cls.event_handler(luigi.Event.SUCCESS)(_task_succeeded)
+    task_cls.event_handler(luigi.Event.FAILURE)(_task_failed)
+
+
+def read_metrics(metrics_fp=BUILD_METRICS_FILE):
+    """Return all recorded task runs, oldest first."""
+    if not os.path.isfile(metrics_fp):
+        return []
+
+    with open(metrics_fp) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _dependency_ids(task):
+    """Return the task_ids of `task` and everything upstream of it."""
+    task_ids = set()
+    stack = [task]
+    while stack:
+        t = stack.pop()
+        if t.task_id in task_ids:
+            continue
+
+        task_ids.add(t.task_id)
+        stack.extend(luigi.task.flatten(t.requires()))
+
+    return task_ids
+
+
+def write_build_report(task, *, output_basepath, metrics_fp=BUILD_METRICS_FILE):
+    """Write JSON and CSV reports of the latest run of each task in `task`'s graph.
+
+    Tasks which were already complete at the start of this build are reported
+    from the build which ran them. Rows are sorted by wall time, longest first.
+    """
+    task_ids = _dependency_ids(task)
+    latest_runs = {}
+    for record in read_metrics(metrics_fp):
+        if record['task_id'] in task_ids:
+            latest_runs[record['task_id']] = record
+
+    rows = sorted(
+        latest_runs.values(),
+        key=lambda r: r['wall_time_s'],
+        reverse=True,
+    )
+
+    with open(f'{output_basepath}.json', 'w') as f:
+        json.dump(rows, f, indent=2)
+
+    with open(f'{output_basepath}.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(
+            f, fieldnames=REPORT_FIELDS, extrasaction='ignore',
+        )
+        writer.writeheader()
+        writer.writerows(rows)
+
+    with open(f'{output_basepath}_hosts.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=HOST_REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(host_throughput(rows))
+
+    logger.info(
+        f'Wrote build report for {len(rows)} tasks: {output_basepath}.{{json,csv}}'
+        f' and {output_basepath}_hosts.csv'
+    )
+
+
+def host_throughput(records):
+    """Sum the downloads of task run `records` per host, busiest first.
+
+    `bytes_per_s` is per connection; hosts serving several connections at once
+    delivered more in total.
+    """
+    totals = {}
+    for record in records:
+        for host, downloads in (record.get('downloads') or {}).items():
+            host_total = totals.setdefault(host, {'bytes': 0, 'transfer_s': 0.0})
+            host_total['bytes'] += downloads['bytes']
+            host_total['transfer_s'] += downloads['seconds']
+
+    rows = []
+    for host, t in totals.items():
+        rows.append({
+            'host': host,
+            'bytes': t['bytes'],
+            'transfer_s': round(t['transfer_s'], 3),
+            'bytes_per_s': (
+                round(t['bytes'] / t['transfer_s']) if t['transfer_s'] else None
+            ),
+        })
+
+    return sorted(rows, key=lambda row: row['bytes'], reverse=True)
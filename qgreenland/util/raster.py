@@ -1,8 +1,12 @@
+import inspect
 import logging
 import os
 import subprocess
 import tempfile
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Union
+from xml.etree import ElementTree
 
 import pyproj
 from osgeo import gdal
@@ -10,10 +14,42 @@ from osgeo.gdalconst import GA_ReadOnly
 
 from qgreenland.config import CONFIG
 from qgreenland.exceptions import QgrRuntimeError
+from qgreenland.util.calc import GDAL_CALC_DEFAULT_NODATA, gdal_calc, is_nodata
 
 logger = logging.getLogger('luigi-interface')
 
 
+# `gdal.Warp` performance settings by the size of the raster to warp, smallest
+# first. Threads are capped at the host's cores, and memory at shares of the
+# warping task's `memory` resource; see `warp_performance_kwargs`.
+WARP_PROFILES = {
+    # Quick to warp; not worth competing with other tasks for cores.
+    'small': {
+        'max_bytes': 256 * 1024 ** 2,
+        'threads': 1,
+        'warp_memory_mb': 64,
+        'cache_mb': 64,
+    },
+    'medium': {
+        'max_bytes': 4 * 1024 ** 3,
+        'threads': 4,
+        'warp_memory_mb': 1024,
+        'cache_mb': 512,
+    },
+    'large': {
+        'max_bytes': None,
+        'threads': None,
+        'warp_memory_mb': 4096,
+        'cache_mb': 2048,
+    },
+}
+
+
+def is_lazy(fp):
+    """Whether `fp` is a virtual raster, to be computed when materialized."""
+    return fp.endswith('.vrt')
+
+
 def _get_raster_srs_str(fp):
     """Read a raster with GDAL and return its SRS or None."""
     try:
@@ -41,11 +77,85 @@ def _get_raster_srs_str(fp):
         return None
 
 
+def _gdal_error(action):
+    """Return an error for a failed GDAL `action`, with GDAL's last message."""
+    return QgrRuntimeError(f'{action} failed: {gdal.GetLastErrorMsg()}')
+
+
+def host_cores():
+    """Return the number of cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def raster_bytes(fp):
+    """Return the uncompressed size of the raster at `fp`."""
+    ds = gdal.Open(fp, GA_ReadOnly)
+    band = ds.GetRasterBand(1)
+    pixel_bytes = gdal.GetDataTypeSize(band.DataType) // 8
+
+    return ds.RasterXSize * ds.RasterYSize * ds.RasterCount * pixel_bytes
+
+
+def warp_profile(fp):
+    """Return the name of the `WARP_PROFILES` entry for the raster at `fp`."""
+    size = raster_bytes(fp)
+    for name, profile in WARP_PROFILES.items():
+        if profile['max_bytes'] is None or size <= profile['max_bytes']:
+            return name
+
+
+def warp_performance_kwargs(inp_path, *, memory_gb, cpus, profile=None):
+    """Return `warp_raster` kwargs to warp `inp_path` quickly.
+
+    `profile` is a `WARP_PROFILES` name, chosen by the size of `inp_path` if
+    not given. Warping and compression use the profile's threads, at most
+    `cpus`, and warping and GDAL's block cache get at most half and a quarter
+    of `memory_gb`; pass the task's `cpu` and `memory` resources.
+    """
+    profile = profile or warp_profile(inp_path)
+    settings = WARP_PROFILES[profile]
+    threads = min(settings['threads'] or cpus, cpus, host_cores())
+    memory_mb = int(memory_gb * 1024)
+    logger.info(f'Warping {inp_path} with the {profile} profile')
+
+    kwargs = {
+        # Values under 10000 are in MB.
+        'warpMemoryLimit': min(settings['warp_memory_mb'], memory_mb // 2),
+        'cache_max_mb': min(settings['cache_mb'], memory_mb // 4),
+    }
+    if threads > 1:
+        kwargs['multithread'] = True
+        kwargs['warpOptions'] = [f'NUM_THREADS={threads}']
+        # Compress blocks in parallel, for drivers which support it (GTiff).
+        kwargs['creationOptions'] = [f'NUM_THREADS={threads}']
+
+    return kwargs
+
+
+@contextmanager
+def gdal_cache_max(cache_max_mb):
+    """Set the size of GDAL's block cache, if given, until exiting."""
+    if cache_max_mb is None:
+        yield
+        return
+
+    # Unlike the `GDAL_CACHEMAX` config option, takes effect after GDAL has
+    # read any raster.
+    previous = gdal.GetCacheMax()
+    gdal.SetCacheMax(int(cache_max_mb * 1024 ** 2))
+    try:
+        yield
+    finally:
+        gdal.SetCacheMax(previous)
+
+
 def warp_raster(inp_path, out_path, *, layer_cfg, warp_kwargs=None):
     """Use gdal.Warp to modify raster data file.
 
     TODO: Switch to gdal command-line
-    TODO: Figure out a way to warp in one step, stop using _gdalwarp_cut_hack()
     """
     logger.info(f"Reprojecting {layer_cfg['id']}...")
 
@@ -67,14 +177,20 @@ def warp_raster(inp_path, out_path, *, layer_cfg, warp_kwargs=None):
                            'No projection automatically detected and '
                            'none explicitly provided.')
 
+    if is_lazy(out_path):
+        # Applied when the VRT is materialized; see `materialize_vrt`.
+        warp_kwargs.pop('creationOptions', None)
+        warp_kwargs['format'] = 'VRT'
+
     ignore_output_bounds_hack = warp_kwargs.pop('ignore_output_bounds_hack', False)
-    if ignore_output_bounds_hack:
-        _gdalwarp(out_path, inp_path, **warp_kwargs)
-    else:
-        _gdalwarp_cut_hack(
-            out_path, inp_path,
-            layer_cfg=layer_cfg, warp_kwargs=warp_kwargs
-        )
+    with gdal_cache_max(warp_kwargs.pop('cache_max_mb', None)):
+        if ignore_output_bounds_hack:
+            _gdalwarp(out_path, inp_path, **warp_kwargs)
+        else:
+            _gdalwarp_cut_hack(
+                out_path, inp_path,
+                layer_cfg=layer_cfg, warp_kwargs=warp_kwargs
+            )
 
 
 def _gdalwarp_cut_hack(out_path, inp_path, *, layer_cfg, warp_kwargs):
@@ -98,11 +214,16 @@ def _gdalwarp_cut_hack(out_path, inp_path, *, layer_cfg, warp_kwargs):
     idea why setting target extent in a separate operation fixes this. Setting
     target extent in the same operation _does not_ fix this.
 
-    TODO: Figure out a way to stop doing this in two steps!!!
+    The first step is an in-memory warped VRT, so it's computed a block at a
+    time as the second step reads it, and only the output is written to disk.
+    If the output is a VRT too, the first step is written next to it, as
+    `bounds.vrt`, for the output to refer to.
     """
     # These kwargs are only for step2. 'creationOptions' is extracted so we
     # don't, e.g. compress twice.
     step2_keys = ['cutlineDSName', 'cropToCutline', 'creationOptions']
+    # Step 2 warps too, as it reads step 1, so both get the performance kwargs.
+    shared_keys = ['multithread', 'warpMemoryLimit', 'warpOptions']
 
     # Step 1 needs to subset for this to work (outputBounds == `-te`).
     step1_kwargs = {k: v for k, v in warp_kwargs.items() if k not in step2_keys}
@@ -111,22 +232,36 @@ def _gdalwarp_cut_hack(out_path, inp_path, *, layer_cfg, warp_kwargs):
 
     # Step 2 actually does the shape-based cut as a separate step, to avoid
     # errors.
-    step2_kwargs = {k: v for k, v in warp_kwargs.items() if k in step2_keys}
-
-    with tempfile.TemporaryDirectory() as td:
-        step1_tempfn = f'tempfile{os.path.splitext(out_path)[1]}'
-        step1_tempfp = os.path.join(td, step1_tempfn)
+    step2_kwargs = {
+        k: v for k, v in warp_kwargs.items() if k in step2_keys + shared_keys
+    }
 
-        _gdalwarp(step1_tempfp, inp_path, **step1_kwargs)
-        _gdalwarp(out_path, step1_tempfp, **step2_kwargs)
+    step1_kwargs['format'] = 'VRT'
+    step1_path = ''
+    if is_lazy(out_path):
+        step1_path = str(Path(out_path).with_name('bounds.vrt'))
 
+    step1_ds = gdal.Warp(step1_path, inp_path, **step1_kwargs)
+    if step1_ds is None:
+        raise _gdal_error(f'gdal.Warp of {inp_path} to the boundary')
 
-def _gdalwarp(out_path: str, inp_path: str, **warp_kwargs) -> None:
+    try:
+        _gdalwarp(out_path, step1_ds, **step2_kwargs)
+    finally:
+        # Close the dataset.
+        step1_ds = None
+
+
+def _gdalwarp(
+    out_path: str,
+    inp: Union[str, gdal.Dataset],
+    **warp_kwargs,
+) -> None:
+    inp_path = inp if isinstance(inp, str) else 'in-memory VRT'
     logger.debug(f'Warping {inp_path} -> {out_path} with arguments:'
                  f' {warp_kwargs}')
 
-    gdal.UseExceptions()
-    gdal.Warp(out_path, inp_path, **warp_kwargs)
+    gdal.Warp(out_path, inp, **warp_kwargs)
 
     if not Path(out_path).is_file():
         raise RuntimeError(
@@ -135,25 +270,26 @@ def _gdalwarp(out_path: str, inp_path: str, **warp_kwargs) -> None:
         )
 
 
-def gdal_calc_raster(in_filepath, out_filepath, *, layer_cfg, gdal_calc_kwargs):
-    cmd_args_list = []
-    for k, v in gdal_calc_kwargs.items():
-        cmd_args_list.append(f'--{k}={v}')
-
-    cmd_args_str = ' '.join(cmd_args_list)
-
-    cmd = (f'. activate gdal && gdal_calc.py {cmd_args_str}'
-           f' -A {in_filepath} --outfile={out_filepath}')
-    logger.debug(f'Executing gdal_calc command: {cmd}')
-
-    # TODO: util func for running external cmd.
-    result = subprocess.run(cmd,
-                            shell=True,
-                            executable='/bin/bash',
-                            capture_output=True)
+def gdal_calc_raster(
+    in_filepath, out_filepath, *, layer_cfg, gdal_calc_kwargs, workers,
+):
+    """Write `gdal_calc_kwargs['calc']` of `in_filepath`, as `A`; see `gdal_calc`.
 
-    if result.returncode != 0:
-        raise RuntimeError(result.stderr)
+    Windows are computed on `workers` threads; pass the task's `cpu` resource.
+    """
+    creation_options = gdal_calc_kwargs.get('creation-option', [])
+    if isinstance(creation_options, str):
+        creation_options = [creation_options]
+
+    gdal_calc(
+        {'A': in_filepath}, out_filepath,
+        # Quoted for the shell, as `gdal_calc.py` arguments.
+        calc=gdal_calc_kwargs['calc'].strip('\'"'),
+        out_type=gdal_calc_kwargs.get('type'),
+        nodata_value=gdal_calc_kwargs.get('NoDataValue'),
+        creation_options=creation_options,
+        workers=workers,
+    )
 
 
 def gdal_mdim_translate_raster(in_filepath, out_filepath, *,
@@ -214,3 +350,181 @@ def apply_mask(source_grid, mask_grid, nodata_value):
     masked_grid[mask_grid] = nodata_value
 
     return masked_grid
+
+
+# Evaluates a `gdal_calc.py` expression of `A` for each block read from a
+# derived VRT band. `{calc}`, `{src_nodata}` and `{dst_nodata}` are filled in.
+_GDAL_CALC_PIXEL_FUNCTION = """
+import numpy as np
+from numpy import *
+
+
+{is_nodata}
+
+def gdal_calc(in_ar, out_ar, *args, **kwargs):
+    A = in_ar[0]
+    src_nodata = {src_nodata}
+    result = {calc}
+    if src_nodata is not None:
+        result = where(is_nodata(A, src_nodata), {dst_nodata}, result)
+    out_ar[:] = result
+"""
+
+
+def gdal_calc_vrt(in_filepath, out_filepath, *, gdal_calc_kwargs):
+    """Write a VRT computing `gdal_calc_raster`'s output as it's read.
+
+    Reading it requires the `GDAL_VRT_ENABLE_PYTHON=YES` config option; see
+    `materialize_vrt`.
+    """
+    calc = gdal_calc_kwargs['calc'].strip('\'"')
+    ds = gdal.Open(in_filepath, GA_ReadOnly)
+    if ds is None:
+        raise _gdal_error(f'Opening {in_filepath}')
+
+    # Read before closing `ds`; with GDAL 3.0, bands don't keep their dataset
+    # open.
+    src_band = ds.GetRasterBand(1)
+    src_nodata = src_band.GetNoDataValue()
+    out_type = gdal_calc_kwargs.get('type', gdal.GetDataTypeName(src_band.DataType))
+    dst_nodata = gdal_calc_kwargs.get('NoDataValue', GDAL_CALC_DEFAULT_NODATA[out_type])
+    src_band = None
+
+    vrt_ds = gdal.Translate(out_filepath, ds, format='VRT')
+    if vrt_ds is None:
+        raise _gdal_error(f'gdal.Translate {in_filepath} -> {out_filepath}')
+    vrt_ds.GetRasterBand(1).SetNoDataValue(dst_nodata)
+    vrt_ds = None
+    ds = None
+
+    pixel_function = _GDAL_CALC_PIXEL_FUNCTION.format(
+        # Masks nodata like `gdal_calc`, including NaN.
+        is_nodata=inspect.getsource(is_nodata),
+        calc=calc,
+        src_nodata=src_nodata,
+        dst_nodata=dst_nodata,
+    )
+    tree = ElementTree.parse(out_filepath)
+    band = tree.find('VRTRasterBand')
+    for source in band:
+        # Pass nodata pixels to the pixel function, which masks them, instead
+        # of skipping them.
+        for nodata in source.findall('NODATA'):
+            source.remove(nodata)
+    band.set('subClass', 'VRTDerivedRasterBand')
+    band.set('dataType', out_type)
+    for tag, text in (
+        ('PixelFunctionType', 'gdal_calc'),
+        ('PixelFunctionLanguage', 'Python'),
+        ('PixelFunctionCode', pixel_function),
+        # Compute in floating point, as `gdal_calc.py` does for float
+        # expressions, not in the output type.
+        ('SourceTransferType', 'Float64'),
+    ):
+        ElementTree.SubElement(band, tag).text = text
+    tree.write(out_filepath)
+
+
+def to_vrt(in_filepath, out_filepath):
+    """Write a VRT of `in_filepath`, e.g. to edit its metadata without copying it."""
+    if gdal.Translate(out_filepath, in_filepath, format='VRT') is None:
+        raise _gdal_error(f'gdal.Translate {in_filepath} -> {out_filepath}')
+
+
+@contextmanager
+def gdal_config_options(**options):
+    """Set GDAL config options until exiting."""
+    previous = {k: gdal.GetConfigOption(k) for k in options}
+    for k, v in options.items():
+        gdal.SetConfigOption(k, v)
+    try:
+        yield
+    finally:
+        for k, v in previous.items():
+            gdal.SetConfigOption(k, v)
+
+
+def materialize_vrt(vrt_filepath, out_filepath, *, creation_options):
+    """Compute the raster described by `vrt_filepath` into `out_filepath`."""
+    logger.info(f'Materializing {vrt_filepath} -> {out_filepath}')
+    # Our VRTs may compute `gdal_calc` expressions; see `gdal_calc_vrt`.
+    with gdal_config_options(GDAL_VRT_ENABLE_PYTHON='YES'):
+        out_ds = gdal.Translate(
+            out_filepath, vrt_filepath, creationOptions=creation_options,
+        )
+    if out_ds is None:
+        raise _gdal_error(f'Materializing {vrt_filepath}')
+    out_ds = None
+
+
+# Tile size of Cloud-Optimized GeoTIFFs; also the size below which no more
+# overviews are built.
+COG_BLOCK_SIZE = 512
+COG_CREATION_OPTIONS = [
+    'TILED=YES',
+    f'BLOCKXSIZE={COG_BLOCK_SIZE}',
+    f'BLOCKYSIZE={COG_BLOCK_SIZE}',
+    'COMPRESS=DEFLATE',
+    'BIGTIFF=IF_SAFER',
+    # Write the overviews before the full resolution data, as a COG.
+    'COPY_SRC_OVERVIEWS=YES',
+]
+# `BuildOverviews` resampling methods in GDAL 3.0.
+OVERVIEW_RESAMPLING_METHODS = (
+    'nearest', 'average', 'cubic', 'cubicspline', 'lanczos', 'gauss', 'mode',
+)
+
+
+def cog_overview_levels(width, height):
+    """Return the overview factors to reduce a raster to one COG tile."""
+    levels = []
+    factor = 1
+    while -(-max(width, height) // factor) > COG_BLOCK_SIZE:
+        factor *= 2
+        levels.append(factor)
+
+    return levels
+
+
+def write_cog(in_filepath, out_filepath, *, overview_levels=None, resampling='average'):
+    """Write `in_filepath` as a tiled, compressed Cloud-Optimized GeoTIFF.
+
+    Overviews are built with `cog_overview_levels`, unless `overview_levels`
+    are given, in a scratch file next to `out_filepath`, then copied into the
+    output with the full resolution data, so the output is written once.
+    GDAL 3.0 has no COG driver; this is its documented recipe for GTiff.
+
+    A VRT `in_filepath` (see `is_lazy`) is read as-is, without a scratch copy of
+    its full resolution data; it's computed when the overviews are built and
+    again when the output is written.
+    """
+    logger.info(f'Writing COG {in_filepath} -> {out_filepath}')
+    config_options = {'BIGTIFF_OVERVIEW': 'IF_SAFER'}
+    if is_lazy(in_filepath):
+        # Our VRTs may compute `gdal_calc` expressions; see `gdal_calc_vrt`.
+        config_options['GDAL_VRT_ENABLE_PYTHON'] = 'YES'
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(out_filepath)) as scratch:
+        # Overviews are written next to the source; don't touch the input.
+        src_path = os.path.join(scratch, 'source.vrt')
+        to_vrt(os.path.abspath(in_filepath), src_path)
+
+        with gdal_config_options(**config_options):
+            src_ds = gdal.Open(src_path, GA_ReadOnly)
+            if src_ds is None:
+                raise _gdal_error(f'Opening {in_filepath}')
+
+            levels = overview_levels or cog_overview_levels(
+                src_ds.RasterXSize, src_ds.RasterYSize,
+            )
+            # Returns a `CPLErr`, `CE_None` (0) if it succeeded.
+            if levels and src_ds.BuildOverviews(resampling.upper(), levels):
+                raise _gdal_error(f'Building overviews of {in_filepath}')
+
+            out_ds = gdal.Translate(
+                out_filepath, src_ds, creationOptions=COG_CREATION_OPTIONS,
+            )
+            if out_ds is None:
+                raise _gdal_error(f'Writing COG {out_filepath}')
+            out_ds = None
+            src_ds = None
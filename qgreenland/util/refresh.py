@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Re-fetch data sources which changed upstream since they were fetched.
+
+Fetch outputs are otherwise kept forever. Run this before a build; the build
+then rebuilds only layers using sources whose content changed. See
+`qgreenland.util.manifest`.
+"""
+import click
+
+from qgreenland.util.planning import task_graph
+
+
+@click.command(context_settings={'help_option_names': ['-h', '--help']})
+@click.option('dry_run', '--dry-run', '-d',
+              help="Only report which sources changed; don't fetch them.",
+              is_flag=True)
+def refresh_cli(**kwargs):
+    """Check fetched data sources for upstream changes and re-fetch them."""
+    # Imported here so `--help` works without loading the config.
+    from qgreenland.tasks.common.fetch import FetchTask
+    from qgreenland.tasks.main import ZipQGreenland
+
+    fetch_tasks = sorted(
+        {t for t in task_graph(ZipQGreenland()) if isinstance(t, FetchTask)},
+        key=lambda t: t.output_name,
+    )
+
+    for task in fetch_tasks:
+        if not task.complete():
+            print(f'{task.output_name}: not fetched yet')
+            continue
+
+        if not task.changed_upstream():
+            print(f'{task.output_name}: unchanged')
+            continue
+
+        if kwargs['dry_run']:
+            print(f'{task.output_name}: changed upstream')
+            continue
+
+        generation = task.content_version
+        task.clone(refresh=True).run()
+        if task.content_version == generation:
+            print(f'{task.output_name}: re-fetched; content unchanged')
+        else:
+            print(f'{task.output_name}: re-fetched; content changed')
+
+
+if __name__ == '__main__':
+    refresh_cli()
@@ -20,3 +20,25 @@ def generate_layer_tasks():
         tasks.append(task(layer_id=cfg['id']))
 
     return tasks
+
+
+def data_source_steps(data_source, task_cls):
+    """Return the `task_cls` steps of every layer pipeline using `data_source`.
+
+    Steps are found by following each pipeline's chain of `requires_task`.
+    """
+    steps = []
+
+    for cfg in CONFIG['layers'].values():
+        if cfg['data_source'] != data_source:
+            continue
+        if cfg['dataset']['access_method'] == 'gdal_remote':
+            continue
+
+        task = INGEST_TASKS[cfg['ingest_task']](layer_id=cfg['id']).requires()
+        while task is not None:
+            if isinstance(task, task_cls):
+                steps.append(task)
+            task = getattr(task, 'requires_task', None)
+
+    return steps
@@ -3,6 +3,7 @@ import subprocess
 
 import geopandas as gpd
 import pandas as pd
+from osgeo import gdal
 
 from qgreenland.exceptions import QgrRuntimeError
 
@@ -72,3 +73,32 @@ def ogr2ogr(in_filepath, out_filepath, **ogr2ogr_kwargs):
         raise RuntimeError(result.stderr)
 
     return result
+
+
+def merge_to_gpkg(in_filepaths, out_filepath, *, layer_name):
+    """Write the features of all `in_filepaths` to one GeoPackage layer.
+
+    Runs in process, appending every input to the one open output dataset,
+    instead of running `ogr2ogr` once per input.
+    """
+    out_ds = None
+    for in_filepath in in_filepaths:
+        logger.debug(f'Appending {in_filepath} to {out_filepath}:{layer_name}')
+        if out_ds is None:
+            out_ds = gdal.VectorTranslate(
+                out_filepath, in_filepath, format='GPKG', layerName=layer_name,
+            )
+            succeeded = out_ds is not None
+        else:
+            # Returns 1 if it succeeded, given an open output dataset.
+            succeeded = gdal.VectorTranslate(
+                out_ds, in_filepath, accessMode='append', layerName=layer_name,
+            ) == 1
+
+        if not succeeded:
+            raise QgrRuntimeError(
+                f'Failed to append {in_filepath} to {out_filepath}:'
+                f' {gdal.GetLastErrorMsg()}'
+            )
+
+    out_ds = None
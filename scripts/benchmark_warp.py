@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Time warping a large synthetic raster with and without a warp profile.
+
+See `qgreenland.util.raster.WARP_PROFILES`. Run in the luigi container, e.g.:
+
+    docker-compose exec luigi python \
+        ./tasks/qgreenland/scripts/benchmark_warp.py --size 16384
+"""
+import os
+import tempfile
+import time
+
+import click
+import numpy as np
+from osgeo import gdal, osr
+
+from qgreenland.util.raster import (host_cores,
+                                    raster_bytes,
+                                    warp_performance_kwargs,
+                                    warp_raster)
+
+# Extent of the synthetic raster, in the source projection.
+HALF_WIDTH_M = 3_000_000
+SOURCE_EPSG = 3411
+ROWS_PER_WRITE = 512
+
+
+def _synthetic_raster(fp, *, size):
+    """Write a `size` by `size` Float32 raster of noisy waves, a strip at a time."""
+    ds = gdal.GetDriverByName('GTiff').Create(
+        fp, size, size, 1, gdal.GDT_Float32,
+        options=['TILED=YES', 'BIGTIFF=YES'],
+    )
+    res = 2 * HALF_WIDTH_M / size
+    ds.SetGeoTransform((-HALF_WIDTH_M, res, 0, HALF_WIDTH_M, 0, -res))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(SOURCE_EPSG)
+    ds.SetProjection(srs.ExportToWkt())
+
+    band = ds.GetRasterBand(1)
+    rng = np.random.default_rng(0)
+    cols = np.sin(np.arange(size, dtype=np.float32) / 97)
+    for row in range(0, size, ROWS_PER_WRITE):
+        n_rows = min(ROWS_PER_WRITE, size - row)
+        rows = np.cos(np.arange(row, row + n_rows, dtype=np.float32) / 89)
+        data = np.outer(rows, cols) * 1000 + rng.random((n_rows, size)) * 10
+        band.WriteArray(data.astype(np.float32), 0, row)
+    ds = None
+
+    return res
+
+
+def _time_warp(inp_path, out_path, warp_kwargs):
+    start = time.monotonic()
+    warp_raster(
+        inp_path, out_path,
+        layer_cfg={'id': 'benchmark'},
+        warp_kwargs={**warp_kwargs, 'ignore_output_bounds_hack': True},
+    )
+    elapsed = time.monotonic() - start
+    os.remove(out_path)
+
+    return elapsed
+
+
+@click.command(context_settings={'help_option_names': ['-h', '--help']})
+@click.option('size', '--size', '-s',
+              help='Width and height of the synthetic raster, in pixels.',
+              type=int, default=16384, show_default=True)
+@click.option('profile', '--profile', '-p',
+              help='Warp profile to compare; by default, chosen by size.',
+              type=click.Choice(['small', 'medium', 'large']), default=None)
+@click.option('memory_gb', '--memory-gb', '-m',
+              help='Memory resource of the warping task, in GB.',
+              type=int, default=4, show_default=True)
+@click.option('cpus', '--cpus', '-c',
+              help='CPU resource of the warping task; by default, all cores.',
+              type=int, default=None)
+@click.option('work_dir', '--work-dir', '-d',
+              help='Where to write the synthetic raster and warped outputs.',
+              default=None)
+def benchmark_cli(size, profile, memory_gb, cpus, work_dir):
+    cpus = cpus or host_cores()
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        inp_path = os.path.join(tmp_dir, 'synthetic.tif')
+        out_path = os.path.join(tmp_dir, 'warped.tif')
+
+        print(f'Writing a {size}x{size} synthetic raster...')
+        res = _synthetic_raster(inp_path, size=size)
+        print(
+            f'{raster_bytes(inp_path) / 1024 ** 3:.2f} GiB uncompressed,'
+            f' {host_cores()} cores'
+        )
+
+        baseline_kwargs = {
+            'resampleAlg': 'bilinear',
+            'xRes': res,
+            'yRes': res,
+            'creationOptions': ['COMPRESS=DEFLATE'],
+        }
+        profiled_kwargs = dict(baseline_kwargs)
+        performance_kwargs = warp_performance_kwargs(
+            inp_path, memory_gb=memory_gb, cpus=cpus, profile=profile,
+        )
+        profiled_kwargs['creationOptions'] = (
+            baseline_kwargs['creationOptions']
+            + performance_kwargs.pop('creationOptions', [])
+        )
+        profiled_kwargs.update(performance_kwargs)
+
+        # The raster was just written, so both runs read it from the page cache.
+        baseline_s = _time_warp(inp_path, out_path, baseline_kwargs)
+        print(f'Default settings: {baseline_s:.1f}s')
+        profiled_s = _time_warp(inp_path, out_path, profiled_kwargs)
+        print(f'Profiled settings {performance_kwargs}: {profiled_s:.1f}s')
+        print(f'Speedup: {baseline_s / profiled_s:.2f}x')
+
+
+if __name__ == '__main__':
+    benchmark_cli()
@@ -0,0 +1,5 @@
+#!/bin/bash
+
+# Print the critical path and predicted build time, e.g. for 8 and 16 workers:
+#     ./scripts/plan_build.sh -w 8 -w 16
+docker-compose exec luigi ./tasks/qgreenland/qgreenland/util/planning.py "$@"
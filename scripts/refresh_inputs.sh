@@ -0,0 +1,5 @@
+#!/bin/bash
+
+# Re-fetch data sources which changed upstream. Check without fetching:
+#     ./scripts/refresh_inputs.sh --dry-run
+docker-compose exec luigi ./tasks/qgreenland/qgreenland/util/refresh.py "$@"
@@ -1,12 +1,13 @@
 #!/bin/bash
 set -e
 
-# TODO: --workers=$(nproc)  (or more?)
-# Currently hardcoded to 1 because increasing number of workers leads to failures:
-#
-#    File "/luigi/tasks/qgreenland/util/qgis.py", line 87, in get_map_layer
-#        raise RuntimeError(f"Layer located at '{layer_path}' does not exist.")
-#        RuntimeError: Layer located at '/luigi/data/luigi-wip/qgreenland/Geophysics/IceBridge BedMachine/bedmachine_bed/bedmachine_bed.tif' does not exist.
+# Layer outputs are committed with atomic renames (see
+# `qgreenland.util.misc.temporary_path_dir`), so it's safe to run many workers.
+# How many tasks actually run at once is limited by the `[resources]` in
+# `luigi/conf/luigi.toml`; run enough workers to fill the CPU slots _and_ the
+# network slots so downloads overlap with processing. Override with e.g.
+# `QGR_WORKERS=1` to debug.
+workers="${QGR_WORKERS:-$(( $(nproc) + 8 ))}"
 
 # If this script is called from Jenkins, docker-compose's default TTY behavior
 # will not work. In other situations, we will want the ability to attach to a
@@ -21,6 +22,6 @@ fi
 # removed/commented for prod.
 # docker-compose up -d
 # NOTE: Workers must be set to 1 for python debug breakpoints to be usable
-docker-compose exec ${tty_arg} luigi luigi --workers=1 \
+docker-compose exec ${tty_arg} luigi luigi --workers="${workers}" \
   --module qgreenland.tasks.main ZipQGreenland
 # docker-compose down